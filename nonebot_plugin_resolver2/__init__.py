@@ -1,15 +1,24 @@
+import asyncio
+
 from nonebot import get_driver, logger
+from nonebot.matcher import Matcher
+from nonebot.message import run_postprocessor
 from nonebot.plugin import PluginMetadata
 
+from .client import close_sessions
 from .config import (
+    MEDIA_SERVER,
     Config,
-    plugin_cache_dir,
     rconfig,
     scheduler,
     ytb_cookies_file,
 )
 from .cookie import save_cookies_to_netscape
-from .matchers import resolvers
+from .download.cache import cache_manager
+from .download.ytdlp import ytdlp_info_cache, ytdlp_pool
+from .matchers import resolvers  # noqa: F401
+from .matchers.helper import release_base64
+from .server import media_server
 
 __plugin_meta__ = PluginMetadata(
     name="链接分享自动解析",
@@ -26,6 +35,10 @@ __plugin_meta__ = PluginMetadata(
     },
 )
 
+# 路由需要在驱动器启动前注册
+if MEDIA_SERVER:
+    media_server.setup()
+
 
 @get_driver().on_startup
 async def _():
@@ -33,43 +46,36 @@ async def _():
         save_cookies_to_netscape(rconfig.r_ytb_ck, ytb_cookies_file, "youtube.com")
         logger.debug(f"保存 youtube cookie 到 {ytb_cookies_file}")
 
-    destroy_resolvers: list[str] = []
-    if not rconfig.r_xhs_ck:
-        if xiaohongshu := resolvers.pop("xiaohongshu", None):
-            xiaohongshu.destroy()
-            logger.warning("未配置小红书 cookie, 小红书解析已关闭")
-            destroy_resolvers.append("xiaohongshu")
+    # 加载缓存索引
+    await cache_manager.load()
+    await cache_manager.evict()
 
-    # 关闭全局禁用的解析
-    for resolver in rconfig.r_disable_resolvers:
-        if matcher := resolvers.get(resolver, None):
-            matcher.destroy()
-            destroy_resolvers.append(resolver)
-    if destroy_resolvers:
-        logger.warning(f"已关闭解析: {', '.join(destroy_resolvers)}")
+    await asyncio.to_thread(ytdlp_info_cache.load)
+    # 启动 yt-dlp 工作进程
+    if ytdlp_pool is not None:
+        await ytdlp_pool.start()
 
-    # 初始化 bilibili api
-    from .parsers.bilibili import init_bilibili_api
 
-    init_bilibili_api()
+@get_driver().on_shutdown
+async def _():
+    await close_sessions()
+    await cache_manager.close()
+    if ytdlp_pool is not None:
+        await ytdlp_pool.close()
+    await asyncio.to_thread(ytdlp_info_cache.save)
 
 
-@scheduler.scheduled_job("cron", hour=1, minute=0, id="resolver2-clean-local-cache")
-async def clean_plugin_cache():
-    import asyncio
+@run_postprocessor
+async def _(matcher: Matcher):
+    # 释放 handler 固定的缓存文件和 base64 内存预算，此时消息已发送完成
+    cache_manager.release_held(matcher.state)
+    await release_base64(matcher.state)
 
-    from .download.utils import safe_unlink
 
+@scheduler.scheduled_job("interval", minutes=10, id="resolver2-evict-local-cache")
+async def evict_plugin_cache():
     try:
-        files = [f for f in plugin_cache_dir.iterdir() if f.is_file()]
-        if not files:
-            logger.info("no cache files to clean")
-            return
-
-        # 并发删除文件
-        tasks = [safe_unlink(file) for file in files]
-        await asyncio.gather(*tasks)
-
-        logger.info(f"Successfully cleaned {len(files)} cache files")
+        await cache_manager.sync()
+        await cache_manager.evict()
     except Exception as e:
-        logger.error(f"Error while cleaning cache: {e}")
+        logger.error(f"Error while evicting cache: {e}")
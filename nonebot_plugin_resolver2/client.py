@@ -0,0 +1,47 @@
+import asyncio
+
+import aiohttp
+
+from .constant import HTTP_KEEPALIVE_TIMEOUT, HTTP_LIMIT, HTTP_LIMIT_PER_HOST
+
+# 共享的 session，以 (代理, 是否校验证书) 为键
+_SESSIONS: dict[tuple[str | None, bool], aiohttp.ClientSession] = {}
+
+
+def get_session(*, proxy: str | None = None, verify_ssl: bool = True) -> aiohttp.ClientSession:
+    """获取共享的长连接 session，相同代理和 TLS 配置的请求复用同一个连接池
+
+    session 由插件统一管理，调用方不要关闭；aiohttp 不支持 session 级别的代理，请求时仍需传入 proxy
+
+    Args:
+        proxy (str | None, optional): 代理地址. Defaults to None.
+        verify_ssl (bool, optional): 是否校验证书. Defaults to True.
+
+    Returns:
+        aiohttp.ClientSession: session
+    """
+    key = (proxy, verify_ssl)
+    session = _SESSIONS.get(key)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300,
+            ssl=verify_ssl,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=300, connect=10.0),
+            # 不在请求之间共享 cookie，与每次新建 session 的行为保持一致
+            cookie_jar=aiohttp.DummyCookieJar(),
+        )
+        _SESSIONS[key] = session
+    return session
+
+
+async def close_sessions() -> None:
+    """关闭所有共享 session"""
+    sessions = list(_SESSIONS.values())
+    _SESSIONS.clear()
+    await asyncio.gather(*(session.close() for session in sessions if not session.closed))
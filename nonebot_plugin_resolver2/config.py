@@ -42,8 +42,54 @@ class Config(BaseModel):
     r_max_size: int = 100
     # 视频最大时长
     r_video_duration_maximum: int = 480
+    # 缓存目录最大大小 单位 MB，超过后按最近访问时间淘汰
+    r_cache_max_size: int = 2048
     # 禁止的解析器
     r_disable_resolvers: list[MatcherNames] = []
+    # 分段下载的并发连接数，为 1 时关闭分段下载
+    r_download_connections: int = 4
+    # 分段下载的分片大小 单位 MB
+    r_download_part_size: int = 8
+    # HLS 同时下载的分段数
+    r_hls_connections: int = 4
+    # 下载的全局最大并发连接数
+    r_download_max_connections: int = 16
+    # 下载的单个 host 最大并发连接数
+    r_download_host_connections: int = 6
+    # 顺序下载前是否先请求第一个字节，获取资源大小
+    r_download_preflight: bool = False
+    # 哔哩哔哩音视频流是否直接通过管道输入 ffmpeg 合并，不落盘临时文件
+    r_bili_stream_merge: bool = True
+    # 哔哩哔哩视频流编码偏好，越靠前越优先，都没有时接受任意编码
+    r_bili_video_codecs: list[Literal["avc", "hev", "av1"]] = ["avc", "av1", "hev"]
+    # 超过大小限制的视频是否压缩后直接发送，否则以文件形式发送
+    r_video_fit_size: bool = False
+    # 超过时长或大小限制的视频，发送前多少秒的预览片段 单位秒，为 0 时不发送预览
+    r_preview_duration: int = 30
+    # ffmpeg 编码任务的最大并发数，为 0 时根据 CPU 核数决定
+    r_ffmpeg_workers: int = 0
+    # ffmpeg 单个任务的最长运行时间 单位秒
+    r_ffmpeg_timeout: int = 600
+    # 是否通过 nonebot 的 FastAPI 驱动器提供缓存文件，协议端通过签名 url 拉取，优先于 base64
+    r_media_server: bool = False
+    # 协议端访问 nonebot 使用的地址，如 http://192.168.1.2:8080，为空时根据 HOST 和 PORT 生成
+    r_media_server_url: str | None = None
+    # 媒体文件 url 的有效时间 单位秒
+    r_media_server_ttl: int = 600
+    # yt-dlp 工作进程数，为 0 时在线程中执行
+    r_ytdlp_workers: int = 0
+    # yt-dlp 单个任务的最长运行时间 单位秒
+    r_ytdlp_timeout: int = 600
+    # 是否在重启时保留 yt-dlp 信息缓存
+    r_ytdlp_info_persist: bool = False
+    # yt-dlp 下载 DASH/HLS 分片的并发数
+    r_ytdlp_concurrent_fragments: int = 4
+    # yt-dlp 分块下载 http 资源的块大小 单位 MB，为 0 时不分块
+    r_ytdlp_http_chunk_size: int = 10
+    # 是否通过插件的下载器下载 yt-dlp 选择的 https 格式，共享连接限制、代理和下载统计
+    r_ytdlp_native_download: bool = False
+    # yt-dlp 下载音频的格式，passthrough 只复制音频流，opus/mp3 按大小限制转码，flac 无损转码
+    r_ytdlp_audio_format: Literal["passthrough", "opus", "mp3", "flac"] = "passthrough"
 
 
 plugin_cache_dir: Path = store.get_plugin_cache_dir()
@@ -64,9 +110,55 @@ PROXY: str | None = rconfig.r_proxy
 DURATION_MAXIMUM: int = rconfig.r_video_duration_maximum
 # 资源最大大小
 MAX_SIZE: int = rconfig.r_max_size
+# 缓存目录最大大小
+CACHE_MAX_SIZE: int = rconfig.r_cache_max_size
 # 是否需要上传音频文件
 NEED_UPLOAD: bool = rconfig.r_need_upload
 # 是否需要合并转发
 NEED_FORWARD: bool = rconfig.r_need_forward
 # 是否使用 base64 编码发送图片，音频，视频
 USE_BASE64: bool = rconfig.r_use_base64
+# 分段下载的并发连接数
+DOWNLOAD_CONNECTIONS: int = rconfig.r_download_connections
+# 分段下载的分片大小
+DOWNLOAD_PART_SIZE: int = rconfig.r_download_part_size
+# HLS 同时下载的分段数
+HLS_CONNECTIONS: int = rconfig.r_hls_connections
+# 下载的全局最大并发连接数
+DOWNLOAD_MAX_CONNECTIONS: int = rconfig.r_download_max_connections
+# 下载的单个 host 最大并发连接数
+DOWNLOAD_HOST_CONNECTIONS: int = rconfig.r_download_host_connections
+# 顺序下载前是否先请求第一个字节，获取资源大小
+DOWNLOAD_PREFLIGHT: bool = rconfig.r_download_preflight
+# 哔哩哔哩音视频流是否直接通过管道输入 ffmpeg 合并
+BILI_STREAM_MERGE: bool = rconfig.r_bili_stream_merge
+# 哔哩哔哩视频流编码偏好
+BILI_VIDEO_CODECS: list[str] = list(rconfig.r_bili_video_codecs)
+# 超过大小限制的视频是否压缩后直接发送
+VIDEO_FIT_SIZE: bool = rconfig.r_video_fit_size
+# 超过限制的视频的预览时长
+PREVIEW_DURATION: int = rconfig.r_preview_duration
+# ffmpeg 编码任务的最大并发数
+FFMPEG_WORKERS: int = rconfig.r_ffmpeg_workers
+# ffmpeg 单个任务的最长运行时间
+FFMPEG_TIMEOUT: int = rconfig.r_ffmpeg_timeout
+# 是否通过 nonebot 的 FastAPI 驱动器提供缓存文件
+MEDIA_SERVER: bool = rconfig.r_media_server
+# 协议端访问 nonebot 使用的地址
+MEDIA_SERVER_URL: str | None = rconfig.r_media_server_url
+# 媒体文件 url 的有效时间
+MEDIA_SERVER_TTL: int = rconfig.r_media_server_ttl
+# yt-dlp 工作进程数
+YTDLP_WORKERS: int = rconfig.r_ytdlp_workers
+# yt-dlp 单个任务的最长运行时间
+YTDLP_TIMEOUT: int = rconfig.r_ytdlp_timeout
+# 是否在重启时保留 yt-dlp 信息缓存
+YTDLP_INFO_PERSIST: bool = rconfig.r_ytdlp_info_persist
+# yt-dlp 下载 DASH/HLS 分片的并发数
+YTDLP_CONCURRENT_FRAGMENTS: int = rconfig.r_ytdlp_concurrent_fragments
+# yt-dlp 分块下载 http 资源的块大小
+YTDLP_HTTP_CHUNK_SIZE: int = rconfig.r_ytdlp_http_chunk_size
+# 是否通过插件的下载器下载 yt-dlp 选择的 https 格式
+YTDLP_NATIVE_DOWNLOAD: bool = rconfig.r_ytdlp_native_download
+# yt-dlp 下载音频的格式
+YTDLP_AUDIO_FORMAT: str = rconfig.r_ytdlp_audio_format
@@ -8,10 +8,42 @@ COMMON_HEADER: Final[dict[str, str]] = {
     "UBrowser/6.2.4098.3 Safari/537.36"
 }
 
+"""
+哔哩哔哩请求头，与 bilibili_api.HEADERS 一致，避免仅为请求头导入 bilibili_api
+"""
+BILIBILI_HEADER: Final[dict[str, str]] = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/131.0.0.0 Safari/537.36 Edg/131.0.0.0",
+    "Referer": "https://www.bilibili.com",
+}
+
 """
 视频最大大小（MB）
 """
 VIDEO_MAX_MB: Final[int] = 100
 
+"""
+使用 base64 发送时，待发送的 base64 数据最多占用的内存（MB），单个 handler 的数据在发送完成后释放
+"""
+BASE64_MAX_INFLIGHT_MB: Final[int] = 256
+
+"""
+下载失败后的重试次数
+"""
+DOWNLOAD_RETRIES: Final[int] = 3
+
+"""
+共享连接池的总连接数，单个 host 的连接数，空闲连接保持时间（秒）
+"""
+HTTP_LIMIT: Final[int] = 100
+HTTP_LIMIT_PER_HOST: Final[int] = 16
+HTTP_KEEPALIVE_TIMEOUT: Final[float] = 60.0
+
+"""
+yt-dlp 信息缓存最多占用的内存（MB），没有签名地址时的有效时间（秒）
+"""
+YTDLP_INFO_CACHE_MB: Final[int] = 8
+YTDLP_INFO_TTL: Final[int] = 6 * 3600
+
 # 解析列表文件名
 DISABLE_GROUPS: Final[str] = "disable_group_list.json"
@@ -1,26 +1,29 @@
 import asyncio
+from collections.abc import Callable, Coroutine
+from dataclasses import asdict, dataclass, field
+import json
+import os
 from pathlib import Path
+import re
+from typing import Any
 
 import aiofiles
+import aiofiles.os
 import aiohttp
 from nonebot import logger
-from tqdm.asyncio import tqdm
 
-from ..config import MAX_SIZE, plugin_cache_dir
-from ..constant import COMMON_HEADER
-from ..exception import DownloadException
-from .utils import exec_ffmpeg_cmd, generate_file_name, safe_unlink
+from ..client import get_session
+from ..config import DOWNLOAD_CONNECTIONS, DOWNLOAD_PART_SIZE, DOWNLOAD_PREFLIGHT, MAX_SIZE, plugin_cache_dir
+from ..constant import COMMON_HEADER, DOWNLOAD_RETRIES
+from ..exception import DownloadException, DownloadSizeLimitException
+from .cache import cache_manager
+from .ffmpeg import ffmpeg_pool, ffprobe
+from .scheduler import Priority, download_scheduler
+from .telemetry import DownloadRecord, download_telemetry
+from .utils import atomic_output, exec_ffmpeg_cmd, generate_file_name, safe_unlink
 
-# 全局 session
-_SESSION: aiohttp.ClientSession | None = None
-
-
-async def _get_session() -> aiohttp.ClientSession:
-    """获取或创建全局 session"""
-    global _SESSION
-    if _SESSION is None or _SESSION.closed:
-        _SESSION = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300, connect=10.0))
-    return _SESSION
+# 进行中的下载任务，以缓存路径为键，相同资源的并发请求共享同一个下载任务
+_IN_FLIGHT: dict[Path, asyncio.Task[Path]] = {}
 
 
 async def download_file_by_stream(
@@ -29,6 +32,7 @@ async def download_file_by_stream(
     file_name: str | None = None,
     proxy: str | None = None,
     ext_headers: dict[str, str] | None = None,
+    priority: Priority = Priority.VIDEO,
 ) -> Path:
     """download file by url with stream
 
@@ -37,6 +41,7 @@ async def download_file_by_stream(
         file_name (str | None, optional): file name. Defaults to get name by parse_url_resource_name.
         proxy (str | None, optional): proxy url. Defaults to None.
         ext_headers (dict[str, str] | None, optional): ext headers. Defaults to None.
+        priority (Priority, optional): download priority. Defaults to Priority.VIDEO.
 
     Returns:
         Path: file path
@@ -49,46 +54,392 @@ async def download_file_by_stream(
         file_name = generate_file_name(url)
     file_path = plugin_cache_dir / file_name
 
+    # 在当前 handler 结束前固定文件，防止被缓存淘汰
+    cache_manager.hold(file_path)
     # 如果文件存在，则直接返回
-    if file_path.exists():
+    if await cache_manager.lookup(file_path):
+        download_telemetry.cache_hit(url, file_name)
         return file_path
 
+    return await _single_flight(
+        file_path, lambda: _download_file(url, file_path, proxy=proxy, ext_headers=ext_headers, priority=priority)
+    )
+
+
+async def _single_flight(path: Path, factory: Callable[[], Coroutine[Any, Any, Path]]) -> Path:
+    """同一缓存路径只存在一个任务，其余调用者等待该任务完成
+
+    Args:
+        path (Path): 缓存路径
+        factory (Callable[[], Coroutine[Any, Any, Path]]): 没有进行中的任务时，创建任务的协程
+    """
+    task = _IN_FLIGHT.get(path)
+    if task is None:
+        task = asyncio.create_task(factory())
+        _IN_FLIGHT[path] = task
+        task.add_done_callback(lambda _: _IN_FLIGHT.pop(path, None))
+    # shield 防止某个调用者被取消时，连带取消其他调用者共享的任务
+    return await asyncio.shield(task)
+
+
+@dataclass
+class _PartState:
+    """未完成下载的断点信息，保存在 .part 文件旁的 .part.json 中"""
+
+    url: str
+    etag: str | None = None
+    last_modified: str | None = None
+    # 资源总大小，分段下载时必有
+    size: int | None = None
+    # 顺序下载已写入的字节数
+    written: int = 0
+    # 分段下载的分片大小
+    part_size: int = 0
+    # 分段下载已完成的分片起始位置
+    done_parts: list[int] = field(default_factory=list)
+    content_type: str | None = None
+
+    def match(self, probe: "RangeProbe") -> bool:
+        """资源未发生变化时返回 True"""
+        if self.etag or probe.etag:
+            return self.etag == probe.etag
+        if self.last_modified or probe.last_modified:
+            return self.last_modified == probe.last_modified
+        return self.size == probe.size
+
+    @property
+    def if_range(self) -> str | None:
+        """If-Range 请求头，资源变化时服务器会返回完整内容"""
+        return self.etag or self.last_modified
+
+
+@dataclass
+class RangeProbe:
+    """Range 探测结果"""
+
+    # 资源总大小，服务器未返回时为 None
+    size: int | None
+    # 是否支持 Range 请求
+    accept_ranges: bool = False
+    etag: str | None = None
+    last_modified: str | None = None
+    content_type: str | None = None
+
+
+async def _load_part_state(state_path: Path, url: str) -> _PartState | None:
+    """读取断点信息，url 不一致或文件损坏时返回 None"""
+    if not await aiofiles.os.path.exists(state_path):
+        return None
+    try:
+        async with aiofiles.open(state_path) as f:
+            state = _PartState(**json.loads(await f.read()))
+    except (OSError, ValueError, TypeError) as e:
+        logger.warning(f"读取断点信息 {state_path.name} 失败: {e}")
+        return None
+    return state if state.url == url else None
+
+
+async def _save_part_state(state_path: Path, state: _PartState) -> None:
+    """保存断点信息"""
+    async with aiofiles.open(state_path, "w") as f:
+        await f.write(json.dumps(asdict(state)))
+
+
+async def _download_file(
+    url: str,
+    file_path: Path,
+    *,
+    proxy: str | None = None,
+    ext_headers: dict[str, str] | None = None,
+    priority: Priority = Priority.VIDEO,
+) -> Path:
+    """下载文件，先写入 .part 文件，完成后重命名为目标文件，保证缓存中只存在完整文件
+
+    下载失败时保留 .part 文件和断点信息，重试和之后的请求会通过 Range 请求继续下载
+    """
+    tmp_path = file_path.with_name(f"{file_path.name}.part")
+    state_path = file_path.with_name(f"{file_path.name}.part.json")
     headers = {**COMMON_HEADER, **(ext_headers or {})}
 
+    state = await _load_part_state(state_path, url)
+    if state is None or not await aiofiles.os.path.exists(tmp_path):
+        state = _PartState(url=url)
+    elif state.written or state.done_parts:
+        logger.info(f"发现 {file_path.name} 的未完成下载，将继续下载")
+
+    session = get_session(proxy=proxy)
+    with download_telemetry.track(url, file_path.name) as record:
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            try:
+                # 探测资源大小以及是否支持分段下载
+                probe: RangeProbe | None = None
+                if _should_probe(state, priority):
+                    probe = await _try_probe_range(session, url, headers=headers, proxy=proxy, priority=priority)
+                    if probe and probe.size:
+                        check_size(probe.size, file_path.name)
+                        record.total = probe.size
+                if (
+                    probe
+                    and probe.accept_ranges
+                    and probe.size
+                    and DOWNLOAD_CONNECTIONS > 1
+                    and probe.size > DOWNLOAD_PART_SIZE * 1024 * 1024
+                ):
+                    # 资源发生变化或上次为顺序下载时，重新下载
+                    part_size = DOWNLOAD_PART_SIZE * 1024 * 1024
+                    if not state.done_parts or state.part_size != part_size or not state.match(probe):
+                        state = _PartState(
+                            url=url,
+                            etag=probe.etag,
+                            last_modified=probe.last_modified,
+                            size=probe.size,
+                            part_size=part_size,
+                            content_type=probe.content_type,
+                        )
+                    await _download_by_ranges(
+                        session,
+                        url,
+                        tmp_path,
+                        state,
+                        state_path,
+                        record,
+                        headers=headers,
+                        proxy=proxy,
+                        priority=priority,
+                    )
+                else:
+                    if state.done_parts:
+                        state = _PartState(url=url)
+                    await _download_by_single_stream(
+                        session, url, tmp_path, state, record, headers=headers, proxy=proxy, priority=priority
+                    )
+                break
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                # 断点位置无效，下次从头下载
+                if isinstance(e, aiohttp.ClientResponseError) and e.status == 416:
+                    state = _PartState(url=url)
+                await _save_part_state(state_path, state)
+                if attempt < DOWNLOAD_RETRIES and is_retryable(e):
+                    logger.warning(f"url: {url}, file_path: {file_path} 下载出错({e!r}), 第 {attempt + 1} 次重试")
+                    record.retries += 1
+                    await asyncio.sleep(attempt + 1)
+                    continue
+                # 保留 .part 文件，之后的请求将继续下载
+                if isinstance(e, asyncio.TimeoutError):
+                    logger.error(f"url: {url}, file_path: {file_path} 下载超时")
+                    raise DownloadException("资源下载超时")
+                logger.error(f"url: {url}, file_path: {file_path} 下载过程中出现异常{e}")
+                raise
+            except DownloadException:
+                await asyncio.gather(safe_unlink(tmp_path), safe_unlink(state_path))
+                raise
+            except BaseException:
+                await _save_part_state(state_path, state)
+                raise
+
+    # 原子重命名，其他调用者不会看到写了一半的文件
+    await asyncio.to_thread(tmp_path.replace, file_path)
+    await safe_unlink(state_path)
+    await cache_manager.add(
+        file_path, (await aiofiles.os.stat(file_path)).st_size, origin=url, content_type=state.content_type
+    )
+    return file_path
+
+
+def is_retryable(e: Exception) -> bool:
+    """客户端错误 (4xx) 重试无意义，超时、限流、服务端错误和连接中断可以重试"""
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500 or e.status in (408, 416, 429)
+    return True
+
+
+def check_size(size: int, file_name: str) -> None:
+    """检查资源大小是否超过限制
+
+    Raises:
+        DownloadSizeLimitException: 超过限制
+    """
+    if (file_size := size / 1024 / 1024) > MAX_SIZE:
+        logger.warning(f"下载 {file_name} 大小 {file_size:.2f} MB 超过 {MAX_SIZE} MB 限制, 取消下载")
+        raise DownloadSizeLimitException
+
+
+def _should_probe(state: _PartState, priority: Priority) -> bool:
+    """是否需要先探测资源大小，图片和已知较小的资源直接顺序下载，省去一次请求"""
+    if DOWNLOAD_CONNECTIONS <= 1 and not DOWNLOAD_PREFLIGHT:
+        return False
+    if priority == Priority.IMAGE:
+        return False
+    return state.size is None or state.size > DOWNLOAD_PART_SIZE * 1024 * 1024
+
+
+async def _try_probe_range(
+    session: aiohttp.ClientSession,
+    url: str,
+    *,
+    headers: dict[str, str],
+    proxy: str | None = None,
+    priority: Priority = Priority.VIDEO,
+) -> RangeProbe | None:
+    """探测资源，部分 CDN 拒绝 Range 请求 (403/405/416)，探测失败时返回 None，回退为顺序下载"""
     try:
-        session = await _get_session()
-        async with session.get(url, headers=headers, proxy=proxy) as resp:
+        probe = await probe_range(session, url, headers=headers, proxy=proxy, priority=priority)
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        logger.debug(f"探测 {url} 失败({e!r}), 使用顺序下载")
+        return None
+    # 服务器忽略 Range 时不做分段下载
+    return probe if probe.accept_ranges else None
+
+
+async def probe_range(
+    session: aiohttp.ClientSession,
+    url: str,
+    *,
+    headers: dict[str, str],
+    proxy: str | None = None,
+    priority: Priority = Priority.VIDEO,
+) -> RangeProbe:
+    """请求第一个字节，探测资源大小和是否支持 Range 请求
+
+    Returns:
+        RangeProbe: 资源大小和校验信息
+    """
+    async with (
+        download_scheduler.slot(url, priority),
+        session.get(url, headers={**headers, "Range": "bytes=0-0"}, proxy=proxy) as resp,
+    ):
+        resp.raise_for_status()
+        probe = RangeProbe(
+            size=None,
+            etag=resp.headers.get("ETag"),
+            last_modified=resp.headers.get("Last-Modified"),
+            content_type=resp.headers.get("Content-Type"),
+        )
+        # Content-Range: bytes 0-0/12345
+        if resp.status == 206 and (matched := re.fullmatch(r"bytes 0-0/(\d+)", resp.headers.get("Content-Range", ""))):
+            probe.size = int(matched.group(1))
+            probe.accept_ranges = True
+        # 服务器忽略 Range 时返回完整内容，只读取响应头
+        elif resp.status == 200 and (content_length := resp.headers.get("Content-Length")):
+            probe.size = int(content_length)
+        return probe
+
+
+async def _download_by_single_stream(
+    session: aiohttp.ClientSession,
+    url: str,
+    file_path: Path,
+    state: _PartState,
+    record: DownloadRecord,
+    *,
+    headers: dict[str, str],
+    proxy: str | None = None,
+    priority: Priority = Priority.VIDEO,
+) -> None:
+    """单连接顺序下载，存在已下载的部分时通过 Range 请求继续下载"""
+    max_bytes = MAX_SIZE * 1024 * 1024
+    offset = 0
+    if state.written and await aiofiles.os.path.exists(file_path):
+        offset = min(state.written, (await aiofiles.os.stat(file_path)).st_size)
+    if offset:
+        headers = {**headers, "Range": f"bytes={offset}-"}
+        if if_range := state.if_range:
+            headers["If-Range"] = if_range
+
+    async with download_scheduler.slot(url, priority), session.get(url, headers=headers, proxy=proxy) as resp:
+        resp.raise_for_status()
+        # 服务器不支持 Range 或资源已变化，重新下载
+        if offset and (resp.status != 206 or not resp.headers.get("Content-Range", "").startswith(f"bytes {offset}-")):
+            logger.info(f"{file_path.stem} 无法继续下载，重新下载")
+            offset = 0
+        state.written = offset
+        state.etag = resp.headers.get("ETag", state.etag)
+        state.last_modified = resp.headers.get("Last-Modified", state.last_modified)
+        state.content_type = resp.headers.get("Content-Type", state.content_type)
+        # 获取文件大小
+        content_length = resp.headers.get("Content-Length")
+        content_length = int(content_length) + offset if content_length else None
+        if content_length:
+            check_size(content_length, file_path.stem)
+            state.size = content_length
+        record.total = content_length
+        record.resumed_bytes = offset
+        async with aiofiles.open(file_path, "r+b" if offset else "wb") as file:
+            if offset:
+                await file.truncate(offset)
+                await file.seek(offset)
+            async for chunk in resp.content.iter_chunked(1024 * 1024):
+                # 未返回 Content-Length 时，边下载边检查大小
+                if state.written + len(chunk) > max_bytes:
+                    check_size(state.written + len(chunk), file_path.stem)
+                await file.write(chunk)
+                state.written += len(chunk)
+                record.update(len(chunk))
+
+
+async def _download_by_ranges(
+    session: aiohttp.ClientSession,
+    url: str,
+    file_path: Path,
+    state: _PartState,
+    state_path: Path,
+    record: DownloadRecord,
+    *,
+    headers: dict[str, str],
+    proxy: str | None = None,
+    priority: Priority = Priority.VIDEO,
+) -> None:
+    """多连接分段下载，各分片并发写入预分配文件的对应位置，跳过已完成的分片"""
+    assert state.size is not None
+    total_size, part_size = state.size, state.part_size
+    ranges = [
+        (start, min(start + part_size, total_size) - 1)
+        for start in range(0, total_size, part_size)
+        if start not in state.done_parts
+    ]
+    # 预分配文件
+    if not state.done_parts or not await aiofiles.os.path.exists(file_path):
+        state.done_parts.clear()
+        async with aiofiles.open(file_path, "wb") as file:
+            await file.truncate(total_size)
+
+    semaphore = asyncio.Semaphore(DOWNLOAD_CONNECTIONS)
+    state_lock = asyncio.Lock()
+    range_headers = {**headers}
+    if if_range := state.if_range:
+        range_headers["If-Range"] = if_range
+
+    async def fetch_range(start: int, end: int) -> None:
+        part_headers = {**range_headers, "Range": f"bytes={start}-{end}"}
+        async with (
+            semaphore,
+            download_scheduler.slot(url, priority),
+            session.get(url, headers=part_headers, proxy=proxy) as resp,
+        ):
             resp.raise_for_status()
-            # 获取文件大小
-            content_length = resp.headers.get("Content-Length")
-            content_length = int(content_length) if content_length else None
-            if content_length and (file_size := content_length / 1024 / 1024) > MAX_SIZE:
-                logger.warning(f"预下载 {file_name} 大小 {file_size:.2f} MB 超过 {MAX_SIZE} MB 限制, 取消下载")
-                raise DownloadException("音视频流大小超过配置限制，取消下载")
-            with tqdm(
-                total=content_length,  # 为 None 时，无进度条
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-                dynamic_ncols=True,
-                colour="green",
-                desc=file_name,
-            ) as bar:
-                async with aiofiles.open(file_path, "wb") as file:
-                    async for chunk in resp.content.iter_chunked(1024 * 1024):
-                        await file.write(chunk)
-                        bar.update(len(chunk))
-    except asyncio.TimeoutError:
-        await safe_unlink(file_path)
-        logger.error(f"url: {url}, file_path: {file_path} 下载超时")
-        raise DownloadException("资源下载超时")
-    except aiohttp.ClientError as e:
-        await safe_unlink(file_path)
-        logger.error(f"url: {url}, file_path: {file_path} 下载过程中出现异常{e}")
+            if resp.status != 206:
+                raise DownloadException("服务器未返回分段数据，分段下载失败")
+            async with aiofiles.open(file_path, "r+b") as file:
+                await file.seek(start)
+                async for chunk in resp.content.iter_chunked(1024 * 1024):
+                    await file.write(chunk)
+                    record.update(len(chunk))
+        async with state_lock:
+            state.done_parts.append(start)
+            await _save_part_state(state_path, state)
+
+    record.total = total_size
+    record.resumed_bytes = len(state.done_parts) * part_size
+    tasks = [asyncio.create_task(fetch_range(start, end)) for start, end in ranges]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # 任一分片失败时，取消其余分片
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
         raise
 
-    return file_path
-
 
 async def download_video(
     url: str,
@@ -141,7 +492,9 @@ async def download_audio(
     """
     if audio_name is None:
         audio_name = generate_file_name(url, ".mp3")
-    return await download_file_by_stream(url, file_name=audio_name, proxy=proxy, ext_headers=ext_headers)
+    return await download_file_by_stream(
+        url, file_name=audio_name, proxy=proxy, ext_headers=ext_headers, priority=Priority.AUDIO
+    )
 
 
 async def download_img(
@@ -168,7 +521,9 @@ async def download_img(
     """
     if img_name is None:
         img_name = generate_file_name(url, ".jpg")
-    return await download_file_by_stream(url, file_name=img_name, proxy=proxy, ext_headers=ext_headers)
+    return await download_file_by_stream(
+        url, file_name=img_name, proxy=proxy, ext_headers=ext_headers, priority=Priority.IMAGE
+    )
 
 
 async def download_imgs_without_raise(urls: list[str], ext_headers: dict[str, str] | None = None) -> list[Path]:
@@ -210,11 +565,168 @@ async def merge_av(*, v_path: Path, a_path: Path, output_path: Path) -> None:
         "0:v:0",
         "-map",
         "1:a:0",
-        str(output_path),
+        "-movflags",
+        "+faststart",
     ]
 
-    await exec_ffmpeg_cmd(cmd)
-    await asyncio.gather(safe_unlink(v_path), safe_unlink(a_path))
+    async with atomic_output(output_path) as tmp_path:
+        await exec_ffmpeg_cmd([*cmd, str(tmp_path)])
+    await cache_manager.add(output_path)
+    await asyncio.gather(cache_manager.discard(v_path), cache_manager.discard(a_path))
+
+
+async def merge_av_stream(
+    *,
+    v_url: str,
+    a_url: str,
+    output_path: Path,
+    proxy: str | None = None,
+    ext_headers: dict[str, str] | None = None,
+) -> None:
+    """边下载边合并视频和音频，两个流通过管道直接输入 ffmpeg，不写入临时文件，不支持 Windows
+
+    同一输出路径的并发调用共享同一个合并任务
+
+    Args:
+        v_url (str): 视频流地址
+        a_url (str): 音频流地址
+        output_path (Path): 输出文件路径
+        proxy (str | None, optional): proxy url. Defaults to None.
+        ext_headers (dict[str, str] | None, optional): ext headers. Defaults to None.
+
+    Raises:
+        DownloadSizeLimitException: 音视频流大小超过限制
+        aiohttp.ClientError: When download fails
+        asyncio.TimeoutError: When download times out
+        RuntimeError: ffmpeg 执行失败
+    """
+    cache_manager.hold(output_path)
+    await _single_flight(
+        output_path,
+        lambda: _merge_av_stream(v_url, a_url, output_path, proxy=proxy, ext_headers=ext_headers),
+    )
+
+
+async def _merge_av_stream(
+    v_url: str,
+    a_url: str,
+    output_path: Path,
+    *,
+    proxy: str | None = None,
+    ext_headers: dict[str, str] | None = None,
+) -> Path:
+    logger.info(f"Streaming and merging {output_path.name}")
+    # ffmpeg 确认输出完整后再重命名，保证缓存中只存在完整文件
+    tmp_path = output_path.with_name(f"{output_path.name}.part")
+    headers = {**COMMON_HEADER, **(ext_headers or {})}
+    session = get_session(proxy=proxy)
+    max_bytes = MAX_SIZE * 1024 * 1024
+    expected_size = received_size = 0
+
+    # 整个合并只占用一个下载名额：ffmpeg 先读完视频管道才读音频管道，
+    # 两个流各自占用名额时，音频流可能一直等不到视频流释放的名额；
+    # 也不额外占用音频 host 的名额，持有一个名额再等待另一个，全局名额用尽时多个合并会互相等待，
+    # 音频流通常与视频流同 host 且远小于视频流
+    # 只复制流，占用 IO 型任务名额
+    async with download_scheduler.slot(v_url), ffmpeg_pool.slot(heavy=False):
+        v_read, v_write = os.pipe()
+        a_read, a_write = os.pipe()
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-i",
+            f"pipe:{v_read}",
+            "-i",
+            f"pipe:{a_read}",
+            "-c",
+            "copy",
+            "-map",
+            "0:v:0",
+            "-map",
+            "1:a:0",
+            "-movflags",
+            "+faststart",
+            "-f",
+            "mp4",
+            str(tmp_path),
+        ]
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+                pass_fds=(v_read, a_read),
+            )
+        except FileNotFoundError:
+            os.close(v_write)
+            os.close(a_write)
+            raise RuntimeError("ffmpeg 未安装或无法找到可执行文件")
+        finally:
+            # 读端已交给 ffmpeg
+            os.close(v_read)
+            os.close(a_read)
+
+        async def feed(url: str, fd: int, name: str) -> None:
+            nonlocal expected_size, received_size
+            try:
+                with download_telemetry.track(url, name) as record:
+                    async with session.get(url, headers=headers, proxy=proxy) as resp:
+                        resp.raise_for_status()
+                        if resp.content_length:
+                            record.total = resp.content_length
+                            expected_size += resp.content_length
+                            check_size(expected_size, output_path.name)
+                        async for chunk in resp.content.iter_chunked(1024 * 1024):
+                            received_size += len(chunk)
+                            if received_size > max_bytes:
+                                check_size(received_size, output_path.name)
+                            # 管道写满时阻塞，在线程中写入
+                            await asyncio.to_thread(_write_all, fd, chunk)
+                            record.update(len(chunk))
+            finally:
+                # 关闭写端，ffmpeg 读到 EOF
+                os.close(fd)
+
+        assert process.stderr
+        stderr_task = asyncio.create_task(process.stderr.read())
+        tasks = [
+            asyncio.create_task(feed(v_url, v_write, f"{output_path.stem}-video.m4s")),
+            asyncio.create_task(feed(a_url, a_write, f"{output_path.stem}-audio.m4s")),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+            await process.wait()
+        except BaseException as e:
+            # 先结束 ffmpeg，阻塞在管道写入上的线程随之退出
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await safe_unlink(tmp_path)
+            if isinstance(e, BrokenPipeError):
+                # ffmpeg 提前退出
+                raise RuntimeError(f"ffmpeg 执行失败: {(await stderr_task).decode().strip()}") from e
+            stderr_task.cancel()
+            raise
+
+        if process.returncode != 0:
+            await safe_unlink(tmp_path)
+            raise RuntimeError(f"ffmpeg 执行失败: {(await stderr_task).decode().strip()}")
+        await asyncio.to_thread(tmp_path.replace, output_path)
+    await cache_manager.add(output_path, origin=v_url, content_type="video/mp4")
+    return output_path
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    """向管道写入全部数据"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
 
 
 async def merge_av_h264(*, v_path: Path, a_path: Path, output_path: Path) -> None:
@@ -249,11 +761,14 @@ async def merge_av_h264(*, v_path: Path, a_path: Path, output_path: Path) -> Non
         "0:v:0",
         "-map",
         "1:a:0",
-        str(output_path),
+        "-movflags",
+        "+faststart",
     ]
 
-    await exec_ffmpeg_cmd(cmd)
-    await asyncio.gather(safe_unlink(v_path), safe_unlink(a_path))
+    async with atomic_output(output_path) as tmp_path:
+        await exec_ffmpeg_cmd([*cmd, str(tmp_path)])
+    await cache_manager.add(output_path)
+    await asyncio.gather(cache_manager.discard(v_path), cache_manager.discard(a_path))
 
 
 async def encode_video_to_h264(video_path: Path) -> Path:
@@ -266,7 +781,8 @@ async def encode_video_to_h264(video_path: Path) -> Path:
         Path: 编码后的视频路径
     """
     output_path = video_path.with_name(f"{video_path.stem}_h264{video_path.suffix}")
-    if output_path.exists():
+    cache_manager.hold(output_path)
+    if await cache_manager.lookup(output_path):
         return output_path
     cmd = [
         "ffmpeg",
@@ -279,9 +795,186 @@ async def encode_video_to_h264(video_path: Path) -> Path:
         "medium",
         "-crf",
         "23",
-        str(output_path),
+        "-movflags",
+        "+faststart",
+    ]
+    async with atomic_output(output_path) as tmp_path:
+        await exec_ffmpeg_cmd([*cmd, str(tmp_path)])
+    size = (await aiofiles.os.stat(output_path)).st_size
+    await cache_manager.add(output_path, size, content_type="video/mp4")
+    logger.success(f"视频重新编码为 H.264 成功: {output_path}, 大小: {size / 1024 / 1024:.2f}MB")
+    await cache_manager.discard(video_path)
+    return output_path
+
+
+async def remux_faststart(video_path: Path) -> Path:
+    """不重新编码，重新封装为 moov 在文件头部的 mp4
+
+    Args:
+        video_path (Path): 视频路径
+
+    Returns:
+        Path: 重新封装后的视频路径
+    """
+    output_path = video_path.with_name(f"{video_path.stem}_faststart.mp4")
+    cache_manager.hold(output_path)
+    if await cache_manager.lookup(output_path):
+        return output_path
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-i",
+        str(video_path),
+        "-map",
+        "0",
+        "-c",
+        "copy",
+        "-movflags",
+        "+faststart",
+    ]
+    async with atomic_output(output_path) as tmp_path:
+        await exec_ffmpeg_cmd([*cmd, str(tmp_path)])
+    await cache_manager.add(output_path, content_type="video/mp4")
+    return output_path
+
+
+async def extract_thumbnail(video_path: Path) -> Path:
+    """提取视频首帧作为 JPEG 缩略图
+
+    Args:
+        video_path (Path): 视频路径
+
+    Returns:
+        Path: 缩略图路径
+    """
+    output_path = video_path.with_name(f"{video_path.stem}_thumb.jpg")
+    cache_manager.hold(output_path)
+    if await cache_manager.lookup(output_path):
+        return output_path
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-i",
+        str(video_path),
+        "-frames:v",
+        "1",
+        "-vf",
+        "scale='min(640,iw)':-2",
+        "-q:v",
+        "4",
     ]
-    await exec_ffmpeg_cmd(cmd)
-    logger.success(f"视频重新编码为 H.264 成功: {output_path}, 大小: {output_path.stat().st_size / 1024 / 1024:.2f}MB")
-    await safe_unlink(video_path)
+    # 只解码一帧，不占用编码任务名额
+    async with atomic_output(output_path) as tmp_path:
+        await ffmpeg_pool.run([*cmd, str(tmp_path)], heavy=False)
+    await cache_manager.add(output_path, content_type="image/jpeg")
+    return output_path
+
+
+async def repair_video(video_path: Path) -> tuple[Path, Path | None]:
+    """修复无法上传的视频，只重新封装，不重新编码
+
+    检查文件中的视频流，将 moov 移到文件头部，并提取首帧作为缩略图
+
+    Args:
+        video_path (Path): 视频路径
+
+    Returns:
+        tuple[Path, Path | None]: 重新封装后的视频路径和缩略图路径，缩略图提取失败时为 None
+
+    Raises:
+        RuntimeError: 没有视频流或重新封装失败
+    """
+    info = await ffprobe(video_path)
+    video_streams = [stream for stream in info.get("streams", []) if stream.get("codec_type") == "video"]
+    if not video_streams:
+        raise RuntimeError(f"{video_path.name} 中没有视频流")
+    logger.info(
+        f"{video_path.name} 视频编码 {video_streams[0].get('codec_name')}, "
+        f"封装格式 {info.get('format', {}).get('format_name')}, 重新封装并生成缩略图"
+    )
+    fixed_path, thumb_path = await asyncio.gather(
+        remux_faststart(video_path), extract_thumbnail(video_path), return_exceptions=True
+    )
+    if isinstance(fixed_path, BaseException):
+        raise fixed_path
+    if isinstance(thumb_path, BaseException):
+        logger.warning(f"{video_path.name} 缩略图提取失败: {thumb_path}")
+        thumb_path = None
+    return fixed_path, thumb_path
+
+
+async def fit_video_to_size(video_path: Path, max_bytes: int) -> Path:
+    """按大小限制压缩视频，根据时长计算码率，重新编码为 h264
+
+    结果缓存在原视频旁的 {stem}_fit.mp4，再次分享时直接使用
+
+    Args:
+        video_path (Path): 视频路径
+        max_bytes (int): 大小限制，单位字节
+
+    Returns:
+        Path: 压缩后的视频路径
+
+    Raises:
+        RuntimeError: 视频过长无法压缩到限制以内，或 ffmpeg 执行失败
+    """
+    output_path = video_path.with_name(f"{video_path.stem}_fit.mp4")
+    cache_manager.hold(output_path)
+    if await cache_manager.lookup(output_path):
+        return output_path
+
+    info = await ffprobe(video_path)
+    duration = float(info.get("format", {}).get("duration") or 0)
+    if duration <= 0:
+        raise RuntimeError(f"无法获取 {video_path.name} 的时长")
+    # 预留 5% 给封装开销，单位 kbps
+    audio_bitrate = 96
+    video_bitrate = int(max_bytes * 8 * 0.95 / duration / 1000) - audio_bitrate
+    if video_bitrate < 150:
+        raise RuntimeError(f"{video_path.name} 时长 {duration:.0f}s, 无法压缩到 {max_bytes / 1024 / 1024:.0f} MB 以内")
+
+    # 压缩结果确认不超过限制后才重命名，失败时删除临时文件
+    async with atomic_output(output_path) as tmp_path:
+        for _ in range(2):
+            # 码率较低时降低分辨率，保证画质
+            height = next(
+                h for bitrate, h in ((2500, 1080), (1200, 720), (600, 480), (0, 360)) if video_bitrate >= bitrate
+            )
+            logger.info(f"压缩 {video_path.name}: 时长 {duration:.0f}s, 视频码率 {video_bitrate}kbps, 最高 {height}p")
+            cmd = [
+                "ffmpeg",
+                "-y",
+                "-i",
+                str(video_path),
+                "-vf",
+                f"scale=-2:'min({height},ih)'",
+                "-c:v",
+                "libx264",
+                "-preset",
+                "veryfast",
+                "-b:v",
+                f"{video_bitrate}k",
+                "-maxrate",
+                f"{video_bitrate}k",
+                "-bufsize",
+                f"{video_bitrate * 2}k",
+                "-c:a",
+                "aac",
+                "-b:a",
+                f"{audio_bitrate}k",
+                "-movflags",
+                "+faststart",
+                str(tmp_path),
+            ]
+            await exec_ffmpeg_cmd(cmd)
+            size = (await aiofiles.os.stat(tmp_path)).st_size
+            if size <= max_bytes:
+                break
+            # 码率控制存在误差，按超出比例降低码率后重试一次
+            video_bitrate = int(video_bitrate * max_bytes / size * 0.95)
+        else:
+            raise RuntimeError(f"{video_path.name} 压缩后仍超过 {max_bytes / 1024 / 1024:.0f} MB")
+
+    await cache_manager.add(output_path, size, content_type="video/mp4")
+    logger.success(f"视频压缩成功: {output_path.name}, 大小: {size / 1024 / 1024:.2f}MB")
     return output_path
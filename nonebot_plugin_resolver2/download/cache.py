@@ -0,0 +1,354 @@
+import asyncio
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import astuple, dataclass, field, fields
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Any
+
+import aiofiles.os
+from nonebot import logger
+from nonebot.internal.matcher import current_matcher
+
+from ..config import CACHE_MAX_SIZE, plugin_cache_dir, plugin_data_dir
+from .utils import safe_unlink
+
+# matcher state 中记录当前 handler 占用的缓存文件
+_HELD_KEY = "_r_cache_held"
+# 写入中的临时文件的扩展名，包括下载器的 .part、.part.json，以及 yt-dlp 的 .part-Frag1、.temp.mp4、.ytdl
+_PARTIAL_SUFFIXES = (".part", ".temp", ".ytdl")
+
+
+def is_partial(name: str) -> bool:
+    """是否为写入中的临时文件，临时文件可能不完整，不会被登记到索引"""
+    return any(suffix.startswith(_PARTIAL_SUFFIXES) for suffix in Path(name).suffixes)
+
+
+@dataclass
+class CacheEntry:
+    """缓存文件信息"""
+
+    name: str
+    size: int
+    last_access: float
+    created_at: float = field(default_factory=time.time)
+    hits: int = 0
+    # 来源 url
+    origin: str | None = None
+    content_type: str | None = None
+    # 平台内容 id，如 bilibili:BV1xx411c7mD-1
+    content_id: str | None = None
+
+
+class CacheIndex:
+    """基于 SQLite 的缓存索引，所有操作在线程中执行"""
+
+    _COLUMNS = tuple(f.name for f in fields(CacheEntry))
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS cache_files (
+                    name TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    origin TEXT,
+                    content_type TEXT,
+                    content_id TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_cache_files_content_id ON cache_files (content_id);
+                """
+            )
+        return self._conn
+
+    def load(self) -> list[CacheEntry]:
+        """读取全部索引"""
+        with self._lock:
+            rows = self._connect().execute(f"SELECT {', '.join(self._COLUMNS)} FROM cache_files").fetchall()
+        return [CacheEntry(*row) for row in rows]
+
+    def write(self, upserts: list[CacheEntry], deletes: list[str]) -> None:
+        """批量写入和删除"""
+        placeholders = ", ".join("?" * len(self._COLUMNS))
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO cache_files ({', '.join(self._COLUMNS)}) VALUES ({placeholders})",
+                [astuple(entry) for entry in upserts],
+            )
+            conn.executemany("DELETE FROM cache_files WHERE name = ?", [(name,) for name in deletes])
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class CacheManager:
+    """缓存管理
+
+    缓存文件的大小、来源、访问时间和命中次数记录在 SQLite 索引中，内存中保留一份副本供查询，
+    修改先写入内存，再批量写回索引。
+    按最近访问时间淘汰缓存文件，使缓存目录大小不超过配额。
+    正在下载或被 handler 使用的文件通过引用计数固定，不会被淘汰；
+    最近访问过的文件在 min_age 秒内也不会被淘汰，给上传留出时间
+    """
+
+    def __init__(self, cache_dir: Path, max_size: int, db_path: Path, min_age: float = 600):
+        """
+        Args:
+            cache_dir (Path): 缓存目录
+            max_size (int): 缓存配额，单位字节
+            db_path (Path): 索引数据库路径
+            min_age (float, optional): 最近访问的文件不会被淘汰的时间，单位秒. Defaults to 600.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.min_age = min_age
+        self._index = CacheIndex(db_path)
+        self._entries: dict[str, CacheEntry] = {}
+        # 待写回索引的修改
+        self._dirty: set[str] = set()
+        self._removed: set[str] = set()
+        self._pins: Counter[str] = Counter()
+        self._lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._evict_task: asyncio.Task[int] | None = None
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def total_size(self) -> int:
+        """缓存总大小"""
+        return sum(entry.size for entry in self._entries.values())
+
+    @staticmethod
+    def _pin_key(name: str) -> str:
+        """下载中的 .part 文件和目标文件共用同一个引用计数"""
+        return name.removesuffix(".json").removesuffix(".part")
+
+    def _set(self, entry: CacheEntry) -> None:
+        self._entries[entry.name] = entry
+        self._dirty.add(entry.name)
+        self._removed.discard(entry.name)
+
+    def _remove(self, name: str) -> None:
+        self._entries.pop(name, None)
+        self._dirty.discard(name)
+        self._removed.add(name)
+
+    async def lookup(self, path: Path) -> bool:
+        """查询缓存文件是否存在并记录命中
+
+        索引可能落后于文件系统，命中时检查文件是否仍然存在，已被删除的文件从索引中移除；
+        索引中没有的文件只有不是临时文件时才登记，临时文件由原子重命名产生最终文件
+        """
+        try:
+            stat = await aiofiles.os.stat(path)
+        except FileNotFoundError:
+            if path.name in self._entries:
+                self._remove(path.name)
+            self._misses += 1
+            return False
+        if entry := self._entries.get(path.name):
+            entry.hits += 1
+            entry.last_access = time.time()
+            entry.size = stat.st_size
+            self._dirty.add(path.name)
+        elif is_partial(path.name):
+            self._misses += 1
+            return False
+        else:
+            # 未经下载器产生的文件，如 yt-dlp 的输出，登记到索引
+            await self.add(path, stat.st_size)
+        self._hits += 1
+        return True
+
+    def find(self, content_id: str) -> Path | None:
+        """根据内容 id 查找缓存文件"""
+        for entry in self._entries.values():
+            if entry.content_id == content_id:
+                self.touch(self.cache_dir / entry.name)
+                return self.cache_dir / entry.name
+        return None
+
+    def touch(self, path: Path) -> None:
+        """记录一次访问"""
+        if entry := self._entries.get(path.name):
+            entry.last_access = time.time()
+            self._dirty.add(path.name)
+
+    async def add(
+        self,
+        path: Path,
+        size: int | None = None,
+        *,
+        origin: str | None = None,
+        content_type: str | None = None,
+        content_id: str | None = None,
+    ) -> None:
+        """登记新增的缓存文件，超出配额时在后台淘汰"""
+        if size is None:
+            size = (await aiofiles.os.stat(path)).st_size
+        now = time.time()
+        self._set(
+            CacheEntry(
+                name=path.name,
+                size=size,
+                last_access=now,
+                created_at=now,
+                origin=origin,
+                content_type=content_type,
+                content_id=content_id,
+            )
+        )
+        if self._evict_task is None or self._evict_task.done():
+            self._evict_task = asyncio.create_task(self.evict())
+
+    async def discard(self, path: Path) -> None:
+        """删除缓存文件并从索引中移除"""
+        await safe_unlink(path)
+        self._remove(path.name)
+
+    def pin(self, path: Path) -> None:
+        """固定文件，引用计数归零前不会被淘汰"""
+        self._pins[self._pin_key(path.name)] += 1
+
+    def unpin(self, path: Path) -> None:
+        """释放固定"""
+        key = self._pin_key(path.name)
+        self._pins[key] -= 1
+        if self._pins[key] <= 0:
+            del self._pins[key]
+        self.touch(path)
+
+    def is_pinned(self, path: Path) -> bool:
+        return self._pins[self._pin_key(path.name)] > 0
+
+    @contextmanager
+    def pinned(self, *paths: Path) -> Iterator[None]:
+        """在上下文中固定文件"""
+        for path in paths:
+            self.pin(path)
+        try:
+            yield
+        finally:
+            for path in paths:
+                self.unpin(path)
+
+    def hold(self, path: Path) -> None:
+        """在当前 handler 结束前固定文件，不在 handler 中调用时只记录访问"""
+        self.touch(path)
+        matcher = current_matcher.get(None)
+        if matcher is None:
+            return
+        held: set[Path] = matcher.state.setdefault(_HELD_KEY, set())
+        if path not in held:
+            held.add(path)
+            self.pin(path)
+
+    def release_held(self, state: dict) -> None:
+        """释放 handler 固定的文件"""
+        for path in state.pop(_HELD_KEY, ()):
+            self.unpin(path)
+
+    def _scan(self) -> dict[str, tuple[int, float]]:
+        files: dict[str, tuple[int, float]] = {}
+        for file in self.cache_dir.iterdir():
+            if file.is_file() and not is_partial(file.name):
+                stat = file.stat()
+                files[file.name] = (stat.st_size, max(stat.st_atime, stat.st_mtime))
+        return files
+
+    async def load(self) -> None:
+        """读取索引，并根据缓存目录重建"""
+        entries = await asyncio.to_thread(self._index.load)
+        self._entries = {entry.name: entry for entry in entries}
+        await self.sync()
+        logger.info(f"缓存索引加载完成, 共 {len(self._entries)} 个文件, {self.total_size / 1024 / 1024:.2f} MB")
+
+    async def sync(self) -> None:
+        """与缓存目录同步，登记未经下载器产生的文件（合并、转码、yt-dlp 等），移除已不存在的文件"""
+        files = await asyncio.to_thread(self._scan)
+        for name in self._entries.keys() - files.keys():
+            self._remove(name)
+        for name, (size, last_access) in files.items():
+            if entry := self._entries.get(name):
+                if entry.size != size:
+                    entry.size = size
+                    self._dirty.add(name)
+            else:
+                self._set(CacheEntry(name=name, size=size, last_access=last_access, created_at=last_access))
+        await self.flush()
+
+    async def flush(self) -> None:
+        """将修改写回索引"""
+        async with self._flush_lock:
+            if not self._dirty and not self._removed:
+                return
+            upserts = [self._entries[name] for name in self._dirty if name in self._entries]
+            deletes = list(self._removed)
+            self._dirty.clear()
+            self._removed.clear()
+            await asyncio.to_thread(self._index.write, upserts, deletes)
+
+    async def evict(self) -> int:
+        """按最近访问时间淘汰文件，直到缓存大小不超过配额
+
+        Returns:
+            int: 淘汰的文件数
+        """
+        async with self._lock:
+            total_size = self.total_size
+            evicted = 0
+            if total_size > self.max_size:
+                deadline = time.time() - self.min_age
+                for name, entry in sorted(self._entries.items(), key=lambda item: item[1].last_access):
+                    if total_size <= self.max_size:
+                        break
+                    path = self.cache_dir / name
+                    if entry.last_access > deadline or self.is_pinned(path):
+                        continue
+                    await safe_unlink(path)
+                    self._remove(name)
+                    total_size -= entry.size
+                    evicted += 1
+                logger.info(f"缓存淘汰 {evicted} 个文件, 当前缓存大小 {total_size / 1024 / 1024:.2f} MB")
+            await self.flush()
+            return evicted
+
+    def stats(self) -> dict[str, Any]:
+        """缓存统计信息"""
+        lookups = self._hits + self._misses
+        hottest = sorted(self._entries.values(), key=lambda entry: entry.hits, reverse=True)[:5]
+        return {
+            "files": len(self._entries),
+            "total_size": self.total_size,
+            "max_size": self.max_size,
+            "pinned": len(self._pins),
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": self._hits / lookups if lookups else 0.0,
+            "hottest": [(entry.name, entry.hits) for entry in hottest],
+        }
+
+    async def close(self) -> None:
+        """写回修改并关闭索引"""
+        await self.flush()
+        await asyncio.to_thread(self._index.close)
+
+
+# 全局缓存管理
+cache_manager = CacheManager(plugin_cache_dir, CACHE_MAX_SIZE * 1024 * 1024, plugin_data_dir / "cache_index.db")
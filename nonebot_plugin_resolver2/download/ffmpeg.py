@@ -0,0 +1,226 @@
+import asyncio
+from collections import deque
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+import json
+import os
+from pathlib import Path
+import time
+from typing import Any
+
+from nonebot import logger
+
+from ..config import FFMPEG_TIMEOUT, FFMPEG_WORKERS
+
+# 进度日志的最小间隔，单位秒
+_LOG_INTERVAL = 10.0
+# 失败时保留的 stderr 行数
+_STDERR_TAIL = 20
+
+
+def _is_codec_option(arg: str) -> bool:
+    return arg in ("-c", "-codec", "-vcodec", "-acodec") or arg.startswith(("-c:", "-codec:"))
+
+
+def _is_heavy(cmd: list[str]) -> bool:
+    """是否为编码任务，只复制流的合并、封装任务不占用 CPU"""
+    codecs = [cmd[i + 1] for i, arg in enumerate(cmd[:-1]) if _is_codec_option(arg)]
+    # 未指定编码器时 ffmpeg 默认重新编码
+    return not codecs or any(codec != "copy" for codec in codecs)
+
+
+class FFmpegPool:
+    """ffmpeg 任务池
+
+    编码任务会占满所有核心，并发数按 CPU 核数限制；只复制流的任务以 IO 为主，允许更高的并发。
+    每个任务有运行时间限制，超时后结束进程；通过 -progress 输出跟踪进度，stderr 只保留末尾若干行
+    """
+
+    def __init__(self, max_workers: int, timeout: float):
+        """
+        Args:
+            max_workers (int): 编码任务最大并发数，为 0 时根据 CPU 核数决定
+            timeout (float): 单个任务的最长运行时间，单位秒
+        """
+        if max_workers <= 0:
+            max_workers = max(1, (os.cpu_count() or 2) // 2)
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._heavy = asyncio.Semaphore(max_workers)
+        self._light = asyncio.Semaphore(max_workers * 4)
+        # 统计信息
+        self._queued = {"heavy": 0, "light": 0}
+        self._running = {"heavy": 0, "light": 0}
+        self._jobs = 0
+        self._completed = 0
+        self._failed = 0
+        self._timed_out = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._total_run = 0.0
+        self._max_run = 0.0
+
+    @asynccontextmanager
+    async def slot(self, heavy: bool = True) -> AsyncIterator[None]:
+        """获取一个任务名额，退出时释放，用于自行启动 ffmpeg 的场景
+
+        Args:
+            heavy (bool, optional): 是否为编码任务. Defaults to True.
+        """
+        kind = "heavy" if heavy else "light"
+        semaphore = self._heavy if heavy else self._light
+        enqueued_at = time.monotonic()
+        self._queued[kind] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self._queued[kind] -= 1
+        wait = time.monotonic() - enqueued_at
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        if wait > 1:
+            logger.debug(f"ffmpeg 任务排队 {wait:.2f}s, 当前队列: {self._queued}")
+
+        self._running[kind] += 1
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            run = time.monotonic() - started_at
+            self._jobs += 1
+            self._total_run += run
+            self._max_run = max(self._max_run, run)
+            self._running[kind] -= 1
+            semaphore.release()
+
+    async def run(self, cmd: list[str], *, timeout: float | None = None, heavy: bool | None = None) -> None:
+        """执行 ffmpeg 命令
+
+        Args:
+            cmd (list[str]): ffmpeg 命令，最后一个参数为输出文件
+            timeout (float | None, optional): 最长运行时间，单位秒. Defaults to pool timeout.
+            heavy (bool | None, optional): 是否为编码任务. Defaults to 根据命令判断.
+
+        Raises:
+            RuntimeError: ffmpeg 未安装、执行失败或超时
+        """
+        if heavy is None:
+            heavy = _is_heavy(cmd)
+        timeout = timeout or self.timeout
+        name = Path(cmd[-1]).name
+        cmd = [cmd[0], "-nostats", "-progress", "pipe:1", *cmd[1:]]
+
+        async with self.slot(heavy):
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+            except FileNotFoundError:
+                self._failed += 1
+                raise RuntimeError("ffmpeg 未安装或无法找到可执行文件")
+
+            assert process.stdout
+            assert process.stderr
+            stderr_tail: deque[str] = deque(maxlen=_STDERR_TAIL)
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(
+                        self._read_progress(process.stdout, name),
+                        self._read_stderr(process.stderr, stderr_tail),
+                        process.wait(),
+                    ),
+                    timeout,
+                )
+            except asyncio.TimeoutError:
+                self._timed_out += 1
+                self._failed += 1
+                raise RuntimeError(f"ffmpeg 处理 {name} 超时({timeout:.0f}s)")
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
+        if process.returncode != 0:
+            self._failed += 1
+            error_msg = "\n".join(stderr_tail)
+            raise RuntimeError(f"ffmpeg 执行失败: {error_msg}")
+        self._completed += 1
+
+    @staticmethod
+    async def _read_progress(stream: asyncio.StreamReader, name: str) -> None:
+        """解析 -progress 输出的 key=value 行，按间隔输出进度日志"""
+        progress: dict[str, str] = {}
+        last_log = time.monotonic()
+        async for line in stream:
+            key, _, value = line.decode(errors="ignore").strip().partition("=")
+            progress[key] = value
+            # 每组进度以 progress=continue/end 结尾
+            if key != "progress" or (now := time.monotonic()) - last_log < _LOG_INTERVAL:
+                continue
+            last_log = now
+            out_time_us = progress.get("out_time_us", "")
+            out_time = int(out_time_us) / 1_000_000 if out_time_us.isdigit() else 0.0
+            logger.debug(f"ffmpeg 处理 {name}: {out_time:.1f}s, 速度 {progress.get('speed', '-')}")
+
+    @staticmethod
+    async def _read_stderr(stream: asyncio.StreamReader, tail: deque[str]) -> None:
+        """读取 stderr，只保留末尾若干行"""
+        async for line in stream:
+            if line := line.decode(errors="ignore").strip():
+                tail.append(line)
+
+    def stats(self) -> dict[str, Any]:
+        """任务池统计信息，用于调整并发参数"""
+        return {
+            "max_workers": self.max_workers,
+            "queued": dict(self._queued),
+            "running": dict(self._running),
+            "completed": self._completed,
+            "failed": self._failed,
+            "timed_out": self._timed_out,
+            "avg_wait": self._total_wait / self._jobs if self._jobs else 0.0,
+            "max_wait": self._max_wait,
+            "avg_run": self._total_run / self._jobs if self._jobs else 0.0,
+            "max_run": self._max_run,
+        }
+
+
+# 全局 ffmpeg 任务池
+ffmpeg_pool = FFmpegPool(FFMPEG_WORKERS, FFMPEG_TIMEOUT)
+
+
+async def ffprobe(path: Path, *, timeout: float = 30) -> dict[str, Any]:
+    """读取媒体文件的封装和流信息
+
+    Args:
+        path (Path): 媒体文件路径
+        timeout (float, optional): 最长运行时间，单位秒. Defaults to 30.
+
+    Returns:
+        dict[str, Any]: ffprobe 输出的 format 和 streams
+
+    Raises:
+        RuntimeError: ffprobe 未安装、执行失败或超时
+    """
+    cmd = ["ffprobe", "-v", "error", "-show_format", "-show_streams", "-of", "json", str(path)]
+    async with ffmpeg_pool.slot(heavy=False):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+        except FileNotFoundError:
+            raise RuntimeError("ffprobe 未安装或无法找到可执行文件")
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"ffprobe 读取 {path.name} 超时")
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffprobe 执行失败: {stderr.decode().strip()}")
+    return json.loads(stdout)
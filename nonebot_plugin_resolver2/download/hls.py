@@ -0,0 +1,264 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+import re
+from urllib.parse import urljoin
+
+import aiofiles
+import aiohttp
+from nonebot import logger
+
+from ..client import get_session
+from ..config import HLS_CONNECTIONS, MAX_SIZE
+from ..constant import COMMON_HEADER, DOWNLOAD_RETRIES
+from ..exception import DownloadException, DownloadSizeLimitException
+from . import is_retryable
+from .cache import cache_manager
+from .scheduler import download_scheduler
+from .telemetry import DownloadRecord, download_telemetry
+from .utils import atomic_output, exec_ffmpeg_cmd, safe_unlink
+
+# 属性列表中的 KEY=VALUE，VALUE 可能为带引号的字符串
+_ATTRIBUTE_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+@dataclass
+class HlsSegment:
+    """媒体分段"""
+
+    url: str
+    # 时长，单位秒
+    duration: float
+
+
+@dataclass
+class HlsVariant:
+    """主播放列表中的码流"""
+
+    url: str
+    # 峰值码率，单位 bit/s
+    bandwidth: int
+    resolution: str | None = None
+
+
+@dataclass
+class M3U8Playlist:
+    """m3u8 播放列表，主播放列表只有 variants，媒体播放列表只有 segments"""
+
+    segments: list[HlsSegment] = field(default_factory=list)
+    variants: list[HlsVariant] = field(default_factory=list)
+
+    @property
+    def duration(self) -> float:
+        """总时长，单位秒"""
+        return sum(segment.duration for segment in self.segments)
+
+
+def parse_m3u8(text: str, base_url: str) -> M3U8Playlist:
+    """解析 m3u8 播放列表
+
+    Args:
+        text (str): 播放列表内容
+        base_url (str): 播放列表地址，用于补全相对地址
+
+    Returns:
+        M3U8Playlist: 分段或码流列表
+
+    Raises:
+        ValueError: 不是 m3u8 播放列表
+        DownloadException: 播放列表使用初始化分段或加密，直接拼接分段得到的文件无法播放
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines or lines[0] != "#EXTM3U":
+        raise ValueError("不是 m3u8 播放列表")
+    playlist = M3U8Playlist()
+    # 作用于下一个 URI 行的标签
+    duration: float | None = None
+    variant_attrs: dict[str, str] | None = None
+    for line in lines[1:]:
+        if line.startswith("#EXTINF:"):
+            duration = float(line.removeprefix("#EXTINF:").split(",", 1)[0])
+        elif line.startswith("#EXT-X-MAP:"):
+            raise DownloadException("不支持带初始化分段(EXT-X-MAP)的播放列表")
+        elif line.startswith("#EXT-X-KEY:"):
+            method = dict(_ATTRIBUTE_RE.findall(line.removeprefix("#EXT-X-KEY:"))).get("METHOD")
+            if method != "NONE":
+                raise DownloadException("不支持加密(EXT-X-KEY)的播放列表")
+        elif line.startswith("#EXT-X-STREAM-INF:"):
+            attrs = line.removeprefix("#EXT-X-STREAM-INF:")
+            variant_attrs = {key: value.strip('"') for key, value in _ATTRIBUTE_RE.findall(attrs)}
+        elif line.startswith("#"):
+            continue
+        elif variant_attrs is not None:
+            playlist.variants.append(
+                HlsVariant(
+                    url=urljoin(base_url, line),
+                    bandwidth=int(variant_attrs.get("BANDWIDTH", 0)),
+                    resolution=variant_attrs.get("RESOLUTION"),
+                )
+            )
+            variant_attrs = None
+        elif duration is not None:
+            playlist.segments.append(HlsSegment(url=urljoin(base_url, line), duration=duration))
+            duration = None
+    return playlist
+
+
+async def fetch_m3u8(url: str, *, proxy: str | None = None, ext_headers: dict[str, str] | None = None) -> M3U8Playlist:
+    """获取并解析媒体播放列表，主播放列表选择码率最高的码流
+
+    Args:
+        url (str): m3u8 地址
+        proxy (str | None, optional): proxy url. Defaults to None.
+        ext_headers (dict[str, str] | None, optional): ext headers. Defaults to None.
+
+    Returns:
+        M3U8Playlist: 媒体播放列表
+
+    Raises:
+        DownloadException: 获取或解析失败
+    """
+    headers = {**COMMON_HEADER, **(ext_headers or {})}
+    session = get_session(proxy=proxy)
+    try:
+        async with session.get(url, headers=headers, proxy=proxy) as resp:
+            resp.raise_for_status()
+            playlist = parse_m3u8(await resp.text(), str(resp.url))
+        if not playlist.segments and playlist.variants:
+            variant = max(playlist.variants, key=lambda variant: variant.bandwidth)
+            return await fetch_m3u8(variant.url, proxy=proxy, ext_headers=ext_headers)
+    except (asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+        logger.error(f"获取播放列表 {url} 失败: {e!r}")
+        raise DownloadException("获取视频播放列表失败")
+    if not playlist.segments:
+        raise DownloadException("视频播放列表为空")
+    return playlist
+
+
+async def download_hls(
+    m3u8_url: str,
+    segment_urls: list[str],
+    output_path: Path,
+    *,
+    max_size: int | None = None,
+    proxy: str | None = None,
+    ext_headers: dict[str, str] | None = None,
+) -> Path:
+    """并发下载 HLS 分段，按顺序写入后封装为 mp4
+
+    同时下载的分段数不超过 HLS_CONNECTIONS，分段失败时单独重试；
+    超过大小限制时在分段边界停止，只封装已下载的部分
+
+    Args:
+        m3u8_url (str): m3u8 地址，用于记录
+        segment_urls (list[str]): 分段地址
+        output_path (Path): 输出文件路径
+        max_size (int | None, optional): 最大字节数. Defaults to MAX_SIZE.
+        proxy (str | None, optional): proxy url. Defaults to None.
+        ext_headers (dict[str, str] | None, optional): ext headers. Defaults to None.
+
+    Returns:
+        Path: mp4 文件路径
+
+    Raises:
+        DownloadException: 下载或封装失败
+        DownloadSizeLimitException: 第一个分段就超过大小限制
+    """
+    cache_manager.hold(output_path)
+    if await cache_manager.lookup(output_path):
+        download_telemetry.cache_hit(m3u8_url, output_path.name)
+        return output_path
+
+    if max_size is None:
+        max_size = MAX_SIZE * 1024 * 1024
+    headers = {**COMMON_HEADER, **(ext_headers or {})}
+    session = get_session(proxy=proxy)
+    ts_path = output_path.with_name(f"{output_path.stem}.ts.part")
+    try:
+        with download_telemetry.track(m3u8_url, output_path.name) as record:
+            await _download_segments(session, segment_urls, ts_path, max_size, record, headers=headers, proxy=proxy)
+        # 拼接的 ts 不是有效的 mp4，只复制流重新封装
+        async with atomic_output(output_path) as tmp_path:
+            cmd = ["ffmpeg", "-y", "-i", str(ts_path), "-c", "copy", "-movflags", "+faststart", str(tmp_path)]
+            await exec_ffmpeg_cmd(cmd)
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        logger.error(f"下载 {output_path.name} 分段失败: {e!r}")
+        raise DownloadException("下载视频分段失败")
+    except RuntimeError as e:
+        logger.error(f"封装 {output_path.name} 失败: {e}")
+        raise DownloadException("封装视频失败")
+    finally:
+        await safe_unlink(ts_path)
+    await cache_manager.add(output_path, origin=m3u8_url, content_type="video/mp4")
+    return output_path
+
+
+async def _download_segments(
+    session: aiohttp.ClientSession,
+    segment_urls: list[str],
+    path: Path,
+    max_size: int,
+    record: DownloadRecord,
+    *,
+    headers: dict[str, str],
+    proxy: str | None = None,
+) -> None:
+    """滑动窗口并发下载分段，按顺序写入文件，内存中最多保留窗口大小个分段"""
+    window = max(1, HLS_CONNECTIONS)
+    pending: deque[asyncio.Task[bytes]] = deque()
+    urls = iter(segment_urls)
+
+    def schedule() -> None:
+        while len(pending) < window and (url := next(urls, None)):
+            pending.append(asyncio.create_task(_fetch_segment(session, url, record, headers=headers, proxy=proxy)))
+
+    written = 0
+    schedule()
+    try:
+        async with aiofiles.open(path, "wb") as file:
+            for index in range(len(segment_urls)):
+                data = await pending.popleft()
+                if written + len(data) > max_size:
+                    if index == 0:
+                        raise DownloadSizeLimitException
+                    logger.warning(
+                        f"下载 {path.name} 超过 {max_size / 1024 / 1024:.0f} MB 限制, "
+                        f"只保留前 {index}/{len(segment_urls)} 个分段"
+                    )
+                    break
+                await file.write(data)
+                written += len(data)
+                schedule()
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _fetch_segment(
+    session: aiohttp.ClientSession,
+    url: str,
+    record: DownloadRecord,
+    *,
+    headers: dict[str, str],
+    proxy: str | None = None,
+) -> bytes:
+    """下载单个分段，可重试的错误按次数重试"""
+    attempt = 0
+    while True:
+        try:
+            async with download_scheduler.slot(url), session.get(url, headers=headers, proxy=proxy) as resp:
+                resp.raise_for_status()
+                chunks: list[bytes] = []
+                async for chunk in resp.content.iter_chunked(1024 * 1024):
+                    chunks.append(chunk)
+                    record.update(len(chunk))
+                return b"".join(chunks)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            if attempt >= DOWNLOAD_RETRIES or not is_retryable(e):
+                raise
+            attempt += 1
+            record.retries += 1
+            logger.warning(f"下载分段 {url} 出错({e!r}), 第 {attempt} 次重试")
+            await asyncio.sleep(attempt)
@@ -0,0 +1,264 @@
+import asyncio
+from pathlib import Path
+import struct
+
+import aiofiles
+from aiofiles.threadpool.binary import AsyncBufferedIOBase
+import aiohttp
+from nonebot import logger
+
+from ..client import get_session
+from ..config import MAX_SIZE, PREVIEW_DURATION, plugin_cache_dir
+from ..constant import COMMON_HEADER
+from ..exception import DownloadException, DownloadSizeLimitException
+from . import check_size, download_video, probe_range
+from .cache import cache_manager
+from .ffmpeg import ffprobe
+from .scheduler import download_scheduler
+from .telemetry import DownloadRecord, download_telemetry
+from .utils import atomic_output, exec_ffmpeg_cmd, generate_file_name, safe_unlink
+
+# 普通 mp4 预览先下载的头部大小，用于读取 moov 中的总时长
+_PREVIEW_HEAD = 2 * 1024 * 1024
+
+
+def parse_sidx(data: bytes) -> tuple[int, list[tuple[int, float]]]:
+    """解析 DASH 流的 sidx box
+
+    Args:
+        data (bytes): 从 sidx box 开头开始的数据
+
+    Returns:
+        tuple[int, list[tuple[int, float]]]: 第一个分段相对 sidx 开头的偏移，各分段的字节数和时长（秒）
+
+    Raises:
+        ValueError: 不是 sidx box
+    """
+    box_size, box_type = struct.unpack_from(">I4s", data, 0)
+    if box_type != b"sidx":
+        raise ValueError("不是 sidx box")
+    version = data[8]
+    # box 头 8 字节，version + flags 4 字节，reference_ID 4 字节
+    (timescale,) = struct.unpack_from(">I", data, 16)
+    if version == 0:
+        _, first_offset = struct.unpack_from(">II", data, 20)
+        pos = 28
+    else:
+        _, first_offset = struct.unpack_from(">QQ", data, 20)
+        pos = 36
+    # reserved 2 字节，reference_count 2 字节
+    (reference_count,) = struct.unpack_from(">H", data, pos + 2)
+    pos += 4
+    references: list[tuple[int, float]] = []
+    for _ in range(reference_count):
+        reference, duration, _ = struct.unpack_from(">III", data, pos)
+        # 最高位为 reference_type
+        references.append((reference & 0x7FFFFFFF, duration / timescale))
+        pos += 12
+    return box_size + first_offset, references
+
+
+async def _fetch_range(
+    session: aiohttp.ClientSession,
+    url: str,
+    file: AsyncBufferedIOBase,
+    start: int,
+    end: int,
+    record: DownloadRecord,
+    *,
+    headers: dict[str, str],
+    proxy: str | None = None,
+) -> None:
+    """请求 [start, end] 范围的数据，追加写入文件"""
+    async with (
+        download_scheduler.slot(url),
+        session.get(url, headers={**headers, "Range": f"bytes={start}-{end}"}, proxy=proxy) as resp,
+    ):
+        resp.raise_for_status()
+        if resp.status != 206:
+            raise DownloadException("服务器不支持 Range 请求，无法生成预览")
+        async for chunk in resp.content.iter_chunked(1024 * 1024):
+            await file.write(chunk)
+            record.update(len(chunk))
+
+
+async def _download_dash_prefix(
+    session: aiohttp.ClientSession,
+    url: str,
+    index_range: str,
+    duration: float,
+    path: Path,
+    *,
+    headers: dict[str, str],
+    proxy: str | None = None,
+) -> None:
+    """下载 DASH 流的初始化段、sidx 以及覆盖前 duration 秒的分段"""
+    index_start, index_end = map(int, index_range.split("-"))
+    with download_telemetry.track(url, path.name) as record:
+        async with aiofiles.open(path, "w+b") as file:
+            # 初始化段和 sidx
+            await _fetch_range(session, url, file, 0, index_end, record, headers=headers, proxy=proxy)
+            await file.seek(index_start)
+            segment_offset, references = parse_sidx(await file.read(index_end - index_start + 1))
+            # 累加分段，直到覆盖预览时长
+            end = index_start + segment_offset
+            elapsed = 0.0
+            for size, segment_duration in references:
+                end += size
+                elapsed += segment_duration
+                if elapsed >= duration:
+                    break
+            check_size(end, path.name)
+            if end - 1 > index_end:
+                await file.seek(0, 2)
+                await _fetch_range(session, url, file, index_end + 1, end - 1, record, headers=headers, proxy=proxy)
+
+
+async def download_dash_preview(
+    *,
+    v_url: str,
+    v_index_range: str,
+    a_url: str,
+    a_index_range: str,
+    output_path: Path,
+    duration: float = PREVIEW_DURATION,
+    proxy: str | None = None,
+    ext_headers: dict[str, str] | None = None,
+) -> Path:
+    """只下载 DASH 音视频流开头的分段，合并为预览片段
+
+    Args:
+        v_url (str): 视频流地址
+        v_index_range (str): 视频流 sidx 的字节范围
+        a_url (str): 音频流地址
+        a_index_range (str): 音频流 sidx 的字节范围
+        output_path (Path): 输出文件路径
+        duration (float, optional): 预览时长，单位秒. Defaults to PREVIEW_DURATION.
+        proxy (str | None, optional): proxy url. Defaults to None.
+        ext_headers (dict[str, str] | None, optional): ext headers. Defaults to None.
+
+    Returns:
+        Path: 预览片段路径
+
+    Raises:
+        DownloadException: 下载或合并失败
+    """
+    cache_manager.hold(output_path)
+    if await cache_manager.lookup(output_path):
+        return output_path
+    headers = {**COMMON_HEADER, **(ext_headers or {})}
+    session = get_session(proxy=proxy)
+    v_path = output_path.with_name(f"{output_path.stem}-video.part.m4s")
+    a_path = output_path.with_name(f"{output_path.stem}-audio.part.m4s")
+    try:
+        await asyncio.gather(
+            _download_dash_prefix(session, v_url, v_index_range, duration, v_path, headers=headers, proxy=proxy),
+            _download_dash_prefix(session, a_url, a_index_range, duration, a_path, headers=headers, proxy=proxy),
+        )
+        await _trim(output_path, duration, v_path, a_path)
+    except (ValueError, RuntimeError) as e:
+        logger.error(f"生成预览 {output_path.name} 失败: {e}")
+        raise DownloadException("生成预览片段失败")
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        logger.error(f"下载预览 {output_path.name} 失败: {e!r}")
+        raise DownloadException("下载预览片段失败")
+    finally:
+        await asyncio.gather(safe_unlink(v_path), safe_unlink(a_path))
+    return output_path
+
+
+async def download_video_preview(
+    url: str,
+    *,
+    video_name: str | None = None,
+    duration: float = PREVIEW_DURATION,
+    proxy: str | None = None,
+    ext_headers: dict[str, str] | None = None,
+) -> Path:
+    """只下载 mp4 开头的部分，截取为预览片段
+
+    先下载文件头部读取总时长，再按平均码率估算前 duration 秒的大小，要求 moov 位于文件头部
+
+    Args:
+        url (str): url address
+        video_name (str | None, optional): video name. Defaults to get name by parse url.
+        duration (float, optional): 预览时长，单位秒. Defaults to PREVIEW_DURATION.
+        proxy (str | None, optional): proxy url. Defaults to None.
+        ext_headers (dict[str, str] | None, optional): ext headers. Defaults to None.
+
+    Returns:
+        Path: 预览片段路径
+
+    Raises:
+        DownloadException: 不支持 Range 请求、无法读取时长或截取失败
+    """
+    if video_name is None:
+        video_name = generate_file_name(url, ".mp4")
+    output_path = plugin_cache_dir / f"{Path(video_name).stem}_preview.mp4"
+    cache_manager.hold(output_path)
+    if await cache_manager.lookup(output_path):
+        return output_path
+    headers = {**COMMON_HEADER, **(ext_headers or {})}
+    session = get_session(proxy=proxy)
+    prefix_path = output_path.with_name(f"{output_path.stem}_prefix.part.mp4")
+    try:
+        probe = await probe_range(session, url, headers=headers, proxy=proxy)
+        if not probe.accept_ranges or not probe.size:
+            raise DownloadException("资源不支持 Range 请求，无法生成预览")
+        with download_telemetry.track(url, prefix_path.name) as record:
+            async with aiofiles.open(prefix_path, "wb") as file:
+                head_end = min(probe.size, _PREVIEW_HEAD) - 1
+                await _fetch_range(session, url, file, 0, head_end, record, headers=headers, proxy=proxy)
+                await file.flush()
+                # moov 位于文件头部时，可以从头部读取总时长
+                info = await ffprobe(prefix_path)
+                total_duration = float(info.get("format", {}).get("duration") or 0)
+                if total_duration <= 0:
+                    raise DownloadException("无法获取视频时长，无法生成预览")
+                # 按平均码率估算，多下载 20% 保证截取范围内的数据完整
+                end = int(probe.size * min(1.0, duration / total_duration * 1.2)) + _PREVIEW_HEAD
+                end = min(end, probe.size, MAX_SIZE * 1024 * 1024) - 1
+                if end > head_end:
+                    await _fetch_range(session, url, file, head_end + 1, end, record, headers=headers, proxy=proxy)
+        await _trim(output_path, duration, prefix_path)
+    except RuntimeError as e:
+        logger.error(f"生成预览 {output_path.name} 失败: {e}")
+        raise DownloadException("生成预览片段失败")
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        logger.error(f"下载预览 {output_path.name} 失败: {e!r}")
+        raise DownloadException("下载预览片段失败")
+    finally:
+        await safe_unlink(prefix_path)
+    return output_path
+
+
+async def download_video_or_preview(
+    url: str,
+    *,
+    video_name: str | None = None,
+    proxy: str | None = None,
+    ext_headers: dict[str, str] | None = None,
+) -> tuple[Path, bool]:
+    """下载视频，超过大小限制时下载预览片段
+
+    Returns:
+        tuple[Path, bool]: 视频路径，是否为预览片段
+    """
+    try:
+        return await download_video(url, video_name=video_name, proxy=proxy, ext_headers=ext_headers), False
+    except DownloadSizeLimitException:
+        if not PREVIEW_DURATION:
+            raise
+        logger.info(f"视频 {url} 超过大小限制，下载前 {PREVIEW_DURATION} 秒预览")
+        return await download_video_preview(url, video_name=video_name, proxy=proxy, ext_headers=ext_headers), True
+
+
+async def _trim(output_path: Path, duration: float, v_path: Path, a_path: Path | None = None) -> None:
+    """截取前 duration 秒，只复制流"""
+    cmd = ["ffmpeg", "-y", "-i", str(v_path)]
+    if a_path:
+        cmd += ["-i", str(a_path), "-map", "0:v:0", "-map", "1:a:0"]
+    cmd += ["-t", str(duration), "-c", "copy", "-movflags", "+faststart"]
+    async with atomic_output(output_path) as tmp_path:
+        await exec_ffmpeg_cmd([*cmd, str(tmp_path)])
+    await cache_manager.add(output_path, content_type="video/mp4")
@@ -0,0 +1,141 @@
+import asyncio
+from collections import defaultdict
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+import heapq
+import itertools
+import time
+from typing import Any
+from urllib.parse import urlparse
+
+from nonebot import logger
+
+from ..config import DOWNLOAD_HOST_CONNECTIONS, DOWNLOAD_MAX_CONNECTIONS
+
+
+class Priority(IntEnum):
+    """下载优先级，数值越小越优先"""
+
+    IMAGE = 0
+    AUDIO = 1
+    VIDEO = 2
+
+
+@dataclass(order=True)
+class _Waiter:
+    """等待连接的请求"""
+
+    priority: int
+    seq: int
+    host: str = field(compare=False)
+    future: asyncio.Future[None] = field(compare=False)
+    enqueued_at: float = field(compare=False, default_factory=time.monotonic)
+
+
+class DownloadScheduler:
+    """下载调度器
+
+    所有下载请求在建立连接前都需要获取一个连接名额，调度器限制全局和单个 host 的并发连接数，
+    名额空闲时按优先级分配，图片、封面等小文件优先于大视频
+    """
+
+    def __init__(self, max_connections: int, max_host_connections: int):
+        self.max_connections = max(1, max_connections)
+        self.max_host_connections = max(1, max_host_connections)
+        self._active = 0
+        self._host_active: defaultdict[str, int] = defaultdict(int)
+        self._waiters: list[_Waiter] = []
+        self._seq = itertools.count()
+        # 统计信息
+        self._granted = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._max_queue_depth = 0
+
+    @asynccontextmanager
+    async def slot(self, url: str, priority: Priority = Priority.VIDEO) -> AsyncIterator[None]:
+        """获取一个连接名额，退出时释放
+
+        Args:
+            url (str): 请求地址，用于按 host 限制并发
+            priority (Priority, optional): 优先级. Defaults to Priority.VIDEO.
+        """
+        host = urlparse(url).netloc
+        await self._acquire(host, priority)
+        try:
+            yield
+        finally:
+            self._release(host)
+
+    async def _acquire(self, host: str, priority: Priority) -> None:
+        waiter = _Waiter(
+            priority=priority,
+            seq=next(self._seq),
+            host=host,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        heapq.heappush(self._waiters, waiter)
+        self._max_queue_depth = max(self._max_queue_depth, len(self._waiters))
+        self._wakeup()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 已分配名额但调用方被取消
+                self._release(host)
+            else:
+                waiter.future.cancel()
+                self._wakeup()
+            raise
+
+        wait = time.monotonic() - waiter.enqueued_at
+        self._granted += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        if wait > 1:
+            logger.debug(f"下载 {host} 排队 {wait:.2f}s, 当前队列: {self.stats()['queued']}")
+
+    def _release(self, host: str) -> None:
+        self._active -= 1
+        self._host_active[host] -= 1
+        if self._host_active[host] <= 0:
+            del self._host_active[host]
+        self._wakeup()
+
+    def _wakeup(self) -> None:
+        """按优先级分配空闲名额，host 已满的请求不会阻塞其他 host 的请求"""
+        pending: list[_Waiter] = []
+        while self._waiters and self._active < self.max_connections:
+            waiter = heapq.heappop(self._waiters)
+            if waiter.future.done():
+                continue
+            if self._host_active[waiter.host] >= self.max_host_connections:
+                pending.append(waiter)
+                continue
+            self._active += 1
+            self._host_active[waiter.host] += 1
+            waiter.future.set_result(None)
+        for waiter in pending:
+            heapq.heappush(self._waiters, waiter)
+
+    def stats(self) -> dict[str, Any]:
+        """调度器统计信息，用于调整并发参数"""
+        queued = {p.name.lower(): 0 for p in Priority}
+        for waiter in self._waiters:
+            if not waiter.future.done():
+                queued[Priority(waiter.priority).name.lower()] += 1
+        return {
+            "active": self._active,
+            "active_hosts": dict(self._host_active),
+            "queued": queued,
+            "max_queue_depth": self._max_queue_depth,
+            "granted": self._granted,
+            "avg_wait": self._total_wait / self._granted if self._granted else 0.0,
+            "max_wait": self._max_wait,
+        }
+
+
+# 全局下载调度器
+download_scheduler = DownloadScheduler(DOWNLOAD_MAX_CONNECTIONS, DOWNLOAD_HOST_CONNECTIONS)
@@ -0,0 +1,130 @@
+from collections import deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import time
+from typing import Any
+
+from nonebot import logger
+
+# 下载进度日志的最小间隔，单位秒
+_LOG_INTERVAL = 10.0
+
+
+@dataclass
+class DownloadRecord:
+    """单次下载的统计信息"""
+
+    name: str
+    url: str
+    # 资源总大小，未知时为 None
+    total: int | None = None
+    # 本次下载传输的字节数，不含断点续传前已下载的部分
+    total_bytes: int = 0
+    # 断点续传时已下载的字节数
+    resumed_bytes: int = 0
+    retries: int = 0
+    from_cache: bool = False
+    error: str | None = None
+    started_at: float = field(default_factory=time.monotonic)
+    # 首字节耗时，单位秒
+    ttfb: float | None = None
+    # 总耗时，单位秒，下载中为 None
+    elapsed: float | None = None
+    _last_log: float = field(default_factory=time.monotonic, repr=False)
+
+    @property
+    def throughput(self) -> float:
+        """平均下载速度，单位 B/s"""
+        elapsed = self.elapsed if self.elapsed is not None else time.monotonic() - self.started_at
+        return self.total_bytes / elapsed if elapsed > 0 else 0.0
+
+    def update(self, size: int) -> None:
+        """记录收到的数据，按间隔输出进度日志"""
+        now = time.monotonic()
+        if self.ttfb is None:
+            self.ttfb = now - self.started_at
+        self.total_bytes += size
+        if now - self._last_log >= _LOG_INTERVAL:
+            self._last_log = now
+            done = (self.resumed_bytes + self.total_bytes) / 1024 / 1024
+            total = f" / {self.total / 1024 / 1024:.2f}" if self.total else ""
+            logger.debug(f"下载 {self.name}: {done:.2f}{total} MB, {self.throughput / 1024 / 1024:.2f} MB/s")
+
+
+class DownloadTelemetry:
+    """下载统计
+
+    记录每次下载的首字节耗时、速度、大小、重试次数以及是否命中缓存，
+    保留最近 max_records 条记录供查询，替代逐块刷新的进度条
+    """
+
+    def __init__(self, max_records: int = 200):
+        self._records: deque[DownloadRecord] = deque(maxlen=max_records)
+        self._active_records: dict[int, DownloadRecord] = {}
+
+    @contextmanager
+    def track(self, url: str, name: str) -> Iterator[DownloadRecord]:
+        """记录一次下载，退出时记录耗时和异常
+
+        Args:
+            url (str): 下载地址
+            name (str): 文件名
+        """
+        record = DownloadRecord(name=name, url=url)
+        self._active_records[id(record)] = record
+        try:
+            yield record
+        except BaseException as e:
+            record.error = repr(e)
+            raise
+        finally:
+            self._active_records.pop(id(record), None)
+            self._finish(record)
+
+    def cache_hit(self, url: str, name: str) -> None:
+        """记录一次缓存命中"""
+        record = DownloadRecord(name=name, url=url, from_cache=True)
+        self._finish(record)
+
+    def _finish(self, record: DownloadRecord) -> None:
+        record.elapsed = time.monotonic() - record.started_at
+        self._records.append(record)
+        if record.from_cache or record.error:
+            return
+        ttfb = f"{record.ttfb:.2f}s" if record.ttfb is not None else "-"
+        # 图集等场景下载数量多，只在 DEBUG 级别输出，汇总信息通过 summary 查询
+        logger.debug(
+            f"下载 {record.name} 完成, {record.total_bytes / 1024 / 1024:.2f} MB, 用时 {record.elapsed:.2f}s, "
+            f"{record.throughput / 1024 / 1024:.2f} MB/s, 首字节 {ttfb}, 重试 {record.retries} 次"
+        )
+
+    def active(self) -> list[DownloadRecord]:
+        """进行中的下载"""
+        return list(self._active_records.values())
+
+    def recent(self) -> list[DownloadRecord]:
+        """最近完成的下载，按完成顺序排列"""
+        return list(self._records)
+
+    def summary(self) -> dict[str, Any]:
+        """最近下载的汇总统计"""
+        downloads = [r for r in self._records if not r.from_cache]
+        succeeded = [r for r in downloads if r.error is None]
+        ttfbs = [r.ttfb for r in downloads if r.ttfb is not None]
+        total_time = sum(r.elapsed or 0.0 for r in succeeded)
+        total_bytes = sum(r.total_bytes for r in succeeded)
+        return {
+            "active": len(self._active_records),
+            "downloads": len(downloads),
+            "failed": len(downloads) - len(succeeded),
+            "cache_hits": len(self._records) - len(downloads),
+            "total_bytes": total_bytes,
+            "retries": sum(r.retries for r in downloads),
+            "avg_ttfb": sum(ttfbs) / len(ttfbs) if ttfbs else 0.0,
+            "avg_throughput": total_bytes / total_time if total_time > 0 else 0.0,
+        }
+
+
+# 全局下载统计
+download_telemetry = DownloadTelemetry()
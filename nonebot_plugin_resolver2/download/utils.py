@@ -1,4 +1,6 @@
 import asyncio
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 import hashlib
 from pathlib import Path
 import re
@@ -6,6 +8,8 @@ from urllib.parse import urlparse
 
 from nonebot import logger
 
+from .ffmpeg import ffmpeg_pool
+
 
 def keep_zh_en_num(text: str) -> str:
     """
@@ -26,22 +30,25 @@ async def safe_unlink(path: Path):
         logger.error(f"删除 {path} 失败: {e}")
 
 
-async def exec_ffmpeg_cmd(cmd: list[str]) -> None:
+@asynccontextmanager
+async def atomic_output(path: Path) -> AsyncIterator[Path]:
     """
-    执行 ffmpeg 命令
+    先写入临时文件，成功后原子重命名为目标文件，失败时删除临时文件，保证缓存中只存在完整文件
+    临时文件保留原扩展名，ffmpeg 可以据此识别输出格式
     """
+    tmp_path = path.with_name(f"{path.stem}.part{path.suffix}")
     try:
-        process = await asyncio.create_subprocess_exec(
-            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        _, stderr = await process.communicate()
-        return_code = process.returncode
-    except FileNotFoundError:
-        raise RuntimeError("ffmpeg 未安装或无法找到可执行文件")
-
-    if return_code != 0:
-        error_msg = stderr.decode().strip()
-        raise RuntimeError(f"ffmpeg 执行失败: {error_msg}")
+        yield tmp_path
+        await asyncio.to_thread(tmp_path.replace, path)
+    finally:
+        await safe_unlink(tmp_path)
+
+
+async def exec_ffmpeg_cmd(cmd: list[str], *, timeout: float | None = None) -> None:
+    """
+    执行 ffmpeg 命令，通过任务池限制并发和运行时间
+    """
+    await ffmpeg_pool.run(cmd, timeout=timeout)
 
 
 def generate_file_name(url: str, default_suffix: str = "") -> str:
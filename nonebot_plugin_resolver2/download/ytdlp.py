@@ -1,32 +1,244 @@
 import asyncio
-from collections import OrderedDict
+from dataclasses import dataclass
+import json
 from pathlib import Path
+import sys
 from typing import Any
 
-import yt_dlp
+from nonebot import logger
 
-from ..config import PROXY, plugin_cache_dir
-from ..exception import ParseException
-from .utils import generate_file_name
+from ..config import (
+    MAX_SIZE,
+    PROXY,
+    YTDLP_AUDIO_FORMAT,
+    YTDLP_CONCURRENT_FRAGMENTS,
+    YTDLP_HTTP_CHUNK_SIZE,
+    YTDLP_INFO_PERSIST,
+    YTDLP_NATIVE_DOWNLOAD,
+    YTDLP_TIMEOUT,
+    YTDLP_WORKERS,
+    plugin_cache_dir,
+    plugin_data_dir,
+)
+from ..constant import YTDLP_INFO_CACHE_MB, YTDLP_INFO_TTL
+from ..exception import DownloadException, DownloadSizeLimitException, ParseException
+from . import download_file_by_stream, merge_av
+from .cache import cache_manager, is_partial
+from .utils import atomic_output, exec_ffmpeg_cmd, generate_file_name
+from .ytdlp_cache import InfoCache
+from .ytdlp_worker import run_job
 
+# 工作进程脚本
+_WORKER_SCRIPT = Path(__file__).with_name("ytdlp_worker.py")
+# 信息字典可能有数 MB，放宽单行长度限制
+_STREAM_LIMIT = 64 * 1024 * 1024
 
-class LimitedSizeDict(OrderedDict):
-    """
-    定长字典
+
+class _Worker:
+    """yt-dlp 工作进程，通过 stdin/stdout 逐行交换 JSON"""
+
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+
+    @classmethod
+    async def spawn(cls) -> "_Worker":
+        """启动工作进程，等待 yt_dlp 导入完成"""
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            str(_WORKER_SCRIPT),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            limit=_STREAM_LIMIT,
+        )
+        worker = cls(process)
+        try:
+            await worker._recv()
+        except BaseException:
+            await worker.kill()
+            raise
+        return worker
+
+    async def _recv(self) -> dict[str, Any]:
+        assert self.process.stdout
+        line = await self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f"yt-dlp 工作进程意外退出, 返回码 {await self.process.wait()}")
+        return json.loads(line)
+
+    async def call(self, action: str, url: str, opts: dict[str, Any]) -> dict[str, Any]:
+        assert self.process.stdin
+        job = {"action": action, "url": url, "opts": opts}
+        self.process.stdin.write(json.dumps(job, ensure_ascii=False).encode() + b"\n")
+        await self.process.stdin.drain()
+        return await self._recv()
+
+    async def kill(self) -> None:
+        if self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+
+    async def close(self) -> None:
+        """关闭 stdin 通知进程退出，超时后强制结束"""
+        assert self.process.stdin
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), 5)
+        except asyncio.TimeoutError:
+            await self.kill()
+
+
+class YtdlpPool:
+    """yt-dlp 进程池
+
+    yt-dlp 是纯 Python 实现，在线程中执行会与事件循环争抢 GIL，拖慢其他平台的解析。
+    工作进程启动时预先导入 yt_dlp，每个进程同时只执行一个任务；
+    超时或取消时结束执行中的进程，并在后台启动新的进程补充。
+    存活和启动中的进程数不超过 workers，没有空闲进程时等待其他任务归还或补充完成
     """
 
-    def __init__(self, *args, max_size=20, **kwargs):
-        self.max_size = max_size
-        super().__init__(*args, **kwargs)
+    def __init__(self, workers: int, timeout: float):
+        """
+        Args:
+            workers (int): 工作进程数
+            timeout (float): 单个任务的最长运行时间，单位秒
+        """
+        self.workers = workers
+        self.timeout = timeout
+        # 空闲进程，None 表示补充失败，取到的任务需要自行启动进程
+        self._idle: asyncio.Queue[_Worker | None] = asyncio.Queue()
+        # 存活和启动中的进程数
+        self._alive = 0
+        self._spawn_tasks: set[asyncio.Task[None]] = set()
+        # 统计信息
+        self._completed = 0
+        self._failed = 0
+        self._timed_out = 0
+        self._killed = 0
+
+    async def start(self) -> None:
+        """启动全部工作进程"""
+        count = self.workers - self._alive
+        self._alive += count
+        try:
+            workers = await asyncio.gather(*[_Worker.spawn() for _ in range(count)])
+        except BaseException:
+            self._alive -= count
+            raise
+        for worker in workers:
+            self._idle.put_nowait(worker)
+        logger.info(f"yt-dlp 进程池已启动, 共 {self.workers} 个工作进程")
+
+    def _respawn(self) -> None:
+        """在后台启动进程，替换被结束的进程"""
+
+        async def spawn() -> None:
+            try:
+                self._idle.put_nowait(await _Worker.spawn())
+            except Exception as e:
+                logger.error(f"启动 yt-dlp 工作进程失败: {e}")
+                self._idle.put_nowait(None)
+
+        task = asyncio.create_task(spawn())
+        self._spawn_tasks.add(task)
+        task.add_done_callback(self._spawn_tasks.discard)
+
+    async def _take(self) -> _Worker:
+        """取得一个空闲进程，进程数未达到上限时直接启动新进程"""
+        if self._idle.empty() and self._alive < self.workers:
+            self._alive += 1
+            try:
+                return await _Worker.spawn()
+            except BaseException:
+                self._alive -= 1
+                raise
+        worker = await self._idle.get()
+        if worker is None:
+            # 后台补充失败，由当前任务重新启动
+            try:
+                return await _Worker.spawn()
+            except BaseException:
+                self._idle.put_nowait(None)
+                raise
+        return worker
+
+    async def run(self, action: str, url: str, opts: dict[str, Any], *, timeout: float | None = None) -> Any:
+        """在工作进程中执行 yt-dlp 任务
+
+        Args:
+            action (str): extract 获取信息，download 下载
+            url (str): url address
+            opts (dict[str, Any]): YoutubeDL 参数，需要可以 JSON 序列化
+            timeout (float | None, optional): 最长运行时间，单位秒. Defaults to pool timeout.
+
+        Returns:
+            Any: 任务结果
+
+        Raises:
+            RuntimeError: 任务失败、超时或工作进程异常退出
+        """
+        timeout = timeout or self.timeout
+        worker = await self._take()
+        try:
+            reply = await asyncio.wait_for(worker.call(action, url, opts), timeout)
+        except BaseException as e:
+            # 超时、取消或进程异常退出，结束进程并补充
+            await worker.kill()
+            self._killed += 1
+            self._failed += 1
+            self._respawn()
+            if isinstance(e, asyncio.TimeoutError):
+                self._timed_out += 1
+                raise RuntimeError(f"yt-dlp 处理 {url} 超时({timeout:.0f}s)")
+            raise
+        self._idle.put_nowait(worker)
+        if not reply["ok"]:
+            self._failed += 1
+            raise RuntimeError(reply["error"])
+        self._completed += 1
+        return reply["result"]
 
-    def __setitem__(self, key, value):
-        super().__setitem__(key, value)
-        if len(self) > self.max_size:
-            self.popitem(last=False)  # 移除最早添加的项
+    def stats(self) -> dict[str, Any]:
+        """进程池统计信息"""
+        return {
+            "workers": self.workers,
+            "alive": self._alive,
+            "idle": self._idle.qsize(),
+            "completed": self._completed,
+            "failed": self._failed,
+            "timed_out": self._timed_out,
+            "killed": self._killed,
+        }
 
+    async def close(self) -> None:
+        """关闭全部工作进程"""
+        for task in list(self._spawn_tasks):
+            task.cancel()
+        await asyncio.gather(*self._spawn_tasks, return_exceptions=True)
+        workers: list[_Worker] = []
+        while not self._idle.empty():
+            if worker := self._idle.get_nowait():
+                workers.append(worker)
+        self._alive = 0
+        await asyncio.gather(*[worker.close() for worker in workers])
 
-# 使用定长字典缓存链接信息，最多保存 20 个条目
-url_info_mapping: LimitedSizeDict = LimitedSizeDict()
+
+# 全局 yt-dlp 进程池，未配置工作进程数时在线程中执行
+ytdlp_pool: YtdlpPool | None = YtdlpPool(YTDLP_WORKERS, YTDLP_TIMEOUT) if YTDLP_WORKERS > 0 else None
+
+
+async def _run_ytdlp(action: str, url: str, opts: dict[str, Any]) -> Any:
+    """执行 yt-dlp 任务，配置了进程池时在工作进程中执行，否则在线程中执行"""
+    if ytdlp_pool is not None:
+        return await ytdlp_pool.run(action, url, opts)
+    return await asyncio.to_thread(run_job, action, url, opts)
+
+
+# 全局 yt-dlp 信息缓存
+ytdlp_info_cache = InfoCache(
+    YTDLP_INFO_CACHE_MB * 1024 * 1024,
+    YTDLP_INFO_TTL,
+    plugin_data_dir / "ytdlp_info_cache.json" if YTDLP_INFO_PERSIST else None,
+)
 
 # 获取视频信息的 基础 opts
 ydl_extract_base_opts: dict[str, Any] = {
@@ -36,14 +248,109 @@ ydl_extract_base_opts: dict[str, Any] = {
 }
 
 # 下载视频的 基础 opts
-ydl_download_base_opts: dict[str, Any] = {}
+ydl_download_base_opts: dict[str, Any] = {
+    "concurrent_fragment_downloads": max(1, YTDLP_CONCURRENT_FRAGMENTS),
+}
+if YTDLP_HTTP_CHUNK_SIZE > 0:
+    ydl_download_base_opts["http_chunk_size"] = YTDLP_HTTP_CHUNK_SIZE * 1024 * 1024
 
 if PROXY is not None:
     ydl_download_base_opts["proxy"] = PROXY
     ydl_extract_base_opts["proxy"] = PROXY
 
 
-async def get_video_info(url: str, cookiefile: Path | None = None) -> dict[str, str]:
+@dataclass
+class FormatSelection:
+    """选择的格式"""
+
+    # yt-dlp 的格式，如 137+140
+    format: str
+    # 估算大小，单位字节
+    size: int
+    # 是否为 h264 + aac，可以直接封装为 mp4
+    compatible: bool
+
+
+def _has_codec(codec: str | None) -> bool:
+    return bool(codec) and codec != "none"
+
+
+def _is_h264(codec: str | None) -> bool:
+    return bool(codec) and codec.startswith(("avc1", "h264"))
+
+
+def _is_aac(codec: str | None) -> bool:
+    return bool(codec) and codec.startswith(("mp4a", "aac"))
+
+
+def _estimate_size(fmt: dict[str, Any], duration: float) -> int | None:
+    """估算格式大小，依次使用 filesize、filesize_approx 和 tbr * duration"""
+    if size := fmt.get("filesize") or fmt.get("filesize_approx"):
+        return int(size)
+    if (tbr := fmt.get("tbr")) and duration:
+        return int(tbr * 1000 / 8 * duration)
+    return None
+
+
+def select_format(info: dict[str, Any], max_size: int) -> FormatSelection | None:
+    """根据格式列表选择不超过大小限制的最佳格式
+
+    优先 h264 + aac，其次分辨率，分辨率相同时选择较小的
+
+    Args:
+        info (dict[str, Any]): yt-dlp 信息
+        max_size (int): 最大字节数
+
+    Returns:
+        FormatSelection | None: 选择的格式，没有格式信息或无法估算完整格式的大小时返回 None
+
+    Raises:
+        DownloadSizeLimitException: 所有格式都超过大小限制
+    """
+    duration = float(info.get("duration") or 0)
+    videos: list[tuple[dict[str, Any], int]] = []
+    audios: list[tuple[dict[str, Any], int]] = []
+    muxed: list[tuple[dict[str, Any], int]] = []
+    for fmt in info.get("formats") or []:
+        has_video, has_audio = _has_codec(fmt.get("vcodec")), _has_codec(fmt.get("acodec"))
+        # 跳过故事板等没有音视频的格式，以及无法估算大小的格式
+        if not (has_video or has_audio) or fmt.get("ext") == "mhtml":
+            continue
+        if (size := _estimate_size(fmt, duration)) is None:
+            continue
+        if has_video and has_audio:
+            muxed.append((fmt, size))
+        elif has_video:
+            videos.append((fmt, size))
+        else:
+            audios.append((fmt, size))
+    if not (videos or muxed):
+        return None
+
+    candidates: list[tuple[tuple[bool, int, bool, int], FormatSelection]] = []
+    for fmt, size in muxed:
+        h264, aac = _is_h264(fmt.get("vcodec")), _is_aac(fmt.get("acodec"))
+        selection = FormatSelection(fmt["format_id"], size, h264 and aac)
+        candidates.append(((h264, fmt.get("height") or 0, aac, -size), selection))
+    for video, video_size in videos:
+        for audio, audio_size in audios:
+            size = video_size + audio_size
+            h264, aac = _is_h264(video.get("vcodec")), _is_aac(audio.get("acodec"))
+            selection = FormatSelection(f"{video['format_id']}+{audio['format_id']}", size, h264 and aac)
+            candidates.append(((h264, video.get("height") or 0, aac, -size), selection))
+    # 只有视频格式可以估算大小，无法组合出完整的格式
+    if not candidates:
+        return None
+
+    fitting = [(key, selection) for key, selection in candidates if selection.size <= max_size]
+    if not fitting:
+        smallest = min(selection.size for _, selection in candidates)
+        logger.warning(f"所有格式都超过 {max_size / 1024 / 1024:.0f} MB 限制, 最小 {smallest / 1024 / 1024:.2f} MB")
+        raise DownloadSizeLimitException
+    return max(fitting, key=lambda item: item[0])[1]
+
+
+async def get_video_info(url: str, cookiefile: Path | None = None) -> dict[str, Any]:
     """get video info by url
 
     Args:
@@ -51,22 +358,19 @@ async def get_video_info(url: str, cookiefile: Path | None = None) -> dict[str,
         cookiefile (Path | None, optional): cookie file path. Defaults to None.
 
     Returns:
-        dict[str, str]: video info
+        dict[str, Any]: 精简后的 video info，只包含基本信息和格式列表
     """
-    info_dict = url_info_mapping.get(url, None)
-    if info_dict:
+    if info_dict := ytdlp_info_cache.get(url):
         return info_dict
     ydl_opts = {} | ydl_extract_base_opts
 
     if cookiefile:
         ydl_opts["cookiefile"] = str(cookiefile)
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info_dict = await asyncio.to_thread(ydl.extract_info, url, download=False)
-        if not info_dict:
-            raise ParseException("获取视频信息失败")
-        url_info_mapping[url] = info_dict
-        return info_dict
+    info_dict = await _run_ytdlp("extract", url, ydl_opts)
+    if not info_dict:
+        raise ParseException("获取视频信息失败")
+    return ytdlp_info_cache.put(url, info_dict)
 
 
 async def ytdlp_download_video(url: str, cookiefile: Path | None = None) -> Path:
@@ -80,25 +384,126 @@ async def ytdlp_download_video(url: str, cookiefile: Path | None = None) -> Path
         Path: video file path
     """
     info_dict = await get_video_info(url, cookiefile)
-    duration = int(info_dict.get("duration", 600))
     video_path = plugin_cache_dir / generate_file_name(url, ".mp4")
-    if video_path.exists():
+    cache_manager.hold(video_path)
+    if await cache_manager.lookup(video_path):
         return video_path
-    ydl_opts = {
+    ydl_opts: dict[str, Any] = {
         "outtmpl": f"{video_path}",
         "merge_output_format": "mp4",
-        "format": f"bv[filesize<={duration // 10 + 10}M]+ba/b[filesize<={duration // 8 + 10}M]",
-        "postprocessors": [{"key": "FFmpegVideoConvertor", "preferedformat": "mp4"}],
     } | ydl_download_base_opts
+    if selection := select_format(info_dict, MAX_SIZE * 1024 * 1024):
+        logger.debug(f"yt-dlp 选择格式 {selection.format}, 估算大小 {selection.size / 1024 / 1024:.2f} MB")
+        if YTDLP_NATIVE_DOWNLOAD and selection.compatible:
+            if await _download_native(url, selection.format, video_path, cookiefile):
+                return video_path
+        ydl_opts["format"] = selection.format
+        # h264 + aac 可以直接封装为 mp4，无需转换
+        if not selection.compatible:
+            ydl_opts["postprocessors"] = [{"key": "FFmpegVideoConvertor", "preferedformat": "mp4"}]
+    else:
+        # 没有格式信息时按时长粗略估算
+        duration = int(info_dict.get("duration", 600))
+        ydl_opts["format"] = f"bv[filesize<={duration // 10 + 10}M]+ba/b[filesize<={duration // 8 + 10}M]"
+        ydl_opts["postprocessors"] = [{"key": "FFmpegVideoConvertor", "preferedformat": "mp4"}]
 
     if cookiefile:
         ydl_opts["cookiefile"] = str(cookiefile)
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        await asyncio.to_thread(ydl.download, [url])
+    await _run_ytdlp("download", url, ydl_opts)
     return video_path
 
 
+async def _download_native(url: str, format_spec: str, video_path: Path, cookiefile: Path | None = None) -> bool:
+    """通过插件的下载器下载 https 格式，再只复制流封装为 mp4
+
+    Args:
+        url (str): url address
+        format_spec (str): yt-dlp 的格式，如 137+140
+        video_path (Path): 输出文件路径
+        cookiefile (Path | None, optional): cookie file path. Defaults to None.
+
+    Returns:
+        bool: 是否已下载，格式不是 https 直链时返回 False，交给 yt-dlp 下载
+    """
+    # 精简后的信息不包含签名地址，按选择的格式重新获取
+    ydl_opts = {"format": format_spec} | ydl_extract_base_opts
+    if cookiefile:
+        ydl_opts["cookiefile"] = str(cookiefile)
+    info = await _run_ytdlp("extract", url, ydl_opts)
+    formats: list[dict[str, Any]] = info.get("requested_formats") or [info]
+    if any(fmt.get("protocol") not in ("http", "https") or not fmt.get("url") for fmt in formats):
+        return False
+
+    paths = await asyncio.gather(
+        *[
+            download_file_by_stream(
+                fmt["url"],
+                file_name=f"{video_path.stem}-{fmt['format_id']}.{fmt.get('ext', 'mp4')}",
+                proxy=PROXY,
+                ext_headers=fmt.get("http_headers"),
+            )
+            for fmt in formats
+        ]
+    )
+    if len(paths) == 2:
+        await merge_av(v_path=paths[0], a_path=paths[1], output_path=video_path)
+    else:
+        async with atomic_output(video_path) as tmp_path:
+            cmd = ["ffmpeg", "-y", "-i", str(paths[0]), "-c", "copy", "-movflags", "+faststart", str(tmp_path)]
+            await exec_ffmpeg_cmd(cmd)
+        await cache_manager.discard(paths[0])
+    return True
+
+
+# 各音频格式转换后可能的扩展名
+_AUDIO_SUFFIXES: dict[str, tuple[str, ...]] = {
+    "passthrough": (".opus", ".m4a", ".ogg", ".mp3", ".aac", ".flac"),
+    "opus": (".opus",),
+    "mp3": (".mp3",),
+    "flac": (".flac",),
+}
+# 兜底时不接受的视频扩展名，避免把同一链接缓存的视频当作音频发送
+_VIDEO_SUFFIXES: tuple[str, ...] = (".mp4", ".mkv", ".webm", ".flv", ".mov")
+# 转码时的默认码率和最低码率，单位 kbps
+_AUDIO_BITRATES: dict[str, tuple[int, int]] = {"opus": (96, 24), "mp3": (192, 64)}
+
+
+async def _find_audio(file_name: str, *, any_suffix: bool = False) -> Path | None:
+    """查找已下载的音频文件
+
+    Args:
+        file_name (str): 不含扩展名的文件名
+        any_suffix (bool, optional): 没有预期扩展名的文件时，接受 yt-dlp 产生的其他非视频文件. Defaults to False.
+    """
+
+    def _glob() -> list[Path]:
+        return sorted(path for path in plugin_cache_dir.glob(f"{file_name}.*") if not is_partial(path.name))
+
+    paths = await asyncio.to_thread(_glob)
+    suffixes = _AUDIO_SUFFIXES[YTDLP_AUDIO_FORMAT]
+    if audio_path := next((path for path in paths if path.suffix in suffixes), None):
+        return audio_path
+    if any_suffix:
+        return next((path for path in paths if path.suffix not in _VIDEO_SUFFIXES), None)
+    return None
+
+
+def _audio_postprocessor(duration: float) -> dict[str, Any]:
+    """根据音频格式生成 FFmpegExtractAudio 参数，有损转码时按时长和大小限制计算码率"""
+    if YTDLP_AUDIO_FORMAT == "passthrough":
+        # best 表示不重新编码，按原编码选择容器
+        return {"key": "FFmpegExtractAudio", "preferredcodec": "best"}
+    if YTDLP_AUDIO_FORMAT == "flac":
+        return {"key": "FFmpegExtractAudio", "preferredcodec": "flac", "preferredquality": "0"}
+    bitrate, min_bitrate = _AUDIO_BITRATES[YTDLP_AUDIO_FORMAT]
+    if duration > 0:
+        # 预留 5% 给容器开销
+        budget = int(MAX_SIZE * 1024 * 1024 * 8 / duration / 1000 * 0.95)
+        bitrate = max(min_bitrate, min(bitrate, budget))
+    return {"key": "FFmpegExtractAudio", "preferredcodec": YTDLP_AUDIO_FORMAT, "preferredquality": str(bitrate)}
+
+
 async def ytdlp_download_audio(url: str, cookiefile: Path | None = None) -> Path:
     """download audio by yt-dlp
 
@@ -107,26 +512,27 @@ async def ytdlp_download_audio(url: str, cookiefile: Path | None = None) -> Path
         cookiefile (Path | None, optional): cookie file path. Defaults to None.
 
     Returns:
-        Path: audio file path
+        Path: audio file path，扩展名由 r_ytdlp_audio_format 和原音频编码决定
+
+    Raises:
+        DownloadException: 下载后找不到音频文件
     """
-    file_name = generate_file_name(url)
-    audio_path = plugin_cache_dir / f"{file_name}.flac"
-    if audio_path.exists():
+    # 使用单独的文件名，与同一链接缓存的视频 {hash}.mp4 区分
+    file_name = f"{generate_file_name(url)}.audio"
+    if audio_path := await _find_audio(file_name):
         return audio_path
+    duration = 0.0
+    if YTDLP_AUDIO_FORMAT in _AUDIO_BITRATES:
+        duration = float((await get_video_info(url, cookiefile)).get("duration") or 0)
     ydl_opts = {
         "outtmpl": f"{plugin_cache_dir / file_name}.%(ext)s",
         "format": "bestaudio/best",
-        "postprocessors": [
-            {
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "flac",
-                "preferredquality": "0",
-            }
-        ],
+        "postprocessors": [_audio_postprocessor(duration)],
     } | ydl_download_base_opts
 
     if cookiefile:
         ydl_opts["cookiefile"] = str(cookiefile)
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        await asyncio.to_thread(ydl.download, [url])
-    return audio_path
+    await _run_ytdlp("download", url, ydl_opts)
+    if audio_path := await _find_audio(file_name, any_suffix=True):
+        return audio_path
+    raise DownloadException("音频下载失败，找不到转换后的文件")
@@ -0,0 +1,190 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import json
+from pathlib import Path
+import re
+import time
+from typing import Any
+
+from nonebot import logger
+
+# 可以直接从链接得到内容 id 的平台，key 与 yt-dlp 的 extractor_key 一致
+_URL_KEY_PATTERNS: list[tuple[str, re.Pattern[str]]] = [
+    (
+        "Youtube",
+        re.compile(r"(?:youtu\.be/|youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/|v/))([\w-]{11})"),
+    ),
+    ("TikTok", re.compile(r"tiktok\.com/(?:@[^/]+/video|v|embed(?:/v2)?)/(\d+)")),
+]
+# 签名地址中的过期时间，如 youtube 的 expire=1700000000 或 /expire/1700000000/
+_EXPIRE_RE = re.compile(r"(?:expire|x-expires)[=/](\d{10})")
+# 过期前预留的时间，单位秒
+_EXPIRE_MARGIN = 60
+
+# 保留的字段
+_INFO_FIELDS = ("id", "extractor_key", "title", "duration", "uploader", "thumbnail", "webpage_url")
+_FORMAT_FIELDS = (
+    "format_id",
+    "ext",
+    "protocol",
+    "vcodec",
+    "acodec",
+    "width",
+    "height",
+    "fps",
+    "tbr",
+    "vbr",
+    "abr",
+    "filesize",
+    "filesize_approx",
+)
+
+
+def url_cache_key(url: str) -> str | None:
+    """根据链接得到与 extractor 无关的缓存 key，同一视频的不同链接形式得到相同的 key"""
+    for extractor_key, pattern in _URL_KEY_PATTERNS:
+        if matched := pattern.search(url):
+            return f"{extractor_key}:{matched.group(1)}"
+    return None
+
+
+def _expires_at(info: dict[str, Any], ttl: float) -> float:
+    """缓存过期时间，不晚于签名地址中最早的过期时间"""
+    expires_at = time.time() + ttl
+    urls = [info.get("url"), *(fmt.get("url") for fmt in info.get("formats") or [])]
+    for url in urls:
+        if url and (matched := _EXPIRE_RE.search(url)):
+            expires_at = min(expires_at, int(matched.group(1)) - _EXPIRE_MARGIN)
+    return expires_at
+
+
+def project_info(info: dict[str, Any]) -> dict[str, Any]:
+    """只保留用到的字段，去掉格式地址、缩略图列表、字幕等"""
+    projected = {key: info[key] for key in _INFO_FIELDS if info.get(key) is not None}
+    if formats := info.get("formats"):
+        projected["formats"] = [
+            {key: fmt[key] for key in _FORMAT_FIELDS if fmt.get(key) is not None} for fmt in formats
+        ]
+    return projected
+
+
+@dataclass
+class _InfoEntry:
+    info: dict[str, Any]
+    expires_at: float
+    size: int
+    # 指向该条目的链接
+    urls: list[str] = field(default_factory=list)
+
+
+class InfoCache:
+    """yt-dlp 信息缓存
+
+    以 extractor_key:id 为 key，同一视频的不同链接共用一个条目；只保存精简后的信息，按总字节数淘汰最久未使用的条目。
+    条目在签名地址过期前失效，可以在重启时保存到文件
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, persist_path: Path | None = None):
+        """
+        Args:
+            max_bytes (int): 缓存信息的最大总字节数，按 JSON 长度计算
+            ttl (float): 没有签名地址时的有效时间，单位秒
+            persist_path (Path | None, optional): 持久化文件路径，为 None 时不持久化. Defaults to None.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self._entries: OrderedDict[str, _InfoEntry] = OrderedDict()
+        # 链接到 key 的映射，用于无法从链接得到 id 的平台
+        self._aliases: dict[str, str] = {}
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, url: str) -> dict[str, Any] | None:
+        """查询链接对应的信息，过期时返回 None"""
+        key = url_cache_key(url) or self._aliases.get(url)
+        if key is None or (entry := self._entries.get(key)) is None:
+            return None
+        if entry.expires_at <= time.time():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry.info
+
+    def put(self, url: str, info: dict[str, Any]) -> dict[str, Any]:
+        """缓存 yt-dlp 返回的信息
+
+        Args:
+            url (str): 请求的链接
+            info (dict[str, Any]): yt-dlp 返回的完整信息
+
+        Returns:
+            dict[str, Any]: 精简后的信息
+        """
+        projected = project_info(info)
+        expires_at = _expires_at(info, self.ttl)
+        # 优先使用从链接得到的 key，与查询时一致
+        key = url_cache_key(url)
+        if key is None:
+            key = f"{info['extractor_key']}:{info['id']}" if "id" in info and "extractor_key" in info else url
+        urls = []
+        if old := self._entries.get(key):
+            urls = old.urls
+            self._remove(key)
+        if url not in urls:
+            urls.append(url)
+        self._set(key, _InfoEntry(projected, expires_at, len(json.dumps(projected, ensure_ascii=False)), urls))
+        return projected
+
+    def _set(self, key: str, entry: _InfoEntry) -> None:
+        self._entries[key] = entry
+        self._size += entry.size
+        for url in entry.urls:
+            self._aliases[url] = key
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+        for url in entry.urls:
+            if self._aliases.get(url) == key:
+                del self._aliases[url]
+
+    def load(self) -> None:
+        """从持久化文件读取未过期的条目"""
+        if self.persist_path is None or not self.persist_path.exists():
+            return
+        try:
+            data = json.loads(self.persist_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取 yt-dlp 信息缓存失败: {e}")
+            return
+        now = time.time()
+        for key, item in data.items():
+            if item["expires_at"] > now:
+                info = item["info"]
+                size = len(json.dumps(info, ensure_ascii=False))
+                self._set(key, _InfoEntry(info, item["expires_at"], size, item["urls"]))
+        logger.debug(f"读取 yt-dlp 信息缓存 {len(self._entries)} 条")
+
+    def save(self) -> None:
+        """将未过期的条目写入持久化文件"""
+        if self.persist_path is None:
+            return
+        now = time.time()
+        data = {
+            key: {"info": entry.info, "expires_at": entry.expires_at, "urls": entry.urls}
+            for key, entry in self._entries.items()
+            if entry.expires_at > now
+        }
+        try:
+            self.persist_path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        except OSError as e:
+            logger.warning(f"保存 yt-dlp 信息缓存失败: {e}")
@@ -0,0 +1,62 @@
+"""yt-dlp 工作进程
+
+作为独立脚本运行，不导入插件的其他模块，启动时预先导入 yt_dlp。
+从 stdin 逐行读取 JSON 任务，向原 stdout 逐行写入 JSON 结果；
+yt-dlp 自身的输出被重定向到 stderr，不会干扰结果
+"""
+
+import json
+import os
+from pathlib import Path
+import sys
+from typing import Any
+
+
+def run_job(action: str, url: str, opts: dict[str, Any]) -> Any:
+    """执行 yt-dlp 任务
+
+    Args:
+        action (str): extract 获取信息，download 下载
+        url (str): url address
+        opts (dict[str, Any]): YoutubeDL 参数
+
+    Returns:
+        Any: extract 返回可 JSON 序列化的信息字典，download 返回 yt-dlp 的返回码
+    """
+    import yt_dlp
+
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        if action == "extract":
+            return ydl.sanitize_info(ydl.extract_info(url, download=False))
+        if action == "download":
+            return ydl.download([url])
+    raise ValueError(f"未知的任务类型: {action}")
+
+
+def main() -> None:
+    # 作为脚本运行时脚本所在目录位于 sys.path 开头，其中的 utils.py 等模块会遮蔽同名的第三方模块
+    script_dir = Path(__file__).resolve().parent
+    sys.path = [path for path in sys.path if Path(path or ".").resolve() != script_dir]
+    # 预先导入，任务到达时无需等待
+    import yt_dlp  # noqa: F401
+
+    # 结果通道使用原 stdout，之后的 print 输出到 stderr
+    result_out = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    def reply(message: dict[str, Any]) -> None:
+        result_out.write(json.dumps(message, ensure_ascii=False) + "\n")
+        result_out.flush()
+
+    reply({"ready": True})
+    for line in sys.stdin:
+        job = json.loads(line)
+        try:
+            reply({"ok": True, "result": run_job(job["action"], job["url"], job["opts"])})
+        except Exception as e:
+            reply({"ok": False, "error": f"{type(e).__name__}: {e}"})
+
+
+if __name__ == "__main__":
+    main()
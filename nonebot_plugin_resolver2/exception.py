@@ -10,6 +10,13 @@ class DownloadException(Exception):
     pass
 
 
+class DownloadSizeLimitException(DownloadException):
+    """资源大小超过配置限制"""
+
+    def __init__(self, message: str = "音视频流大小超过配置限制，取消下载"):
+        super().__init__(message)
+
+
 class ParseException(Exception):
     """解析异常"""
 
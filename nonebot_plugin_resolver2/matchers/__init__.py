@@ -1,25 +1,29 @@
+from importlib import import_module
+from typing import get_args
+
+from nonebot import logger
 from nonebot.matcher import Matcher
 
-from .acfun import acfun
-from .bilibili import bilibili
-from .douyin import douyin
-from .kugou import kugou
-from .ncm import ncm
-from .tiktok import tiktok
-from .twitter import twitter
-from .weibo import weibo
-from .xiaohongshu import xiaohongshu
-from .ytb import ytb
-
-resolvers: dict[str, type[Matcher]] = {
-    "bilibili": bilibili,
-    "acfun": acfun,
-    "douyin": douyin,
-    "ytb": ytb,
-    "kugou": kugou,
-    "ncm": ncm,
-    "twitter": twitter,
-    "tiktok": tiktok,
-    "weibo": weibo,
-    "xiaohongshu": xiaohongshu,
-}
+from ..config import MatcherNames, rconfig
+
+
+def _load_resolvers() -> dict[str, type[Matcher]]:
+    """只导入启用的解析器，被禁用的解析器及其依赖不会被导入
+
+    每个解析器模块中定义与模块同名的 matcher
+    """
+    disabled: list[str] = list(rconfig.r_disable_resolvers)
+    if not rconfig.r_xhs_ck and "xiaohongshu" not in disabled:
+        logger.warning("未配置小红书 cookie, 小红书解析已关闭")
+        disabled.append("xiaohongshu")
+    if disabled:
+        logger.warning(f"已关闭解析: {', '.join(disabled)}")
+
+    loaded: dict[str, type[Matcher]] = {}
+    for name in get_args(MatcherNames):
+        if name not in disabled:
+            loaded[name] = getattr(import_module(f".{name}", __name__), name)
+    return loaded
+
+
+resolvers: dict[str, type[Matcher]] = _load_resolvers()
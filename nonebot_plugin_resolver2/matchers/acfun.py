@@ -27,4 +27,4 @@ async def _(event: MessageEvent) -> None:
     await acfun.send(f"{NICKNAME}解析 | 猴山 - {video_desc}")
 
     video_file = await download_acfun_video(m3u8s_url, acid)
-    await acfun.send(get_video_seg(video_file))
+    await acfun.send(await get_video_seg(video_file))
@@ -1,24 +1,29 @@
 import asyncio
+import os
 from pathlib import Path
 import re
 
-import aiohttp
-from bilibili_api import HEADERS
 from nonebot import logger, on_command, on_message
 from nonebot.adapters.onebot.v11 import Bot, Message, MessageEvent, MessageSegment
 from nonebot.adapters.onebot.v11.exception import ActionFailed
 from nonebot.params import CommandArg
 
-from ..config import DURATION_MAXIMUM, NEED_UPLOAD, NICKNAME, plugin_cache_dir
+from ..client import get_session
+from ..config import BILI_STREAM_MERGE, DURATION_MAXIMUM, NEED_UPLOAD, NICKNAME, PREVIEW_DURATION, plugin_cache_dir
+from ..constant import BILIBILI_HEADER
 from ..download import (
     download_file_by_stream,
     download_img,
     download_imgs_without_raise,
     encode_video_to_h264,
     merge_av,
+    merge_av_stream,
+    repair_video,
 )
+from ..download.cache import cache_manager
+from ..download.preview import download_dash_preview
 from ..download.utils import keep_zh_en_num
-from ..exception import handle_exception
+from ..exception import DownloadSizeLimitException, handle_exception
 from ..parsers.bilibili import (
     parse_favlist,
     parse_live,
@@ -61,9 +66,8 @@ async def _(text: str = ExtractText(), keyword: str = Keyword()):
     # 短链重定向地址
     if keyword in ("b23", "bili2233"):
         b23url = url
-        async with aiohttp.ClientSession() as session:
-            async with session.get(b23url, headers=HEADERS, allow_redirects=False) as resp:
-                url = resp.headers.get("Location", b23url)
+        async with get_session().get(b23url, headers=BILIBILI_HEADER, allow_redirects=False) as resp:
+            url = resp.headers.get("Location", b23url)
         if url == b23url:
             logger.info(f"链接 {url} 无效，忽略")
             return
@@ -89,7 +93,7 @@ async def _(text: str = ExtractText(), keyword: str = Keyword()):
             segs = [text]
             if img_lst:
                 paths = await download_imgs_without_raise(img_lst)
-                segs.extend(get_img_seg(path) for path in paths)
+                segs.extend([await get_img_seg(path) for path in paths])
             await send_segments(segs)
             await bilibili.finish()
         # 直播间解析
@@ -104,8 +108,8 @@ async def _(text: str = ExtractText(), keyword: str = Keyword()):
             if not title:
                 await bilibili.finish(f"{share_prefix}直播 - 未找到直播间信息")
             res = f"{share_prefix}直播 {title}"
-            res += get_img_seg(await download_img(cover)) if cover else ""
-            res += get_img_seg(await download_img(keyframe)) if keyframe else ""
+            res += await get_img_seg(await download_img(cover)) if cover else ""
+            res += await get_img_seg(await download_img(keyframe)) if keyframe else ""
             await bilibili.finish(res)
         # 专栏解析
         elif "/read" in url:
@@ -125,7 +129,7 @@ async def _(text: str = ExtractText(), keyword: str = Keyword()):
                 if text:
                     segs.append(text)
                 else:
-                    segs.append(get_img_seg(paths.pop()))
+                    segs.append(await get_img_seg(paths.pop()))
             if segs:
                 await send_segments(segs)
                 await bilibili.finish()
@@ -144,7 +148,7 @@ async def _(text: str = ExtractText(), keyword: str = Keyword()):
             segs = []
             # 组合 text 和 image
             for path, text in zip(paths, texts):
-                segs.append(get_img_seg(path) + text)
+                segs.append(await get_img_seg(path) + text)
             await send_segments(segs)
             await bilibili.finish()
         else:
@@ -164,7 +168,7 @@ async def _(text: str = ExtractText(), keyword: str = Keyword()):
 
     segs = [
         video_info.title,
-        get_img_seg(await download_img(video_info.cover_url)),
+        await get_img_seg(await download_img(video_info.cover_url)),
         video_info.display_info,
         video_info.ai_summary,
     ]
@@ -175,36 +179,74 @@ async def _(text: str = ExtractText(), keyword: str = Keyword()):
     #    )
     await send_segments(segs)
 
-    if video_info.video_duration > DURATION_MAXIMUM:
-        logger.info(f"video duration > {DURATION_MAXIMUM}, ignore download")
-        return
-    # 下载视频和音频
     file_name_prefix = f"{video_id}-{page_num}"
-    video_path = plugin_cache_dir / f"{file_name_prefix}.mp4"
-
-    if not video_path.exists():
-        # 下载视频和音频
-        v_path, a_path = await asyncio.gather(
-            download_file_by_stream(
-                video_info.video_url, file_name=f"{file_name_prefix}-video.m4s", ext_headers=HEADERS
-            ),
-            download_file_by_stream(
-                video_info.audio_url, file_name=f"{file_name_prefix}-audio.m4s", ext_headers=HEADERS
-            ),
+    if video_info.video_duration > DURATION_MAXIMUM:
+        if not (PREVIEW_DURATION and video_info.video_index_range and video_info.audio_index_range):
+            logger.info(f"video duration > {DURATION_MAXIMUM}, ignore download")
+            return
+        # 只下载开头的分段作为预览
+        logger.info(f"video duration > {DURATION_MAXIMUM}, download {PREVIEW_DURATION}s preview")
+        preview_path = await download_dash_preview(
+            v_url=video_info.video_url,
+            v_index_range=video_info.video_index_range,
+            a_url=video_info.audio_url,
+            a_index_range=video_info.audio_index_range,
+            output_path=plugin_cache_dir / f"{file_name_prefix}_preview.mp4",
+            ext_headers=BILIBILI_HEADER,
         )
-        await merge_av(v_path=v_path, a_path=a_path, output_path=video_path)
+        await bilibili.send(f"视频时长超过 {DURATION_MAXIMUM // 60} 分钟, 仅发送前 {PREVIEW_DURATION} 秒预览")
+        await bilibili.finish(await get_video_seg(preview_path))
+    # 下载视频和音频
+    content_id = f"bilibili:{file_name_prefix}"
+    video_path = cache_manager.find(content_id) or plugin_cache_dir / f"{file_name_prefix}.mp4"
+
+    if not await cache_manager.lookup(video_path):
+        await download_and_merge(video_info.video_url, video_info.audio_url, file_name_prefix, video_path)
+        await cache_manager.add(video_path, content_type="video/mp4", content_id=content_id)
     # 发送视频
     try:
-        await bilibili.send(get_video_seg(video_path))
+        await bilibili.send(await get_video_seg(video_path))
     except ActionFailed as e:
-        message: str = e.info.get("message", "")
-        # 无缩略图
-        if not message.endswith(".png'"):
+        if not _is_thumbnail_error(e):
             raise
-        # 重新编码为 h264
-        logger.warning("视频上传出现无缩略图错误，将重新编码为 h264 进行上传")
+        logger.warning("视频上传出现无缩略图错误，将重新封装并生成缩略图后上传")
+        try:
+            fixed_path, thumb_path = await repair_video(video_path)
+            await bilibili.send(await get_video_seg(fixed_path, thumb=thumb_path))
+            return
+        except ActionFailed as e:
+            # 已是 h264 编码时重新编码无济于事
+            if not _is_thumbnail_error(e) or video_info.video_codec == "avc":
+                raise
+        except RuntimeError as e:
+            logger.warning(f"视频重新封装失败: {e}")
+        # 没有可用的 h264 视频流，重新编码为 h264
+        logger.warning(f"视频编码为 {video_info.video_codec}, 将重新编码为 h264 进行上传")
         h264_video_path = await encode_video_to_h264(video_path)
-        await bilibili.send(get_video_seg(h264_video_path))
+        await bilibili.send(await get_video_seg(h264_video_path))
+
+
+def _is_thumbnail_error(e: ActionFailed) -> bool:
+    """上传视频时出现的无缩略图错误"""
+    message: str = e.info.get("message", "")
+    return message.endswith(".png'")
+
+
+async def download_and_merge(video_url: str, audio_url: str, file_name_prefix: str, video_path: Path) -> None:
+    """下载并合并音视频，优先边下载边合并，失败时回退为下载临时文件后合并"""
+    if BILI_STREAM_MERGE and os.name != "nt":
+        try:
+            await merge_av_stream(v_url=video_url, a_url=audio_url, output_path=video_path, ext_headers=BILIBILI_HEADER)
+            return
+        except DownloadSizeLimitException:
+            raise
+        except Exception as e:
+            logger.warning(f"{file_name_prefix} 流式合并失败({e!r})，回退为下载后合并")
+    v_path, a_path = await asyncio.gather(
+        download_file_by_stream(video_url, file_name=f"{file_name_prefix}-video.m4s", ext_headers=BILIBILI_HEADER),
+        download_file_by_stream(audio_url, file_name=f"{file_name_prefix}-audio.m4s", ext_headers=BILIBILI_HEADER),
+    )
+    await merge_av(v_path=v_path, a_path=a_path, output_path=video_path)
 
 
 @bili_music.handle()
@@ -227,10 +269,10 @@ async def _(bot: Bot, event: MessageEvent, args: Message = CommandArg()):
     audio_path = plugin_cache_dir / audio_name
     # 下载
     if not audio_path.exists():
-        await download_file_by_stream(video_info.audio_url, file_name=audio_name, ext_headers=HEADERS)
+        await download_file_by_stream(video_info.audio_url, file_name=audio_name, ext_headers=BILIBILI_HEADER)
 
     # 发送音频
-    await bili_music.send(get_record_seg(audio_path))
+    await bili_music.send(await get_record_seg(audio_path))
     # 上传音频
     if NEED_UPLOAD:
-        await bili_music.send(get_file_seg(audio_path))
+        await bili_music.send(await get_file_seg(audio_path))
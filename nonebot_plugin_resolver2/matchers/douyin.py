@@ -6,8 +6,9 @@ from nonebot import logger, on_keyword
 from nonebot.adapters.onebot.v11 import Message, MessageEvent, MessageSegment
 from nonebot.rule import Rule
 
-from ..config import NICKNAME
+from ..config import NICKNAME, PREVIEW_DURATION
 from ..download import download_imgs_without_raise, download_video
+from ..download.preview import download_video_or_preview
 from ..exception import handle_exception
 from ..parsers.base import VideoInfo
 from ..parsers.douyin import DouYin
@@ -38,18 +39,20 @@ async def _(event: MessageEvent):
     # 存在普通图片
     if video_info.images:
         paths: list[Path] = await download_imgs_without_raise(video_info.images)
-        segs.extend(get_img_seg(path) for path in paths)
+        segs.extend([await get_img_seg(path) for path in paths])
     # 存在动态图片
     if video_info.dynamic_images:
         # 并发下载动态图片
         video_download_tasks = [asyncio.create_task(download_video(url)) for url in video_info.dynamic_images]
         video_download_results = await asyncio.gather(*video_download_tasks, return_exceptions=True)
-        video_seg_lst = [get_video_seg(seg) for seg in video_download_results if isinstance(seg, Path)]
+        video_seg_lst = [await get_video_seg(seg) for seg in video_download_results if isinstance(seg, Path)]
         segs.extend(video_seg_lst)
     if segs:
         await send_segments(segs)
         await douyin.finish()
     # 存在视频
     if video_url := video_info.video_url:
-        video_path = await download_video(video_url)
-        await douyin.finish(get_video_seg(video_path))
+        video_path, is_preview = await download_video_or_preview(video_url)
+        if is_preview:
+            await douyin.send(f"视频大小超过限制, 仅发送前 {PREVIEW_DURATION} 秒预览")
+        await douyin.finish(await get_video_seg(video_path))
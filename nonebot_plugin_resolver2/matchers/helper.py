@@ -1,12 +1,19 @@
+import asyncio
+import base64
 from pathlib import Path
 from typing import Any, cast
 
+import aiofiles.os
+from nonebot import logger
 from nonebot.adapters.onebot.utils import f2s
 from nonebot.adapters.onebot.v11 import GroupMessageEvent, Message, MessageEvent, MessageSegment
-from nonebot.internal.matcher import current_bot, current_event
+from nonebot.internal.matcher import current_bot, current_event, current_matcher
 
-from ..config import NEED_FORWARD, NICKNAME, USE_BASE64
-from ..constant import VIDEO_MAX_MB
+from ..config import NEED_FORWARD, NICKNAME, USE_BASE64, VIDEO_FIT_SIZE
+from ..constant import BASE64_MAX_INFLIGHT_MB, VIDEO_MAX_MB
+from ..download import fit_video_to_size
+from ..download.cache import cache_manager
+from ..server import media_server
 
 
 def construct_nodes(user_id: int, segments: list[Message | MessageSegment | str]) -> Message:
@@ -51,7 +58,102 @@ async def send_segments(segments: list[Message | MessageSegment | str]) -> None:
         await bot.send(event, message=message)
 
 
-def get_img_seg(img_path: Path) -> MessageSegment:
+class _ByteBudget:
+    """限制待发送的 base64 字符串占用的内存
+
+    base64 字符串保存在消息段中直到消息发送完成，预留在 handler 结束后才释放。
+    已持有预留的 handler 不再等待，避免两个 handler 互相等待对方释放，
+    因此预算限制的是同时开始编码的 handler，单个 handler 可以超出预算
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._used = 0
+        self._cond = asyncio.Condition()
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    async def acquire(self, size: int, *, holding: bool = False) -> None:
+        """预留内存
+
+        Args:
+            size (int): 字节数
+            holding (bool, optional): 调用者是否已持有预留，为 True 时不等待. Defaults to False.
+        """
+        async with self._cond:
+            if not holding:
+                # 单个文件超过上限时，等待其他预留释放后独占
+                await self._cond.wait_for(lambda: self._used == 0 or self._used + size <= self.limit)
+            self._used += size
+
+    async def release(self, size: int) -> None:
+        """释放预留"""
+        async with self._cond:
+            self._used -= size
+            self._cond.notify_all()
+
+
+_base64_budget = _ByteBudget(BASE64_MAX_INFLIGHT_MB * 1024 * 1024)
+# matcher state 中记录当前 handler 预留的 base64 内存
+_BASE64_KEY = "_r_base64_reserved"
+# 每次读取的字节数，为 3 的倍数，各块编码结果可以直接拼接
+_BASE64_CHUNK = 3 * 1024 * 1024
+
+
+def _encode_base64(path: Path) -> str:
+    """分块读取文件并编码为 base64:// 字符串，不在内存中保留原始文件"""
+    prefix = b"base64://"
+    size = path.stat().st_size
+    buffer = bytearray(len(prefix) + (size + 2) // 3 * 4)
+    buffer[: len(prefix)] = prefix
+    pos = len(prefix)
+    with path.open("rb") as f:
+        while chunk := f.read(_BASE64_CHUNK):
+            encoded = base64.b64encode(chunk)
+            buffer[pos : pos + len(encoded)] = encoded
+            pos += len(encoded)
+    del buffer[pos:]
+    return buffer.decode("ascii")
+
+
+async def _file_ref(path: Path) -> Path | str:
+    """获取发送文件时使用的引用，在当前 handler 结束前固定文件
+
+    启用媒体文件服务时返回签名 url；使用 base64 时在线程中编码，
+    编码缓冲区和结果字符串计入内存预算，在 handler 结束、消息发送完成后由 release_base64 释放
+    """
+    cache_manager.hold(path)
+    if media_server.enabled:
+        return media_server.url_for(path)
+    if not USE_BASE64:
+        return path
+    size = (await aiofiles.os.stat(path)).st_size
+    reserved = (size + 2) // 3 * 4 * 2
+    matcher = current_matcher.get(None)
+    state = matcher.state if matcher else None
+    await _base64_budget.acquire(reserved, holding=bool(state and state.get(_BASE64_KEY)))
+    try:
+        encoded = await asyncio.to_thread(_encode_base64, path)
+    except BaseException:
+        await _base64_budget.release(reserved)
+        raise
+    if state is None:
+        # 不在 handler 中调用时无法得知何时发送完成，编码后立即释放
+        await _base64_budget.release(reserved)
+    else:
+        state[_BASE64_KEY] = state.get(_BASE64_KEY, 0) + reserved
+    return encoded
+
+
+async def release_base64(state: dict) -> None:
+    """释放 handler 中 base64 编码结果占用的内存预算"""
+    if reserved := state.pop(_BASE64_KEY, 0):
+        await _base64_budget.release(reserved)
+
+
+async def get_img_seg(img_path: Path) -> MessageSegment:
     """获取图片 Seg
 
     Args:
@@ -60,11 +162,10 @@ def get_img_seg(img_path: Path) -> MessageSegment:
     Returns:
         MessageSegment: 图片 Seg
     """
-    file = img_path.read_bytes() if USE_BASE64 else img_path
-    return MessageSegment.image(file)
+    return MessageSegment.image(await _file_ref(img_path))
 
 
-def get_record_seg(audio_path: Path) -> MessageSegment:
+async def get_record_seg(audio_path: Path) -> MessageSegment:
     """获取语音 Seg
 
     Args:
@@ -73,50 +174,55 @@ def get_record_seg(audio_path: Path) -> MessageSegment:
     Returns:
         MessageSegment: 语音 Seg
     """
-    file = audio_path.read_bytes() if USE_BASE64 else audio_path
-    return MessageSegment.record(file)
+    return MessageSegment.record(await _file_ref(audio_path))
 
 
-def get_video_seg(video_path: Path) -> MessageSegment:
+async def get_video_seg(video_path: Path, thumb: Path | None = None) -> MessageSegment:
     """获取视频 Seg
 
+    Args:
+        video_path (Path): 视频路径
+        thumb (Path | None, optional): 缩略图路径. Defaults to None.
+
     Returns:
         MessageSegment: 视频 Seg
     """
-    seg: MessageSegment
-    # 检测文件大小
-    file_size_byte_count = int(video_path.stat().st_size)
-    file = video_path.read_bytes() if USE_BASE64 else video_path
+    cache_manager.hold(video_path)
+    # 先检测文件大小，确定消息段类型后再读取文件
+    file_size_byte_count = (await aiofiles.os.stat(video_path)).st_size
     if file_size_byte_count == 0:
-        seg = MessageSegment.text("视频文件大小为0")
-    elif file_size_byte_count > VIDEO_MAX_MB * 1024 * 1024:
-        # 转为文件 Seg
-        seg = get_file_seg(file, display_name=video_path.name)
-    else:
-        seg = MessageSegment.video(file)
+        return MessageSegment.text("视频文件大小为0")
+    if file_size_byte_count > VIDEO_MAX_MB * 1024 * 1024:
+        if not VIDEO_FIT_SIZE:
+            # 转为文件 Seg
+            return await get_file_seg(video_path)
+        try:
+            video_path = await fit_video_to_size(video_path, VIDEO_MAX_MB * 1024 * 1024)
+            thumb = None
+        except RuntimeError as e:
+            logger.warning(f"视频压缩失败, 将以文件形式发送: {e}")
+            return await get_file_seg(video_path)
+    seg = MessageSegment.video(await _file_ref(video_path))
+    if thumb:
+        seg.data["thumb"] = f2s(await _file_ref(thumb))
     return seg
 
 
-def get_file_seg(file: Path | bytes, display_name: str = "") -> MessageSegment:
+async def get_file_seg(file: Path, display_name: str = "") -> MessageSegment:
     """获取文件 Seg
 
     Args:
-        file (Path | bytes): 文件路径
+        file (Path): 文件路径
         display_name (str, optional): 显示名称. Defaults to file.name.
 
     Returns:
         MessageSegment: 文件 Seg
     """
-    if not display_name and isinstance(file, Path):
-        display_name = file.name
-    if not display_name:
-        raise ValueError("文件名不能为空")
-    if USE_BASE64:
-        file = file.read_bytes() if isinstance(file, Path) else file
+    display_name = display_name or file.name
     return MessageSegment(
         "file",
         data={
             "name": display_name,
-            "file": f2s(file),
+            "file": f2s(await _file_ref(file)),
         },
     )
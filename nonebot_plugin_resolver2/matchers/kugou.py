@@ -30,12 +30,12 @@ async def _(text: str = ExtractText()):
 
     title_author_name = f"{video_info.title} - {video_info.author.name}"
 
-    await kugou.send(f"{share_prefix}{title_author_name}" + get_img_seg(await download_img(video_info.cover_url)))
+    await kugou.send(f"{share_prefix}{title_author_name}" + await get_img_seg(await download_img(video_info.cover_url)))
 
     audio_path = await download_audio(url=video_info.music_url)
     # 发送语音
-    await kugou.send(get_record_seg(audio_path))
+    await kugou.send(await get_record_seg(audio_path))
     # 发送群文件
     if NEED_UPLOAD:
         filename = f"{keep_zh_en_num(title_author_name)}.flac"
-        await kugou.finish(get_file_seg(audio_path, filename))
+        await kugou.finish(await get_file_seg(audio_path, filename))
@@ -1,8 +1,8 @@
 import re
 
-import aiohttp
 from nonebot import logger, on_message
 
+from ..client import get_session
 from ..config import NEED_UPLOAD, NICKNAME
 from ..constant import COMMON_HEADER
 from ..download import download_audio, download_img
@@ -30,9 +30,8 @@ async def _(text: str = ExtractText(), keyword: str = Keyword()):
     if keyword == "163cn.tv":
         if match := re.search(r"(http:|https:)\/\/163cn\.tv\/([a-zA-Z0-9]+)", text):
             url = match.group(0)
-            async with aiohttp.ClientSession() as session:
-                async with session.head(url, allow_redirects=False) as resp:
-                    url = resp.headers.get("Location", "")
+            async with get_session().head(url, allow_redirects=False) as resp:
+                url = resp.headers.get("Location", "")
     else:
         url = text
     matched = re.search(r"id=(\d+)", url)
@@ -43,23 +42,22 @@ async def _(text: str = ExtractText(), keyword: str = Keyword()):
 
     # 对接临时接口
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{NETEASE_TEMP_API.replace('{}', ncm_id)}", headers=COMMON_HEADER) as resp:
-                resp.raise_for_status()
-                ncm_vip_data = await resp.json()
+        async with get_session().get(f"{NETEASE_TEMP_API.replace('{}', ncm_id)}", headers=COMMON_HEADER) as resp:
+            resp.raise_for_status()
+            ncm_vip_data = await resp.json()
         ncm_music_url, ncm_cover, ncm_singer, ncm_title = (
             ncm_vip_data.get(key) for key in ["music_url", "cover", "singer", "title"]
         )
     except Exception as e:
         await ncm.send(f"{share_prefix}错误: {e}")
         raise
-    await ncm.send(f"{share_prefix}{ncm_title} {ncm_singer}" + get_img_seg(await download_img(ncm_cover)))
+    await ncm.send(f"{share_prefix}{ncm_title} {ncm_singer}" + await get_img_seg(await download_img(ncm_cover)))
     # 下载音频文件后会返回一个下载路径
     audio_path = await download_audio(ncm_music_url)
     # 发送语音
-    await ncm.send(get_record_seg(audio_path))
+    await ncm.send(await get_record_seg(audio_path))
     # 发送群文件
     if NEED_UPLOAD:
         file_name = keep_zh_en_num(f"{ncm_title}-{ncm_singer}")
         file_name = f"{file_name}.flac"
-        await ncm.send(get_file_seg(audio_path, file_name))
+        await ncm.send(await get_file_seg(audio_path, file_name))
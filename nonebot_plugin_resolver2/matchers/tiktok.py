@@ -1,10 +1,10 @@
 import re
 
-import aiohttp
 from nonebot import logger, on_keyword
 from nonebot.adapters.onebot.v11 import MessageEvent
 from nonebot.rule import Rule
 
+from ..client import get_session
 from ..config import NICKNAME, PROXY
 from ..download.ytdlp import get_video_info, ytdlp_download_video
 from ..exception import handle_exception
@@ -29,9 +29,8 @@ async def _(event: MessageEvent):
 
     # 如果 prefix 是 vt 或 vm，则需要重定向
     if prefix == "vt" or prefix == "vm":
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, allow_redirects=False, proxy=PROXY) as resp:
-                url = resp.headers.get("Location")
+        async with get_session(proxy=PROXY).get(url, allow_redirects=False, proxy=PROXY) as resp:
+            url = resp.headers.get("Location")
 
     pub_prefix = f"{NICKNAME}解析 | TikTok - "
     if not url:
@@ -46,4 +45,4 @@ async def _(event: MessageEvent):
     except Exception as e:
         await tiktok.finish(f"{pub_prefix}下载视频失败 {e}")
 
-    await tiktok.send(get_video_seg(video_path))
+    await tiktok.send(await get_video_seg(video_path))
@@ -1,14 +1,15 @@
 import re
 from typing import Any
 
-import aiohttp
 from nonebot import logger, on_keyword
 from nonebot.adapters.onebot.v11 import MessageEvent
 from nonebot.rule import Rule
 
-from ..config import NICKNAME, PROXY
+from ..client import get_session
+from ..config import NICKNAME, PREVIEW_DURATION, PROXY
 from ..constant import COMMON_HEADER
-from ..download import download_img, download_video
+from ..download import download_img
+from ..download.preview import download_video_or_preview
 from ..exception import ParseException, handle_exception
 from .filter import is_not_in_disabled_groups
 from .helper import get_img_seg, get_video_seg
@@ -32,12 +33,14 @@ async def _(event: MessageEvent):
     video_url, pic_url = await parse_x_url(x_url)
     # 下载视频
     if video_url:
-        video_path = await download_video(url=video_url, proxy=PROXY)
-        await twitter.send(get_video_seg(video_path))
+        video_path, is_preview = await download_video_or_preview(video_url, proxy=PROXY)
+        if is_preview:
+            await twitter.send(f"视频大小超过限制, 仅发送前 {PREVIEW_DURATION} 秒预览")
+        await twitter.send(await get_video_seg(video_path))
     # 下载图片
     if pic_url:
         img_path = await download_img(url=pic_url, proxy=PROXY)
-        await twitter.send(get_img_seg(img_path))
+        await twitter.send(await get_img_seg(img_path))
 
 
 async def parse_x_url(x_url: str) -> tuple[str, str]:
@@ -55,9 +58,8 @@ async def parse_x_url(x_url: str) -> tuple[str, str]:
             "Sec-Fetch-User": "?1",
             **COMMON_HEADER,
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                return await response.json()
+        async with get_session().get(url, headers=headers) as response:
+            return await response.json()
 
     resp = await x_req(x_url)
     if resp.get("code") == 0:
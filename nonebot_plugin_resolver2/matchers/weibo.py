@@ -2,8 +2,9 @@ from nonebot import on_keyword
 from nonebot.adapters.onebot.v11 import MessageEvent
 from nonebot.rule import Rule
 
-from ..config import NICKNAME
-from ..download import download_imgs_without_raise, download_video
+from ..config import NICKNAME, PREVIEW_DURATION
+from ..download import download_imgs_without_raise
+from ..download.preview import download_video_or_preview
 from ..exception import handle_exception
 from ..parsers.weibo import WeiBo
 from .filter import is_not_in_disabled_groups
@@ -28,9 +29,11 @@ async def _(event: MessageEvent):
 
     await weibo.send(f"{pub_prefix}{video_info.title} - {video_info.author.name}")
     if video_info.video_url:
-        video_path = await download_video(video_info.video_url, ext_headers=ext_headers)
-        await weibo.finish(get_video_seg(video_path))
+        video_path, is_preview = await download_video_or_preview(video_info.video_url, ext_headers=ext_headers)
+        if is_preview:
+            await weibo.send(f"视频大小超过限制, 仅发送前 {PREVIEW_DURATION} 秒预览")
+        await weibo.finish(await get_video_seg(video_path))
     if video_info.images:
         image_paths = await download_imgs_without_raise(video_info.images, ext_headers=ext_headers)
         if image_paths:
-            await send_segments([get_img_seg(path) for path in image_paths])
+            await send_segments([await get_img_seg(path) for path in image_paths])
@@ -3,8 +3,9 @@ import re
 from nonebot import logger, on_message
 from nonebot.adapters.onebot.v11 import Message, MessageSegment
 
-from ..config import NICKNAME
-from ..download import download_imgs_without_raise, download_video
+from ..config import NICKNAME, PREVIEW_DURATION
+from ..download import download_imgs_without_raise
+from ..download.preview import download_video_or_preview
 from ..exception import handle_exception
 from ..parsers.xiaohongshu import parse_url
 from .filter import is_not_in_disabled_groups
@@ -33,11 +34,13 @@ async def _(text: str = ExtractText()):
         # 发送图片
         segs: list[MessageSegment | Message | str] = [
             title_desc,
-            *(get_img_seg(img_path) for img_path in img_path_list),
+            *[await get_img_seg(img_path) for img_path in img_path_list],
         ]
         await send_segments(segs)
     # 如果是视频
     elif video_url:
         await xiaohongshu.send(f"{NICKNAME}解析 | 小红书 - 视频 - {title_desc}")
-        video_path = await download_video(video_url)
-        await xiaohongshu.finish(get_video_seg(video_path))
+        video_path, is_preview = await download_video_or_preview(video_url)
+        if is_preview:
+            await xiaohongshu.send(f"视频大小超过限制, 仅发送前 {PREVIEW_DURATION} 秒预览")
+        await xiaohongshu.finish(await get_video_seg(video_path))
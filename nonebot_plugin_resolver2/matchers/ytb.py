@@ -75,9 +75,9 @@ async def _(
         await ytb.finish(f"{media_type}下载失败", reply_message=True)
     # 发送视频或音频
     if video_path:
-        await ytb.send(get_video_seg(video_path))
+        await ytb.send(await get_video_seg(video_path))
     elif audio_path:
-        await ytb.send(get_record_seg(audio_path))
+        await ytb.send(await get_record_seg(audio_path))
         if NEED_UPLOAD:
-            file_name = f"{keep_zh_en_num(title)}.flac"
-            await ytb.send(get_file_seg(audio_path, file_name))
+            file_name = f"{keep_zh_en_num(title)}{audio_path.suffix}"
+            await ytb.send(await get_file_seg(audio_path, file_name))
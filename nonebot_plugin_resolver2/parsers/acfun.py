@@ -1,14 +1,17 @@
-import asyncio
+from dataclasses import dataclass
 import json
 from pathlib import Path
 import re
+from typing import Any
 
-import aiofiles
-import aiohttp
+from nonebot import logger
 
+from ..client import get_session
 from ..config import MAX_SIZE, plugin_cache_dir
-from ..download.utils import safe_unlink
-from ..exception import DownloadException, ParseException
+from ..download.cache import cache_manager
+from ..download.hls import download_hls, fetch_m3u8
+from ..download.telemetry import download_telemetry
+from ..exception import ParseException
 
 ACFUN_HEADERS = {
     "referer": "https://www.acfun.cn/",
@@ -16,6 +19,52 @@ ACFUN_HEADERS = {
 }
 
 
+@dataclass
+class AcfunRepresentation:
+    """ksPlay 中的一路码流"""
+
+    url: str
+    quality: str
+    height: int
+    # 平均码率，单位 kbps，未知时为 0
+    bitrate: int
+
+    def estimate_size(self, duration: float) -> int | None:
+        """按平均码率估算大小，单位字节，码率未知时返回 None"""
+        return int(self.bitrate * 1000 / 8 * duration) if self.bitrate else None
+
+
+def _parse_representations(ks_play: dict[str, Any]) -> list[AcfunRepresentation]:
+    """解析 ksPlay 中的码流，按画质从高到低排列"""
+    representations = [
+        AcfunRepresentation(
+            url=item["url"],
+            quality=item.get("qualityLabel") or item.get("qualityType") or f"{item.get('height', 0)}p",
+            height=int(item.get("height") or 0),
+            bitrate=int(item.get("avgBitrate") or item.get("maxBitrate") or 0),
+        )
+        for adaptation in ks_play.get("adaptationSet", [])
+        for item in adaptation.get("representation", [])
+        if item.get("url")
+    ]
+    representations.sort(key=lambda rep: (rep.height, rep.bitrate), reverse=True)
+    return representations
+
+
+def _select_representation(
+    representations: list[AcfunRepresentation], duration: float, max_size: int
+) -> AcfunRepresentation:
+    """选择估算大小不超过 max_size 的最高画质，都超过时选择码率最低的，码率都未知时选择画质最低的"""
+    for rep in representations:
+        size = rep.estimate_size(duration)
+        if size is not None and size <= max_size:
+            return rep
+    if known := [rep for rep in representations if rep.bitrate]:
+        return min(known, key=lambda rep: rep.bitrate)
+    # 已按画质从高到低排序
+    return representations[-1]
+
+
 async def parse_acfun_url(url: str) -> tuple[str, str]:
     """解析acfun链接
 
@@ -28,10 +77,9 @@ async def parse_acfun_url(url: str) -> tuple[str, str]:
     # 拼接查询参数
     url = f"{url}?quickViewId=videoInfo_new&ajaxpipe=1"
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=ACFUN_HEADERS) as resp:
-            resp.raise_for_status()
-            raw = await resp.text()
+    async with get_session().get(url, headers=ACFUN_HEADERS) as resp:
+        resp.raise_for_status()
+        raw = await resp.text()
 
     matched = re.search(r"window\.videoInfo =(.*?)</script>", raw)
     if not matched:
@@ -47,13 +95,17 @@ async def parse_acfun_url(url: str) -> tuple[str, str]:
         f"作者: {video_info.get('user', {}).get('name', '')}, 上传于 {video_info.get('createTime', '')}"
     )
 
-    ks_play_json = video_info["currentVideoInfo"]["ksPlayJson"]
-    ks_play = json.loads(ks_play_json)
-    representations = ks_play["adaptationSet"][0]["representation"]
-    # 这里[d['url'] for d in representations]，从 4k ~ 360，此处默认720p
-    m3u8_url = [d["url"] for d in representations][3]
+    current_video_info = video_info["currentVideoInfo"]
+    ks_play = json.loads(current_video_info["ksPlayJson"])
+    representations = _parse_representations(ks_play)
+    if not representations:
+        raise ParseException("acfun 视频没有可用的码流")
+    duration_ms = current_video_info.get("durationMillis") or ks_play["adaptationSet"][0].get("duration") or 0
+    # 选择能在大小限制内下载完整的最高画质
+    rep = _select_representation(representations, duration_ms / 1000, MAX_SIZE * 1024 * 1024)
+    logger.debug(f"acfun 选择画质 {rep.quality}, 码率 {rep.bitrate} kbps, 时长 {duration_ms / 1000:.0f}s")
 
-    return m3u8_url, video_desc
+    return rep.url, video_desc
 
 
 async def download_acfun_video(m3u8s_url: str, acid: int) -> Path:
@@ -66,65 +118,12 @@ async def download_acfun_video(m3u8s_url: str, acid: int) -> Path:
     Returns:
         Path: 下载的mp4文件
     """
-    from tqdm.asyncio import tqdm
-
-    m3u8_full_urls = await _parse_m3u8(m3u8s_url)
     video_file = plugin_cache_dir / f"acfun_{acid}.mp4"
-    if video_file.exists():
+    cache_manager.hold(video_file)
+    if await cache_manager.lookup(video_file):
+        download_telemetry.cache_hit(m3u8s_url, video_file.name)
         return video_file
 
-    try:
-        max_size_in_bytes = MAX_SIZE * 1024 * 1024
-        async with aiofiles.open(video_file, "wb") as f, aiohttp.ClientSession() as session:
-            total_size = 0
-            with tqdm(
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-                dynamic_ncols=True,
-                desc=video_file.name,
-            ) as bar:
-                for url in m3u8_full_urls:
-                    async with session.get(url, headers=ACFUN_HEADERS) as resp:
-                        async for chunk in resp.content.iter_chunked(1024 * 1024):
-                            await f.write(chunk)
-                            total_size += len(chunk)
-                            bar.update(len(chunk))
-                    if total_size > max_size_in_bytes:
-                        # 直接截断
-                        break
-    except aiohttp.ClientError as e:
-        await safe_unlink(video_file)
-        raise DownloadException(f"下载 acfun 视频失败: {e}")
-    except asyncio.TimeoutError:
-        await safe_unlink(video_file)
-        raise DownloadException("下载 acfun 视频超时")
-    return video_file
-
-
-async def _parse_m3u8(m3u8_url: str):
-    """解析m3u8链接
-
-    Args:
-        m3u8_url (str): m3u8链接
-
-    Returns:
-        list[str]: 视频链接
-    """
-    async with aiohttp.ClientSession() as session:
-        async with session.get(m3u8_url, headers=ACFUN_HEADERS) as resp:
-            m3u8_file = await resp.text()
-    # 分离ts文件链接
-    raw_pieces = re.split(r"\n#EXTINF:.{8},\n", m3u8_file)
-    # 过滤头部\
-    m3u8_relative_links = raw_pieces[1:]
-
-    # 修改尾部 去掉尾部多余的结束符
-    patched_tail = m3u8_relative_links[-1].split("\n")[0]
-    m3u8_relative_links[-1] = patched_tail
-
-    # 完整链接，直接加 m3u8Url 的通用前缀
-    m3u8_prefix = "/".join(m3u8_url.split("/")[0:-1])
-    m3u8_full_urls = [f"{m3u8_prefix}/{d}" for d in m3u8_relative_links]
-
-    return m3u8_full_urls
+    playlist = await fetch_m3u8(m3u8s_url, ext_headers=ACFUN_HEADERS)
+    segment_urls = [segment.url for segment in playlist.segments]
+    return await download_hls(m3u8s_url, segment_urls, video_file, ext_headers=ACFUN_HEADERS)
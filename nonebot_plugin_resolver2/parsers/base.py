@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
 
-import aiohttp
+from ..client import get_session
 
 
 @dataclass
@@ -61,7 +61,7 @@ class BaseParser(ABC):
 
     async def get_redirect_url(self, url: str) -> str:
         """获取重定向后的URL"""
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=self.default_headers, allow_redirects=False, ssl=False) as response:
-                response.raise_for_status()
-                return response.headers.get("Location", url)
+        session = get_session(verify_ssl=False)
+        async with session.get(url, headers=self.default_headers, allow_redirects=False) as response:
+            response.raise_for_status()
+            return response.headers.get("Location", url)
@@ -1,20 +1,26 @@
 from dataclasses import dataclass
 import re
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
-from bilibili_api import Credential
-from bilibili_api.video import Video
 from nonebot import logger
 
 from ..exception import ParseException
 
-CREDENTIAL: Credential | None = None
+if TYPE_CHECKING:
+    from bilibili_api import Credential
+    from bilibili_api.video import Video
+
+CREDENTIAL: "Credential | None" = None
+_initialized = False
 
 
 def init_bilibili_api():
-    """初始化 bilibili api"""
+    """初始化 bilibili api，bilibili_api 导入较慢，在第一次解析时调用"""
+    global _initialized, CREDENTIAL
+    if _initialized:
+        return
 
-    from bilibili_api import request_settings, select_client
+    from bilibili_api import Credential, request_settings, select_client
 
     from ..config import rconfig
     from ..cookie import ck2dict
@@ -26,11 +32,12 @@ def init_bilibili_api():
     # 第二参数数值参考 curl_cffi 文档
     # https://curl-cffi.readthedocs.io/en/latest/impersonate.html
 
-    if not rconfig.r_bili_ck:
+    if rconfig.r_bili_ck:
+        CREDENTIAL = Credential.from_cookies(ck2dict(rconfig.r_bili_ck))
+    else:
         logger.warning("未配置哔哩哔哩 cookie, 无法使用哔哩哔哩 AI 总结, 可能无法解析 720p 以上画质视频")
-        return
-    global CREDENTIAL
-    CREDENTIAL = Credential.from_cookies(ck2dict(rconfig.r_bili_ck))
+    # 导入或设置失败时下次调用重新初始化
+    _initialized = True
 
 
 async def parse_opus(opus_id: int) -> tuple[list[str], str]:
@@ -42,6 +49,7 @@ async def parse_opus(opus_id: int) -> tuple[list[str], str]:
     Returns:
         tuple[list[str], str]: 图片 url 列表和动态信息
     """
+    init_bilibili_api()
     from bilibili_api.opus import Opus
 
     opus = Opus(opus_id, CREDENTIAL)
@@ -77,6 +85,7 @@ async def parse_live(room_id: int) -> tuple[str, str, str]:
     Returns:
         tuple[str, str, str]: 标题、封面、关键帧
     """
+    init_bilibili_api()
     from bilibili_api.live import LiveRoom
 
     room = LiveRoom(room_display_id=room_id, credential=CREDENTIAL)
@@ -98,6 +107,7 @@ async def parse_read(read_id: int) -> tuple[list[str], list[str]]:
     Returns:
         list[str]: img url or text
     """
+    init_bilibili_api()
     from bilibili_api.article import Article
 
     ar = Article(read_id)
@@ -142,6 +152,7 @@ async def parse_favlist(fav_id: int) -> tuple[list[str], list[str]]:
     Returns:
         tuple[list[str], list[str]]: 标题、封面、简介、链接
     """
+    init_bilibili_api()
     from bilibili_api.favorite_list import get_video_favorite_list_content
 
     fav_list: dict[str, Any] = await get_video_favorite_list_content(fav_id)
@@ -178,15 +189,34 @@ class BilibiliVideoInfo:
     video_url: str
     audio_url: str
     ai_summary: str
+    # 视频流编码 avc / hev / av1
+    video_codec: str = "avc"
+    # DASH 流 sidx 所在的字节范围，如 1000-1999，用于下载预览片段
+    video_index_range: str | None = None
+    audio_index_range: str | None = None
+
 
+@dataclass
+class _VideoStreams:
+    """选中的音视频流"""
 
-def parse_video(*, bvid: str | None = None, avid: int | None = None) -> Video:
+    video_url: str
+    audio_url: str
+    video_codec: str
+    video_index_range: str | None = None
+    audio_index_range: str | None = None
+
+
+def parse_video(*, bvid: str | None = None, avid: int | None = None) -> "Video":
     """解析视频信息
 
     Args:
         bvid (str | None): bvid
         avid (int | None): avid
     """
+    init_bilibili_api()
+    from bilibili_api.video import Video
+
     if avid:
         return Video(aid=avid, credential=CREDENTIAL)
     elif bvid:
@@ -231,7 +261,7 @@ async def parse_video_info(*, bvid: str | None = None, avid: int | None = None,
         page_idx = 0
 
     # 获取下载链接
-    video_url, audio_url = await parse_video_download_url(video=video, page_index=page_idx)
+    streams = await _parse_video_streams(video, page_idx)
     # 获取在线观看人数
     online = await video.get_online()
 
@@ -253,15 +283,18 @@ async def parse_video_info(*, bvid: str | None = None, avid: int | None = None,
         title=title,
         display_info=display_info,
         cover_url=cover_url if cover_url else video_info["pic"],
-        video_url=video_url,
-        audio_url=audio_url,
+        video_url=streams.video_url,
+        audio_url=streams.audio_url,
         video_duration=video_duration,
         ai_summary=ai_summary,
+        video_codec=streams.video_codec,
+        video_index_range=streams.video_index_range,
+        audio_index_range=streams.audio_index_range,
     )
 
 
 async def parse_video_download_url(
-    *, video: Video | None = None, bvid: str | None = None, avid: int | None = None, page_index: int = 0
+    *, video: "Video | None" = None, bvid: str | None = None, avid: int | None = None, page_index: int = 0
 ) -> tuple[str, str]:
     """解析视频下载链接
 
@@ -271,19 +304,51 @@ async def parse_video_download_url(
         page_index (int): 页索引 = 页码 - 1
     """
 
-    from bilibili_api.video import VideoDownloadURLDataDetecter
-
     if video is None:
         video = parse_video(bvid=bvid, avid=avid)
+    streams = await _parse_video_streams(video, page_index)
+    return streams.video_url, streams.audio_url
+
+
+async def _parse_video_streams(video: "Video", page_index: int) -> _VideoStreams:
+    """按配置的编码偏好选择音视频流
+
+    优先选择靠前的编码，即使其画质低于其他编码，避免发送时因编码不兼容而重新编码
+
+    Returns:
+        _VideoStreams: 音视频流链接、视频编码和 sidx 范围
+    """
+    from bilibili_api.video import VideoCodecs, VideoDownloadURLDataDetecter, VideoStreamDownloadURL
+
+    from ..config import BILI_VIDEO_CODECS
+
     # 获取下载数据
     download_url_data = await video.get_download_url(page_index=page_index)
     detecter = VideoDownloadURLDataDetecter(download_url_data)
-    streams = detecter.detect_best_streams()
+    # 依次尝试偏好的编码，杜比视界和 HDR 不受编码筛选限制，需要单独排除
+    for codec in BILI_VIDEO_CODECS:
+        streams = detecter.detect_best_streams(codecs=[VideoCodecs[codec.upper()]], no_dolby_video=True, no_hdr=True)
+        if streams[0] is not None:
+            break
+    else:
+        # 都没有时接受任意编码
+        streams = detecter.detect_best_streams()
     video_stream = streams[0]
     audio_stream = streams[1]
     if video_stream is None or audio_stream is None:
         raise ValueError("未找到视频或音频流")
-    return video_stream.url, audio_stream.url
+    video_codec = "avc"
+    if isinstance(video_stream, VideoStreamDownloadURL):
+        video_codec = video_stream.video_codecs.name.lower()
+    logger.debug(f"选择视频流 {video_codec}, 偏好 {BILI_VIDEO_CODECS}")
+    # FLV / MP4 流没有 sidx
+    return _VideoStreams(
+        video_url=video_stream.url,
+        audio_url=audio_stream.url,
+        video_codec=video_codec,
+        video_index_range=getattr(video_stream, "segment_base_index_range", None),
+        audio_index_range=getattr(audio_stream, "segment_base_index_range", None),
+    )
 
 
 def __extra_bili_info(video_info: dict[str, Any]) -> str:
@@ -2,9 +2,9 @@ import json
 import re
 from typing import Any
 
-import aiohttp
 from nonebot import logger
 
+from ..client import get_session
 from ..exception import ParseException
 from .base import BaseParser, VideoAuthor, VideoInfo
 
@@ -47,11 +47,11 @@ class DouYin(BaseParser):
         raise ParseException("作品已删除，或资源直链获取失败, 请稍后再试")
 
     async def parse_video(self, url: str) -> VideoInfo:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=self.default_headers, ssl=False) as response:
-                response.raise_for_status()
-                text = await response.text()
-                data: dict[str, Any] = self.format_response(text)
+        session = get_session(verify_ssl=False)
+        async with session.get(url, headers=self.default_headers) as response:
+            response.raise_for_status()
+            text = await response.text()
+        data: dict[str, Any] = self.format_response(text)
         # 获取图集图片地址
         images: list[str] = []
         # 如果data含有 images，并且 images 是一个列表
@@ -141,10 +141,10 @@ class DouYin(BaseParser):
             "User-Agent": "Mozilla/5.0 (Linux; Android 10; VOG-AL00 Build/HUAWEIVOG-AL00) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.88 Mobile Safari/537.36",  # noqa: E501
             "Accept": "application/json, text/plain, */*",
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, headers=headers, ssl=False) as resp:
-                resp.raise_for_status()
-                resp = await resp.json()
+        session = get_session(verify_ssl=False)
+        async with session.get(url, params=params, headers=headers) as resp:
+            resp.raise_for_status()
+            resp = await resp.json()
         detail = resp.get("aweme_details")
         if not detail:
             raise ParseException("can't find aweme_details in json")
@@ -1,8 +1,7 @@
 import math
 import re
 
-import aiohttp
-
+from ..client import get_session
 from ..constant import COMMON_HEADER
 from ..exception import ParseException
 from .base import BaseParser, VideoAuthor, VideoInfo
@@ -42,10 +41,10 @@ class WeiBo(BaseParser):
             **self.default_headers,
         }
         post_content = 'data={"Component_Play_Playinfo":{"oid":"' + fid + '"}}'
-        async with aiohttp.ClientSession() as session:
-            async with session.post(req_url, headers=headers, data=post_content) as response:
-                response.raise_for_status()
-                json_data = await response.json()
+        session = get_session()
+        async with session.post(req_url, headers=headers, data=post_content) as response:
+            response.raise_for_status()
+            json_data = await response.json()
         data = json_data["data"]["Component_Play_Playinfo"]
 
         video_url = data["stream_url"]
@@ -76,13 +75,13 @@ class WeiBo(BaseParser):
         }
 
         # 请求数据
-        async with aiohttp.ClientSession() as session:
-            async with session.get(WEIBO_SINGLE_INFO.format(weibo_id), headers=headers) as resp:
-                if resp.status != 200:
-                    raise ParseException(f"获取数据失败 {resp.status} {resp.reason}")
-                if "application/json" not in resp.headers.get("content-type", ""):
-                    raise ParseException("获取数据失败 content-type is not application/json")
-                resp_json = await resp.json()
+        session = get_session()
+        async with session.get(WEIBO_SINGLE_INFO.format(weibo_id), headers=headers) as resp:
+            if resp.status != 200:
+                raise ParseException(f"获取数据失败 {resp.status} {resp.reason}")
+            if "application/json" not in resp.headers.get("content-type", ""):
+                raise ParseException("获取数据失败 content-type is not application/json")
+            resp_json = await resp.json()
 
         weibo_data = resp_json.get("data", {})
         text = weibo_data.get("text", "")
@@ -2,8 +2,7 @@ import json
 import re
 from urllib.parse import parse_qs, urlparse
 
-import aiohttp
-
+from ..client import get_session
 from ..config import rconfig
 from ..constant import COMMON_HEADER
 from ..exception import ParseException
@@ -36,9 +35,8 @@ async def parse_url(url: str) -> tuple[str, list[str], str]:
         headers["cookie"] = rconfig.r_xhs_ck
     # 处理 xhslink 短链
     if "xhslink" in url:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers, allow_redirects=False) as resp:
-                url = resp.headers.get("Location", "")
+        async with get_session().get(url, headers=headers, allow_redirects=False) as resp:
+            url = resp.headers.get("Location", "")
     # ?: 非捕获组
     pattern = r"(?:/explore/|/discovery/item/|source=note&noteId=)(\w+)"
     matched = re.search(pattern, url)
@@ -51,12 +49,11 @@ async def parse_url(url: str) -> tuple[str, list[str], str]:
     # 提取 xsec_source 和 xsec_token
     xsec_source = params.get("xsec_source", [None])[0] or "pc_feed"
     xsec_token = params.get("xsec_token", [None])[0]
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            f"{XHS_REQ_LINK}{xhs_id}?xsec_source={xsec_source}&xsec_token={xsec_token}",
-            headers=headers,
-        ) as resp:
-            html = await resp.text()
+    async with get_session().get(
+        f"{XHS_REQ_LINK}{xhs_id}?xsec_source={xsec_source}&xsec_token={xsec_token}",
+        headers=headers,
+    ) as resp:
+        html = await resp.text()
 
     pattern = r"window.__INITIAL_STATE__=(.*?)</script>"
     matched = re.search(pattern, html)
@@ -0,0 +1,114 @@
+import hashlib
+import hmac
+from pathlib import Path
+import secrets
+import time
+from typing import TYPE_CHECKING
+from urllib.parse import quote
+
+import aiofiles.os
+from nonebot import get_app, get_driver, logger
+
+from .config import MEDIA_SERVER_TTL, MEDIA_SERVER_URL, plugin_cache_dir
+from .download.cache import cache_manager
+
+if TYPE_CHECKING:
+    from fastapi import FastAPI
+
+# 媒体文件路由前缀
+_ROUTE_PREFIX = "/resolver2/media"
+
+
+class MediaServer:
+    """通过 NoneBot 的 FastAPI 驱动器提供缓存目录中的文件
+
+    协议端通过带签名的短期 url 拉取文件，不需要与 nonebot 共享文件系统，也不需要 base64 编码。
+    签名密钥在每次启动时随机生成，url 在 ttl 秒后失效
+    """
+
+    def __init__(self, cache_dir: Path, base_url: str | None, ttl: int):
+        """
+        Args:
+            cache_dir (Path): 缓存目录
+            base_url (str | None): 协议端访问 nonebot 使用的地址，为 None 时根据驱动器的 host 和 port 生成
+            ttl (int): url 的有效时间，单位秒
+        """
+        self.cache_dir = cache_dir
+        self.base_url = base_url.rstrip("/") if base_url else None
+        self.ttl = ttl
+        self.enabled = False
+        self._secret = secrets.token_bytes(32)
+
+    def _sign(self, name: str, expires: int) -> str:
+        return hmac.new(self._secret, f"{name}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+    def url_for(self, path: Path) -> str:
+        """生成文件的签名 url
+
+        Args:
+            path (Path): 缓存目录中的文件路径
+
+        Returns:
+            str: 签名 url
+        """
+        expires = int(time.time()) + self.ttl
+        sig = self._sign(path.name, expires)
+        return f"{self.base_url}{_ROUTE_PREFIX}/{quote(path.name)}?expires={expires}&sig={sig}"
+
+    def verify(self, name: str, expires: int, sig: str) -> bool:
+        """校验签名和有效期"""
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self._sign(name, expires), sig)
+
+    def mount(self, app: "FastAPI") -> None:
+        """在 FastAPI 应用上注册文件路由
+
+        Args:
+            app (FastAPI): FastAPI 应用
+        """
+        from fastapi import HTTPException
+        from fastapi.responses import FileResponse
+
+        async def serve_media(name: str, expires: int, sig: str) -> FileResponse:
+            # 路径参数不含 /，这里再排除 . 和 .. 等特殊名称
+            if Path(name).name != name or name in (".", ".."):
+                raise HTTPException(status_code=404)
+            if not self.verify(name, expires, sig):
+                raise HTTPException(status_code=403)
+            path = self.cache_dir / name
+            if not await aiofiles.os.path.isfile(path):
+                raise HTTPException(status_code=404)
+            cache_manager.touch(path)
+            # FileResponse 支持 Range 请求，ASGI 服务器支持 pathsend 扩展时由服务器直接发送文件
+            return FileResponse(path)
+
+        app.add_api_route(f"{_ROUTE_PREFIX}/{{name}}", serve_media, methods=["GET", "HEAD"], include_in_schema=False)
+        if self.base_url is None:
+            config = get_driver().config
+            host = str(config.host)
+            if host in ("0.0.0.0", "::"):
+                host = "127.0.0.1"
+            self.base_url = f"http://{host}:{config.port}"
+        self.enabled = True
+        logger.info(f"媒体文件服务已启用, 协议端通过 {self.base_url}{_ROUTE_PREFIX} 拉取文件")
+
+    def setup(self) -> None:
+        """在 NoneBot 的 FastAPI 驱动器上启用文件服务，驱动器不是 FastAPI 时保持关闭"""
+        try:
+            from fastapi import FastAPI
+        except ImportError:
+            logger.warning("未安装 fastapi, 媒体文件服务未启用")
+            return
+        try:
+            app = get_app()
+        except Exception:
+            app = None
+        if not isinstance(app, FastAPI):
+            logger.warning("媒体文件服务需要使用 FastAPI 驱动器, 当前驱动器不支持, 未启用")
+            return
+        self.mount(app)
+
+
+# 全局媒体文件服务
+media_server = MediaServer(plugin_cache_dir, MEDIA_SERVER_URL, MEDIA_SERVER_TTL)
@@ -19,3 +19,33 @@ async def test_parse_acfun_url():
         video_file = await download_acfun_video(m3u8s_url, acid)
         assert video_file
         logger.info(f"acfun 视频 {acid} 下载成功, 文件大小: {video_file.stat().st_size / 1024 / 1024:.2f} MB")
+
+
+def test_select_acfun_representation():
+    from nonebot_plugin_resolver2.parsers.acfun import _parse_representations, _select_representation
+
+    ks_play = {
+        "adaptationSet": [
+            {
+                "duration": 600_000,
+                "representation": [
+                    {"url": "360", "height": 360, "avgBitrate": 400, "qualityType": "360p"},
+                    {"url": "1080", "height": 1080, "avgBitrate": 2500, "qualityLabel": "1080P"},
+                    {"url": "720", "height": 720, "avgBitrate": 1200, "qualityLabel": "720P"},
+                ],
+            }
+        ]
+    }
+    representations = _parse_representations(ks_play)
+    assert [rep.url for rep in representations] == ["1080", "720", "360"]
+    # 10 分钟 1080P 约 179 MB，720P 约 86 MB
+    assert _select_representation(representations, 600, 100 * 1024 * 1024).url == "720"
+    assert _select_representation(representations, 600, 500 * 1024 * 1024).url == "1080"
+    # 都超过限制时选择码率最低的
+    assert _select_representation(representations, 600, 1024 * 1024).url == "360"
+
+    # 码率都未知时选择画质最低的
+    heights = [1080, 720, 480]
+    ks_play = {"adaptationSet": [{"representation": [{"url": str(height), "height": height} for height in heights]}]}
+    representations = _parse_representations(ks_play)
+    assert _select_representation(representations, 600, 1024 * 1024).url == "480"
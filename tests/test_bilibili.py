@@ -56,3 +56,63 @@ async def test_bilibili_opus():
         assert orig_text
         logger.debug(orig_text)
     logger.success("B站动态解析成功")
+
+
+@pytest.mark.asyncio
+async def test_bilibili_video_codec_preference():
+    from nonebot_plugin_resolver2.parsers.bilibili import _parse_video_streams
+
+    def stream(id: int, codecs: str) -> dict:
+        return {
+            "id": id,
+            "base_url": f"https://example.com/{id}-{codecs}.m4s",
+            "backup_url": [],
+            "bandwidth": 1000,
+            "codecs": codecs,
+            "frame_rate": "30",
+            "width": 1920,
+            "height": 1080,
+            "sar": "1:1",
+            "mime_type": "video/mp4",
+            "segment_base": {"initialization": "0-999", "index_range": "1000-1999"},
+        }
+
+    class FakeVideo:
+        def __init__(self, videos: list[dict]):
+            self.videos = videos
+
+        async def get_download_url(self, page_index: int = 0) -> dict:
+            audio = {**stream(30280, "mp4a.40.2"), "mime_type": "audio/mp4"}
+            return {"dash": {"video": self.videos, "audio": [audio]}}
+
+    # 存在 avc 时，即使画质较低也优先选择
+    video = FakeVideo([stream(80, "hev1.1.6.L120.90"), stream(64, "avc1.640032"), stream(80, "av01.0.08M.08")])
+    streams = await _parse_video_streams(video, 0)  # type: ignore
+    assert streams.video_codec == "avc"
+    assert streams.video_url.endswith("64-avc1.640032.m4s")
+    assert streams.audio_url
+    assert streams.video_index_range == "1000-1999"
+
+    # 没有 avc 时按偏好顺序选择
+    video = FakeVideo([stream(80, "hev1.1.6.L120.90"), stream(64, "av01.0.08M.08")])
+    streams = await _parse_video_streams(video, 0)  # type: ignore
+    assert streams.video_codec == "av1"
+
+
+def test_init_bilibili_api_retry(monkeypatch: pytest.MonkeyPatch):
+    import bilibili_api
+
+    from nonebot_plugin_resolver2.parsers import bilibili
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("select_client")
+
+    monkeypatch.setattr(bilibili, "_initialized", False)
+    with monkeypatch.context() as m:
+        m.setattr(bilibili_api, "select_client", broken)
+        with pytest.raises(RuntimeError):
+            bilibili.init_bilibili_api()
+    # 初始化失败后不会标记为已初始化，下次调用重新初始化
+    assert not bilibili._initialized
+    bilibili.init_bilibili_api()
+    assert bilibili._initialized
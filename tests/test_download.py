@@ -1,4 +1,7 @@
+from pathlib import Path
+
 from nonebot import logger
+import pytest
 
 
 def test_generate_file_name():
@@ -16,15 +19,916 @@ def test_generate_file_name():
         logger.info(f"{url}: {file_name}")
 
 
-def test_limited_size_dict():
-    from nonebot_plugin_resolver2.download.ytdlp import LimitedSizeDict
+async def test_download_file_by_stream_single_flight():
+    import asyncio
 
-    limited_size_dict = LimitedSizeDict()
-    for i in range(20):
-        limited_size_dict[f"test{i}"] = f"test{i}"
-    assert len(limited_size_dict) == 20
-    for i in range(20):
-        assert limited_size_dict[f"test{i}"] == f"test{i}"
-    for i in range(20, 30):
-        limited_size_dict[f"test{i}"] = f"test{i}"
-    assert len(limited_size_dict) == 20
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from nonebot_plugin_resolver2.config import plugin_cache_dir
+    from nonebot_plugin_resolver2.download import download_file_by_stream
+
+    payload = b"resolver2" * 1024 * 256
+    hits = 0
+
+    async def handler(request: web.Request) -> web.StreamResponse:
+        nonlocal hits
+        # 忽略分段下载的探测请求
+        if "Range" not in request.headers:
+            hits += 1
+        resp = web.StreamResponse()
+        resp.content_length = len(payload)
+        await resp.prepare(request)
+        # 分两次写入，模拟下载过程中的其他调用者
+        await resp.write(payload[: len(payload) // 2])
+        await asyncio.sleep(0.2)
+        await resp.write(payload[len(payload) // 2 :])
+        return resp
+
+    app = web.Application()
+    app.router.add_get("/single_flight.bin", handler)
+    async with TestServer(app) as server:
+        url = str(server.make_url("/single_flight.bin"))
+        file_name = "test_single_flight.bin"
+        (plugin_cache_dir / file_name).unlink(missing_ok=True)
+
+        paths = await asyncio.gather(*[download_file_by_stream(url, file_name=file_name) for _ in range(5)])
+
+    assert hits == 1
+    assert len(set(paths)) == 1
+    assert paths[0].read_bytes() == payload
+    assert not paths[0].with_name(f"{file_name}.part").exists()
+    paths[0].unlink()
+
+
+async def test_download_file_by_stream_ranges(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    import os
+
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from nonebot_plugin_resolver2.config import plugin_cache_dir
+    import nonebot_plugin_resolver2.download as download
+
+    # 分片大小 1MB，2 个连接
+    monkeypatch.setattr(download, "DOWNLOAD_PART_SIZE", 1)
+    monkeypatch.setattr(download, "DOWNLOAD_CONNECTIONS", 2)
+
+    payload = os.urandom(3 * 1024 * 1024 + 123)
+    source = tmp_path / "ranges.bin"
+    source.write_bytes(payload)
+    range_headers: list[str] = []
+
+    async def handler(request: web.Request) -> web.StreamResponse:
+        range_headers.append(request.headers.get("Range", ""))
+        return web.FileResponse(source)
+
+    app = web.Application()
+    app.router.add_get("/ranges.bin", handler)
+    async with TestServer(app) as server:
+        file_name = "test_ranges.bin"
+        (plugin_cache_dir / file_name).unlink(missing_ok=True)
+        path = await download.download_file_by_stream(str(server.make_url("/ranges.bin")), file_name=file_name)
+
+    # 1 次探测 + 4 个分片
+    assert len(range_headers) == 5
+    assert all(range_headers)
+    assert path.read_bytes() == payload
+    path.unlink()
+
+
+async def test_download_file_by_stream_probe_fallback(monkeypatch: pytest.MonkeyPatch):
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from nonebot_plugin_resolver2.config import plugin_cache_dir
+    import nonebot_plugin_resolver2.download as download
+
+    monkeypatch.setattr(download, "DOWNLOAD_CONNECTIONS", 2)
+
+    payload = b"resolver2" * 1024
+    range_headers: list[str] = []
+
+    async def handler(request: web.Request) -> web.Response:
+        range_headers.append(request.headers.get("Range", ""))
+        # 拒绝 Range 请求的 CDN
+        if "Range" in request.headers:
+            return web.Response(status=403)
+        return web.Response(body=payload)
+
+    app = web.Application()
+    app.router.add_get("/no_range.bin", handler)
+    app.router.add_get("/image.jpg", handler)
+    async with TestServer(app) as server:
+        file_name = "test_no_range.bin"
+        (plugin_cache_dir / file_name).unlink(missing_ok=True)
+        path = await download.download_file_by_stream(str(server.make_url("/no_range.bin")), file_name=file_name)
+        assert range_headers == ["bytes=0-0", ""]
+        assert path.read_bytes() == payload
+        path.unlink()
+
+        # 图片不探测
+        range_headers.clear()
+        img_name = "test_no_range.jpg"
+        (plugin_cache_dir / img_name).unlink(missing_ok=True)
+        path = await download.download_img(str(server.make_url("/image.jpg")), img_name=img_name)
+        assert range_headers == [""]
+        path.unlink()
+
+
+async def test_download_file_by_stream_resume(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    import os
+
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from nonebot_plugin_resolver2.config import plugin_cache_dir
+    import nonebot_plugin_resolver2.download as download
+    from nonebot_plugin_resolver2.download.telemetry import download_telemetry
+
+    # 关闭分段下载，测试顺序下载的断点续传
+    monkeypatch.setattr(download, "DOWNLOAD_CONNECTIONS", 1)
+
+    payload = os.urandom(2 * 1024 * 1024)
+    source = tmp_path / "resume.bin"
+    source.write_bytes(payload)
+    range_headers: list[str] = []
+
+    async def handler(request: web.Request) -> web.StreamResponse:
+        range_headers.append(request.headers.get("Range", ""))
+        if len(range_headers) > 1:
+            return web.FileResponse(source)
+        # 第一次请求只返回一半数据后断开连接
+        resp = web.StreamResponse(headers={"ETag": '"resume"'})
+        resp.content_length = len(payload)
+        await resp.prepare(request)
+        await resp.write(payload[: len(payload) // 2])
+        assert request.transport
+        request.transport.close()
+        return resp
+
+    app = web.Application()
+    app.router.add_get("/resume.bin", handler)
+    async with TestServer(app) as server:
+        file_name = "test_resume.bin"
+        (plugin_cache_dir / file_name).unlink(missing_ok=True)
+        url = str(server.make_url("/resume.bin"))
+        path = await download.download_file_by_stream(url, file_name=file_name)
+        # 再次请求命中缓存
+        await download.download_file_by_stream(url, file_name=file_name)
+
+    assert range_headers[0] == ""
+    assert range_headers[1].startswith("bytes=")
+    assert range_headers[1] != "bytes=0-"
+    assert path.read_bytes() == payload
+    assert not path.with_name(f"{file_name}.part").exists()
+    assert not path.with_name(f"{file_name}.part.json").exists()
+    path.unlink()
+
+    # 下载统计
+    record, cached = download_telemetry.recent()[-2:]
+    assert record.name == file_name
+    assert record.retries == 1
+    assert record.error is None
+    assert record.ttfb is not None
+    # 两次请求共传输完整文件，第二次从断点继续
+    assert record.total_bytes == len(payload)
+    assert 0 < record.resumed_bytes < len(payload)
+    assert cached.from_cache
+    summary = download_telemetry.summary()
+    assert summary["cache_hits"] >= 1
+    assert summary["retries"] >= 1
+
+
+async def test_download_scheduler():
+    import asyncio
+
+    from nonebot_plugin_resolver2.download.scheduler import DownloadScheduler, Priority
+
+    scheduler = DownloadScheduler(max_connections=2, max_host_connections=1)
+    order: list[str] = []
+    release = asyncio.Event()
+
+    async def job(name: str, url: str, priority: Priority):
+        async with scheduler.slot(url, priority):
+            order.append(name)
+            await release.wait()
+
+    # a.com 占满单 host 名额，b.com 的视频占用另一个全局名额
+    tasks = [
+        asyncio.create_task(job("video-a", "https://a.com/1.mp4", Priority.VIDEO)),
+        asyncio.create_task(job("video-b", "https://b.com/1.mp4", Priority.VIDEO)),
+    ]
+    await asyncio.sleep(0)
+    tasks += [
+        asyncio.create_task(job("video-c", "https://c.com/2.mp4", Priority.VIDEO)),
+        asyncio.create_task(job("image-c", "https://c.com/1.jpg", Priority.IMAGE)),
+    ]
+    await asyncio.sleep(0)
+    assert order == ["video-a", "video-b"]
+    stats = scheduler.stats()
+    assert stats["active"] == 2
+    assert stats["queued"] == {"image": 1, "audio": 0, "video": 1}
+
+    release.set()
+    await asyncio.gather(*tasks)
+    # 图片优先于先入队的视频
+    assert order[2:] == ["image-c", "video-c"]
+    assert scheduler.stats()["active"] == 0
+
+
+async def test_download_file_by_stream_size_limit(monkeypatch: pytest.MonkeyPatch):
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from nonebot_plugin_resolver2.config import plugin_cache_dir
+    import nonebot_plugin_resolver2.download as download
+    from nonebot_plugin_resolver2.exception import DownloadSizeLimitException
+
+    monkeypatch.setattr(download, "DOWNLOAD_CONNECTIONS", 1)
+    monkeypatch.setattr(download, "MAX_SIZE", 1)
+
+    async def handler(request: web.Request) -> web.StreamResponse:
+        # chunked 响应，不返回 Content-Length
+        resp = web.StreamResponse()
+        resp.enable_chunked_encoding()
+        await resp.prepare(request)
+        for _ in range(3):
+            await resp.write(b"0" * 1024 * 1024)
+        return resp
+
+    app = web.Application()
+    app.router.add_get("/chunked.bin", handler)
+    async with TestServer(app) as server:
+        file_name = "test_size_limit.bin"
+        with pytest.raises(DownloadSizeLimitException):
+            await download.download_file_by_stream(str(server.make_url("/chunked.bin")), file_name=file_name)
+
+    assert not (plugin_cache_dir / file_name).exists()
+    assert not (plugin_cache_dir / f"{file_name}.part").exists()
+
+
+async def test_cache_manager(tmp_path: Path):
+    import os
+    import time
+
+    from nonebot_plugin_resolver2.download.cache import CacheManager
+
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    db_path = tmp_path / "cache_index.db"
+    manager = CacheManager(cache_dir, max_size=3 * 1024, db_path=db_path, min_age=60)
+    now = time.time()
+    for i in range(5):
+        file = cache_dir / f"{i}.bin"
+        file.write_bytes(b"0" * 1024)
+        # 越小的编号越久未访问
+        os.utime(file, (now - 3600 + i, now - 3600 + i))
+    # 从缓存目录重建索引
+    await manager.load()
+    assert manager.total_size == 5 * 1024
+
+    # 最久未访问的 0.bin 被固定，1.bin 刚被访问
+    manager.pin(cache_dir / "0.bin")
+    assert await manager.lookup(cache_dir / "1.bin")
+    assert not await manager.lookup(cache_dir / "missing.bin")
+    assert await manager.evict() == 2
+    assert sorted(os.listdir(cache_dir)) == ["0.bin", "1.bin", "4.bin"]
+    assert manager.stats()["hit_rate"] == 0.5
+
+    # 下载中的 .part 文件与目标文件共用固定计数
+    with manager.pinned(cache_dir / "5.bin"):
+        assert manager.is_pinned(cache_dir / "5.bin.part")
+    assert not manager.is_pinned(cache_dir / "5.bin.part")
+
+    # 已被删除的文件不再命中，并从索引中移除
+    (cache_dir / "4.bin").unlink()
+    assert not await manager.lookup(cache_dir / "4.bin")
+    assert manager.total_size == 2 * 1024
+    manager.unpin(cache_dir / "0.bin")
+    await manager.discard(cache_dir / "0.bin")
+    assert not (cache_dir / "0.bin").exists()
+    assert manager.total_size == 1024
+    # 写入中的临时文件不会被登记
+    (cache_dir / "7.part.mp4").write_bytes(b"0")
+    (cache_dir / "8.mp4.part").write_bytes(b"0")
+    assert not await manager.lookup(cache_dir / "7.part.mp4")
+    await manager.sync()
+    assert manager.total_size == 1024
+
+    # 按内容 id 查找，索引重启后仍然存在
+    (cache_dir / "6.mp4").write_bytes(b"0")
+    await manager.add(cache_dir / "6.mp4", content_id="bilibili:BV1xx411c7mD-1", origin="https://example.com/6.mp4")
+    await manager.close()
+
+    manager = CacheManager(cache_dir, max_size=3 * 1024, db_path=db_path, min_age=60)
+    await manager.load()
+    assert manager.find("bilibili:BV1xx411c7mD-1") == cache_dir / "6.mp4"
+    assert manager.stats()["hottest"][0] == ("1.bin", 1)
+    await manager.close()
+
+
+async def test_ffmpeg_pool(tmp_path: Path):
+    import asyncio
+    import stat
+    import sys
+
+    from nonebot_plugin_resolver2.download.ffmpeg import FFmpegPool, _is_heavy
+
+    assert _is_heavy(["ffmpeg", "-i", "a.mp4", "-c:v", "libx264", "b.mp4"])
+    assert not _is_heavy(["ffmpeg", "-i", "a.mp4", "-c", "copy", "b.mp4"])
+
+    # 模拟 ffmpeg: 输出进度，按输出文件名决定成功、失败或卡住
+    fake_ffmpeg = tmp_path / "ffmpeg"
+    fake_ffmpeg.write_text(
+        f"#!{sys.executable}\n"
+        "import sys, time\n"
+        "print('out_time_us=1000000\\nspeed=1x\\nprogress=end', flush=True)\n"
+        "out = sys.argv[-1]\n"
+        "if out == 'fail.mp4':\n"
+        "    print('\\n'.join(f'line {i}' for i in range(100)), file=sys.stderr)\n"
+        "    sys.exit(1)\n"
+        "time.sleep(5 if out == 'hang.mp4' else 0.2)\n"
+    )
+    fake_ffmpeg.chmod(fake_ffmpeg.stat().st_mode | stat.S_IEXEC)
+
+    pool = FFmpegPool(max_workers=1, timeout=2)
+    await asyncio.gather(*[pool.run([str(fake_ffmpeg), "-c:v", "libx264", "ok.mp4"]) for _ in range(3)])
+    stats = pool.stats()
+    assert stats["completed"] == 3
+    # 编码任务串行执行，后两个任务需要排队
+    assert stats["max_wait"] >= 0.2
+
+    with pytest.raises(RuntimeError, match="line 99") as exc_info:
+        await pool.run([str(fake_ffmpeg), "fail.mp4"])
+    # 只保留 stderr 末尾若干行
+    assert "line 0\n" not in str(exc_info.value)
+
+    with pytest.raises(RuntimeError, match="超时"):
+        await pool.run([str(fake_ffmpeg), "hang.mp4"], timeout=0.5)
+    stats = pool.stats()
+    assert stats["failed"] == 2
+    assert stats["timed_out"] == 1
+    assert stats["running"] == {"heavy": 0, "light": 0}
+
+
+async def test_atomic_output(tmp_path: Path):
+    import os
+
+    from nonebot_plugin_resolver2.download.utils import atomic_output
+
+    output_path = tmp_path / "out.mp4"
+
+    async def write(data: bytes, fail: bool) -> None:
+        async with atomic_output(output_path) as part_path:
+            assert part_path.suffix == ".mp4"
+            part_path.write_bytes(data)
+            if fail:
+                raise RuntimeError("ffmpeg 执行失败")
+
+    # 失败时不留下写了一半的文件
+    with pytest.raises(RuntimeError, match="ffmpeg"):
+        await write(b"half", fail=True)
+    assert os.listdir(tmp_path) == []
+
+    await write(b"done", fail=False)
+    assert os.listdir(tmp_path) == ["out.mp4"]
+    assert output_path.read_bytes() == b"done"
+
+
+async def test_fit_video_to_size(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    import os
+    import stat
+    import sys
+
+    from nonebot_plugin_resolver2.download import fit_video_to_size
+
+    # 模拟 ffprobe 返回 60 秒时长，ffmpeg 按输出文件名写入过大的文件或失败
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "ffprobe").write_text(f'#!{sys.executable}\nprint(\'{{"format": {{"duration": "60"}}}}\')\n')
+    (bin_dir / "ffmpeg").write_text(
+        f"#!{sys.executable}\n"
+        "import sys\n"
+        "out = sys.argv[-1]\n"
+        "open(out, 'wb').write(b'0' * 3 * 1024 * 1024)\n"
+        "sys.exit(1 if 'broken' in out else 0)\n"
+    )
+    for tool in bin_dir.iterdir():
+        tool.chmod(tool.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    for name in ("large.mp4", "broken.mp4"):
+        (cache_dir / name).write_bytes(b"0")
+    # 压缩后仍超过限制，或 ffmpeg 失败时，都不留下输出文件
+    with pytest.raises(RuntimeError, match="仍超过"):
+        await fit_video_to_size(cache_dir / "large.mp4", max_bytes=2 * 1024 * 1024)
+    with pytest.raises(RuntimeError, match="ffmpeg"):
+        await fit_video_to_size(cache_dir / "broken.mp4", max_bytes=2 * 1024 * 1024)
+    assert sorted(os.listdir(cache_dir)) == ["broken.mp4", "large.mp4"]
+
+
+async def test_merge_av_stream(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    import asyncio
+    import os
+    import stat
+    import sys
+
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    import nonebot_plugin_resolver2.download as download
+    from nonebot_plugin_resolver2.download.cache import CacheManager
+    from nonebot_plugin_resolver2.download.scheduler import DownloadScheduler
+
+    # 模拟 ffmpeg: 先读完视频管道再读音频管道，拼接后写入输出文件
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake_ffmpeg = bin_dir / "ffmpeg"
+    fake_ffmpeg.write_text(
+        f"#!{sys.executable}\n"
+        "import os, sys\n"
+        "fds = [int(arg.removeprefix('pipe:')) for arg in sys.argv if arg.startswith('pipe:')]\n"
+        "data = b''\n"
+        "for fd in fds:\n"
+        "    with os.fdopen(fd, 'rb') as f:\n"
+        "        data += f.read()\n"
+        "open(sys.argv[-1], 'wb').write(data)\n"
+    )
+    fake_ffmpeg.chmod(fake_ffmpeg.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    # 音视频位于同一 host，且每个 host 只有一个名额
+    monkeypatch.setattr(download, "download_scheduler", DownloadScheduler(max_connections=1, max_host_connections=1))
+    manager = CacheManager(tmp_path, max_size=1024**3, db_path=tmp_path / "cache_index.db")
+    monkeypatch.setattr(download, "cache_manager", manager)
+
+    # 大于管道缓冲区，视频流写入时会阻塞
+    video, audio = os.urandom(1024 * 1024), os.urandom(256 * 1024)
+    hits: list[str] = []
+
+    async def handler(request: web.Request) -> web.Response:
+        hits.append(request.path)
+        return web.Response(body=video if request.path == "/video.m4s" else audio)
+
+    app = web.Application()
+    app.router.add_get("/{name}", handler)
+    output_path = tmp_path / "merged.mp4"
+    async with TestServer(app) as server:
+        v_url, a_url = str(server.make_url("/video.m4s")), str(server.make_url("/audio.m4s"))
+        await asyncio.wait_for(
+            asyncio.gather(
+                *[download.merge_av_stream(v_url=v_url, a_url=a_url, output_path=output_path) for _ in range(3)]
+            ),
+            timeout=10,
+        )
+
+    # 并发调用共享同一个合并任务
+    assert sorted(hits) == ["/audio.m4s", "/video.m4s"]
+    assert output_path.read_bytes() == video + audio
+    assert not output_path.with_name(f"{output_path.name}.part").exists()
+    # 合并结果登记到缓存索引
+    assert manager._entries[output_path.name].size == len(video + audio)
+
+
+async def test_download_dash_prefix(tmp_path: Path):
+    import os
+    import struct
+
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from nonebot_plugin_resolver2.client import get_session
+    from nonebot_plugin_resolver2.download.preview import _download_dash_prefix, parse_sidx
+
+    # 构造初始化段 + sidx (3 个 10 秒的分段) + 分段数据
+    init = os.urandom(100)
+    sizes = [1000, 2000, 3000]
+    references = b"".join(struct.pack(">III", size, 10_000, 0x90000000) for size in sizes)
+    body = struct.pack(">BBBBIIIIHH", 0, 0, 0, 0, 1, 1000, 0, 0, 0, len(sizes)) + references
+    sidx = struct.pack(">I4s", 8 + len(body), b"sidx") + body
+    payload = init + sidx + os.urandom(sum(sizes))
+
+    segment_offset, refs = parse_sidx(sidx)
+    assert segment_offset == len(sidx)
+    assert refs == [(1000, 10.0), (2000, 10.0), (3000, 10.0)]
+
+    source = tmp_path / "dash.m4s"
+    source.write_bytes(payload)
+
+    async def handler(request: web.Request) -> web.StreamResponse:
+        return web.FileResponse(source)
+
+    app = web.Application()
+    app.router.add_get("/dash.m4s", handler)
+    async with TestServer(app) as server:
+        index_range = f"{len(init)}-{len(init) + len(sidx) - 1}"
+        prefix_path = tmp_path / "prefix.m4s"
+        await _download_dash_prefix(
+            get_session(), str(server.make_url("/dash.m4s")), index_range, 15, prefix_path, headers={}
+        )
+
+    # 前 15 秒需要前两个分段
+    assert prefix_path.read_bytes() == payload[: len(init) + len(sidx) + 3000]
+
+
+def test_encode_base64(tmp_path: Path):
+    import base64
+
+    from nonebot_plugin_resolver2.matchers import helper
+
+    # 跨越多个分块且长度不是 3 的倍数
+    data = bytes(range(256)) * (helper._BASE64_CHUNK // 256 * 2 + 3) + b"x"
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+    assert helper._encode_base64(path) == "base64://" + base64.b64encode(data).decode()
+
+    path.write_bytes(b"")
+    assert helper._encode_base64(path) == "base64://"
+
+
+async def test_base64_budget():
+    import asyncio
+
+    from nonebot_plugin_resolver2.matchers.helper import _ByteBudget
+
+    budget = _ByteBudget(100)
+    await budget.acquire(80)
+    # 其他 handler 等待预留释放
+    waiter = asyncio.create_task(budget.acquire(50))
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    # 已持有预留的 handler 不等待，避免互相等待
+    await asyncio.wait_for(budget.acquire(50, holding=True), 1)
+    assert budget.used == 130
+    await budget.release(130)
+    await asyncio.wait_for(waiter, 1)
+    assert budget.used == 50
+
+
+async def test_media_server(tmp_path: Path):
+    from urllib.parse import parse_qs, urlparse
+
+    from fastapi import FastAPI, HTTPException
+
+    from nonebot_plugin_resolver2.server import MediaServer
+
+    server = MediaServer(tmp_path, "http://127.0.0.1:8080/", ttl=60)
+    app = FastAPI()
+    server.mount(app)
+    assert server.enabled
+    endpoint = next(route.endpoint for route in app.routes if getattr(route, "path", "").startswith("/resolver2"))
+
+    file = tmp_path / "a b.mp4"
+    file.write_bytes(b"0" * 1024)
+    url = urlparse(server.url_for(file))
+    assert url.netloc == "127.0.0.1:8080"
+    assert url.path == "/resolver2/media/a%20b.mp4"
+    query = {key: value[0] for key, value in parse_qs(url.query).items()}
+    expires, sig = int(query["expires"]), query["sig"]
+
+    response = await endpoint(file.name, expires, sig)
+    assert Path(response.path) == file
+    # 篡改文件名、过期时间或签名
+    name = file.name
+    for args in [("..", expires, sig), ("x.mp4", expires, sig), (name, expires + 1, sig), (name, expires, "0")]:
+        with pytest.raises(HTTPException):
+            await endpoint(*args)
+    assert not server.verify(file.name, 0, server._sign(file.name, 0))
+
+
+async def test_download_hls_segments(tmp_path: Path):
+    import asyncio
+    import os
+
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from nonebot_plugin_resolver2.client import get_session
+    from nonebot_plugin_resolver2.download.hls import _download_segments
+    from nonebot_plugin_resolver2.download.telemetry import DownloadRecord
+    from nonebot_plugin_resolver2.exception import DownloadSizeLimitException
+
+    segments = [os.urandom(1000) for _ in range(8)]
+    failed: set[int] = set()
+
+    async def handler(request: web.Request) -> web.Response:
+        index = int(request.match_info["index"])
+        # 靠前的分段返回更慢，第 3 个分段第一次请求失败
+        await asyncio.sleep((8 - index) * 0.02)
+        if index == 3 and index not in failed:
+            failed.add(index)
+            return web.Response(status=503)
+        return web.Response(body=segments[index])
+
+    app = web.Application()
+    app.router.add_get("/{index}.ts", handler)
+    async with TestServer(app) as server:
+        urls = [str(server.make_url(f"/{i}.ts")) for i in range(len(segments))]
+        record = DownloadRecord(name="hls", url="hls")
+        path = tmp_path / "full.ts"
+        await _download_segments(get_session(), urls, path, 10_000, record, headers={})
+        # 按顺序写入
+        assert path.read_bytes() == b"".join(segments)
+        assert record.retries == 1
+
+        # 超过大小限制时在分段边界停止
+        path = tmp_path / "capped.ts"
+        await _download_segments(get_session(), urls, path, 3500, record, headers={})
+        assert path.read_bytes() == b"".join(segments[:3])
+
+        with pytest.raises(DownloadSizeLimitException):
+            await _download_segments(get_session(), urls, tmp_path / "none.ts", 500, record, headers={})
+
+
+def test_parse_m3u8():
+    from nonebot_plugin_resolver2.download.hls import parse_m3u8
+    from nonebot_plugin_resolver2.exception import DownloadException
+
+    media = (
+        "#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:10\n"
+        "#EXTINF:10.010000,\nseg0.ts?k=1\n"
+        "#EXTINF:4.5,\n#EXT-X-DISCONTINUITY\nhttps://cdn.example.com/seg1.ts\n"
+        "#EXTINF:9,title\n/abs/seg2.ts\n#EXT-X-ENDLIST\n"
+    )
+    playlist = parse_m3u8(media, "https://example.com/video/index.m3u8")
+    assert [segment.url for segment in playlist.segments] == [
+        "https://example.com/video/seg0.ts?k=1",
+        "https://cdn.example.com/seg1.ts",
+        "https://example.com/abs/seg2.ts",
+    ]
+    assert playlist.duration == pytest.approx(23.51)
+    assert not playlist.variants
+
+    master = (
+        "#EXTM3U\n"
+        '#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,CODECS="avc1.4d401e,mp4a.40.2"\n360.m3u8\n'
+        "#EXT-X-STREAM-INF:RESOLUTION=1280x720,BANDWIDTH=2000000\n720.m3u8\n"
+    )
+    playlist = parse_m3u8(master, "https://example.com/master.m3u8")
+    assert [(v.url, v.bandwidth, v.resolution) for v in playlist.variants] == [
+        ("https://example.com/360.m3u8", 800000, "640x360"),
+        ("https://example.com/720.m3u8", 2000000, "1280x720"),
+    ]
+    assert not playlist.segments
+
+    with pytest.raises(ValueError, match="m3u8"):
+        parse_m3u8("<html></html>", "https://example.com/")
+
+    # fmp4 初始化分段和加密分段无法直接拼接，METHOD=NONE 表示不加密
+    plain = parse_m3u8("#EXTM3U\n#EXT-X-KEY:METHOD=NONE\n#EXTINF:1,\na.ts\n", "https://example.com/")
+    assert len(plain.segments) == 1
+    with pytest.raises(DownloadException, match="EXT-X-MAP"):
+        parse_m3u8('#EXTM3U\n#EXT-X-MAP:URI="init.mp4"\n#EXTINF:1,\na.m4s\n', "https://example.com/")
+    with pytest.raises(DownloadException, match="EXT-X-KEY"):
+        parse_m3u8('#EXTM3U\n#EXT-X-KEY:METHOD=AES-128,URI="k"\n#EXTINF:1,\na.ts\n', "https://example.com/")
+
+
+async def test_ytdlp_pool(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    import asyncio
+
+    from nonebot_plugin_resolver2.download import ytdlp
+
+    # 模拟工作进程: 按 url 决定返回结果、失败或卡住
+    fake_worker = tmp_path / "worker.py"
+    fake_worker.write_text(
+        "import json, os, sys, time\n"
+        "print(json.dumps({'ready': True}), flush=True)\n"
+        "for line in sys.stdin:\n"
+        "    job = json.loads(line)\n"
+        "    if job['url'] == 'hang':\n"
+        "        time.sleep(10)\n"
+        "    if job['url'] == 'fail':\n"
+        "        print(json.dumps({'ok': False, 'error': 'DownloadError: boom'}), flush=True)\n"
+        "        continue\n"
+        "    result = {'pid': os.getpid(), 'url': job['url'], 'title': 'x' * 200_000}\n"
+        "    print(json.dumps({'ok': True, 'result': result}), flush=True)\n"
+    )
+    monkeypatch.setattr(ytdlp, "_WORKER_SCRIPT", fake_worker)
+
+    pool = ytdlp.YtdlpPool(workers=2, timeout=5)
+    await pool.start()
+    try:
+        results = await asyncio.gather(*[pool.run("extract", f"url{i}", {}) for i in range(4)])
+        assert [result["url"] for result in results] == [f"url{i}" for i in range(4)]
+        # 大于 StreamReader 默认限制的结果也可以传输
+        assert len(results[0]["title"]) == 200_000
+        # 进程被复用
+        assert len({result["pid"] for result in results}) <= 2
+
+        with pytest.raises(RuntimeError, match="boom"):
+            await pool.run("extract", "fail", {})
+
+        with pytest.raises(RuntimeError, match="超时"):
+            await pool.run("extract", "hang", {}, timeout=0.5)
+
+        # 取消时结束执行中的进程
+        task = asyncio.create_task(pool.run("extract", "hang", {}))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        stats = pool.stats()
+        assert stats["completed"] == 4
+        assert stats["timed_out"] == 1
+        assert stats["killed"] == 2
+        # 被结束的进程在后台补充，之后的任务正常执行，补充期间进程数不超过上限
+        results = await asyncio.gather(*[pool.run("extract", f"after{i}", {}) for i in range(4)])
+        assert [result["url"] for result in results] == [f"after{i}" for i in range(4)]
+        assert len({result["pid"] for result in results}) <= 2
+        await asyncio.gather(*pool._spawn_tasks)
+        assert pool.stats()["alive"] == 2
+        assert pool.stats()["idle"] == 2
+    finally:
+        await pool.close()
+
+
+def test_ytdlp_info_cache(tmp_path: Path):
+    import time
+
+    from nonebot_plugin_resolver2.download.ytdlp_cache import InfoCache, url_cache_key
+
+    for url in [
+        "https://youtu.be/EKkzbbLYPuI?si=K_S9zIp5g7DhigVz",
+        "https://www.youtube.com/watch?v=EKkzbbLYPuI&list=RD8AxpdwegNKc&index=2",
+        "https://www.youtube.com/watch?feature=share&v=EKkzbbLYPuI",
+        "https://youtube.com/shorts/EKkzbbLYPuI",
+    ]:
+        assert url_cache_key(url) == "Youtube:EKkzbbLYPuI"
+    assert url_cache_key("https://www.tiktok.com/@user/video/7440000000000000000") == "TikTok:7440000000000000000"
+    assert url_cache_key("https://example.com/video") is None
+
+    expire = int(time.time()) + 3600
+    info = {
+        "id": "EKkzbbLYPuI",
+        "extractor_key": "Youtube",
+        "title": "title",
+        "duration": 100,
+        "thumbnails": [{"url": "https://i.ytimg.com/x.jpg"}] * 100,
+        "subtitles": {"en": [{"url": "https://example.com/sub"}]},
+        "formats": [
+            {"format_id": "18", "ext": "mp4", "url": f"https://rr.googlevideo.com/videoplayback?expire={expire}&x=1"},
+        ],
+    }
+    cache = InfoCache(max_bytes=1024 * 1024, ttl=6 * 3600, persist_path=tmp_path / "info.json")
+    projected = cache.put("https://youtu.be/EKkzbbLYPuI", info)
+    assert projected == {
+        "id": "EKkzbbLYPuI",
+        "extractor_key": "Youtube",
+        "title": "title",
+        "duration": 100,
+        "formats": [{"format_id": "18", "ext": "mp4"}],
+    }
+    # 不同的链接形式命中同一条目
+    assert cache.get("https://www.youtube.com/watch?v=EKkzbbLYPuI") == projected
+    # 过期时间不晚于签名地址的过期时间
+    assert cache._entries["Youtube:EKkzbbLYPuI"].expires_at <= expire
+
+    # 无法从链接得到 id 的平台，通过链接别名命中
+    cache.put("https://example.com/a", {"id": "a", "extractor_key": "Generic", "title": "a"})
+    assert cache.get("https://example.com/a") == {"id": "a", "extractor_key": "Generic", "title": "a"}
+
+    # 持久化后重新读取
+    cache.save()
+    restored = InfoCache(max_bytes=1024 * 1024, ttl=6 * 3600, persist_path=tmp_path / "info.json")
+    restored.load()
+    assert restored.get("https://youtu.be/EKkzbbLYPuI") == projected
+    assert restored.size == cache.size
+
+    # 按总字节数淘汰最久未使用的条目
+    small = InfoCache(max_bytes=300, ttl=60)
+    for i in range(10):
+        small.put(f"https://example.com/{i}", {"id": str(i), "extractor_key": "Generic", "title": "x" * 50})
+    assert small.size <= 300
+    assert small.get("https://example.com/9") is not None
+    assert small.get("https://example.com/0") is None
+
+    # 过期的条目不会返回
+    expired = InfoCache(max_bytes=1024, ttl=-1)
+    expired.put("https://example.com/a", {"id": "a", "extractor_key": "Generic"})
+    assert expired.get("https://example.com/a") is None
+    assert len(expired) == 0
+
+
+def test_ytdlp_select_format():
+    from nonebot_plugin_resolver2.download.ytdlp import select_format
+    from nonebot_plugin_resolver2.exception import DownloadSizeLimitException
+
+    mb = 1024 * 1024
+    info = {
+        "duration": 100,
+        "formats": [
+            {"format_id": "sb0", "ext": "mhtml", "vcodec": "none", "acodec": "none"},
+            {"format_id": "18", "vcodec": "avc1.42001E", "acodec": "mp4a.40.2", "height": 360, "tbr": 500},
+            {"format_id": "140", "ext": "m4a", "vcodec": "none", "acodec": "mp4a.40.2", "filesize": 2 * mb},
+            {"format_id": "251", "ext": "webm", "vcodec": "none", "acodec": "opus", "filesize": 1 * mb},
+            {"format_id": "137", "ext": "mp4", "vcodec": "avc1.640028", "acodec": "none", "height": 1080, "tbr": 4000},
+            {"format_id": "136", "ext": "mp4", "vcodec": "avc1.4d401f", "acodec": "none", "height": 720},
+            {
+                "format_id": "136a",
+                "ext": "mp4",
+                "vcodec": "avc1.4d401f",
+                "acodec": "none",
+                "height": 720,
+                "filesize_approx": 20 * mb,
+            },
+            {"format_id": "248", "ext": "webm", "vcodec": "vp9", "acodec": "none", "height": 1080, "filesize": 30 * mb},
+        ],
+    }
+    # 1080P h264 约 48 MB，加上 aac 音频
+    selection = select_format(info, 100 * mb)
+    assert selection
+    assert (selection.format, selection.compatible) == ("137+140", True)
+    assert selection.size == int(4000 * 1000 / 8 * 100) + 2 * mb
+    # 优先 h264，即使 vp9 的分辨率更高
+    selection = select_format(info, 40 * mb)
+    assert selection
+    assert (selection.format, selection.compatible) == ("136a+140", True)
+    selection = select_format(info, 8 * mb)
+    assert selection
+    assert (selection.format, selection.compatible) == ("18", True)
+
+    with pytest.raises(DownloadSizeLimitException):
+        select_format(info, 1 * mb)
+    # 没有格式信息时交给 yt-dlp 处理
+    assert select_format({"duration": 100}, 100 * mb) is None
+    # 只有视频格式可以估算大小，没有音视频合一的格式
+    info = {
+        "duration": 100,
+        "formats": [
+            {"format_id": "140", "ext": "m4a", "vcodec": "none", "acodec": "mp4a.40.2"},
+            {"format_id": "137", "ext": "mp4", "vcodec": "avc1.640028", "acodec": "none", "filesize": 10 * mb},
+        ],
+    }
+    assert select_format(info, 100 * mb) is None
+
+
+async def test_ytdlp_download_native(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    from nonebot_plugin_resolver2.download import ytdlp
+
+    requested_formats = [
+        {"format_id": "137", "ext": "mp4", "protocol": "https", "url": "https://v", "http_headers": {"A": "1"}},
+        {"format_id": "140", "ext": "m4a", "protocol": "https", "url": "https://a", "http_headers": {"A": "1"}},
+    ]
+    downloads: list[tuple[str, str | None, dict | None]] = []
+    merges: list[tuple[Path, Path, Path]] = []
+
+    async def fake_run_ytdlp(action: str, url: str, opts: dict) -> dict:
+        assert action == "extract"
+        return {"requested_formats": requested_formats}
+
+    async def fake_download(url: str, *, file_name=None, proxy=None, ext_headers=None, **_) -> Path:
+        downloads.append((url, file_name, ext_headers))
+        return tmp_path / file_name
+
+    async def fake_merge_av(*, v_path: Path, a_path: Path, output_path: Path) -> None:
+        merges.append((v_path, a_path, output_path))
+
+    monkeypatch.setattr(ytdlp, "_run_ytdlp", fake_run_ytdlp)
+    monkeypatch.setattr(ytdlp, "download_file_by_stream", fake_download)
+    monkeypatch.setattr(ytdlp, "merge_av", fake_merge_av)
+
+    video_path = tmp_path / "video.mp4"
+    assert await ytdlp._download_native("https://youtu.be/x", "137+140", video_path)
+    assert downloads == [
+        ("https://v", "video-137.mp4", {"A": "1"}),
+        ("https://a", "video-140.m4a", {"A": "1"}),
+    ]
+    assert merges == [(tmp_path / "video-137.mp4", tmp_path / "video-140.m4a", video_path)]
+
+    # 分片格式交给 yt-dlp 下载
+    requested_formats[0]["protocol"] = "http_dash_segments"
+    downloads.clear()
+    assert not await ytdlp._download_native("https://youtu.be/x", "137+140", video_path)
+    assert not downloads
+
+
+async def test_ytdlp_audio_postprocessor(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    from nonebot_plugin_resolver2.download import ytdlp
+
+    monkeypatch.setattr(ytdlp, "YTDLP_AUDIO_FORMAT", "passthrough")
+    assert ytdlp._audio_postprocessor(600)["preferredcodec"] == "best"
+    # 原音频为 flac 时保持原样；下载后接受 yt-dlp 产生的其他扩展名，跳过临时文件和视频
+    monkeypatch.setattr(ytdlp, "plugin_cache_dir", tmp_path)
+    (tmp_path / "a.flac").write_bytes(b"0")
+    assert await ytdlp._find_audio("a") == tmp_path / "a.flac"
+    (tmp_path / "b.wav").write_bytes(b"0")
+    (tmp_path / "b.webm.part").write_bytes(b"0")
+    assert await ytdlp._find_audio("b") is None
+    assert await ytdlp._find_audio("b", any_suffix=True) == tmp_path / "b.wav"
+    (tmp_path / "c.mp4").write_bytes(b"0")
+    assert await ytdlp._find_audio("c", any_suffix=True) is None
+    monkeypatch.setattr(ytdlp, "YTDLP_AUDIO_FORMAT", "flac")
+    assert ytdlp._audio_postprocessor(600)["preferredcodec"] == "flac"
+
+    monkeypatch.setattr(ytdlp, "MAX_SIZE", 100)
+    monkeypatch.setattr(ytdlp, "YTDLP_AUDIO_FORMAT", "opus")
+    # 短音频使用默认码率
+    assert ytdlp._audio_postprocessor(600)["preferredquality"] == "96"
+    # 10 小时的音频需要降低码率才能不超过 100 MB
+    assert ytdlp._audio_postprocessor(10 * 3600)["preferredquality"] == "24"
+    monkeypatch.setattr(ytdlp, "YTDLP_AUDIO_FORMAT", "mp3")
+    assert ytdlp._audio_postprocessor(3 * 3600)["preferredquality"] == "73"
+    assert ytdlp._audio_postprocessor(0)["preferredquality"] == "192"
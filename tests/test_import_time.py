@@ -0,0 +1,68 @@
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+
+from nonebot import logger
+
+# 插件自身模块的导入耗时上限，单位微秒
+PLUGIN_IMPORT_BUDGET_US = 500_000
+# 导入插件时不应导入的重型依赖，在第一次使用对应平台时才导入
+DEFERRED_MODULES = ("yt_dlp", "bilibili_api", "curl_cffi", "tqdm")
+
+LOAD_SCRIPT = """
+import nonebot
+from nonebot.adapters.onebot.v11 import Adapter
+
+nonebot.init()
+nonebot.get_driver().register_adapter(Adapter)
+nonebot.load_plugin("nonebot_plugin_resolver2")
+
+import json
+import sys
+
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+def _load_plugin(env: dict[str, str]) -> tuple[set[str], dict[str, tuple[int, int]]]:
+    """在子进程中加载插件，解析 -X importtime 的输出
+
+    importlib.import_module 导入的模块不会出现在 -X importtime 的输出中，已导入的模块以 sys.modules 为准
+
+    Returns:
+        tuple[set[str], dict[str, tuple[int, int]]]: 已导入的模块，模块名到 (自身耗时, 累计耗时) 的映射，单位微秒
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", LOAD_SCRIPT],
+        cwd=Path(__file__).parent.parent,
+        env={**os.environ, "ENVIRONMENT": "test", **env},
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    assert result.returncode == 0, result.stderr[-2000:]
+    times: dict[str, tuple[int, int]] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    modules = set(json.loads(result.stdout.splitlines()[-1]))
+    return modules, times
+
+
+def test_import_time():
+    modules, times = _load_plugin({"R_DISABLE_RESOLVERS": json.dumps(["ytb", "tiktok"])})
+
+    for module in DEFERRED_MODULES:
+        assert module not in modules, f"导入插件时导入了 {module}"
+    # 被禁用的解析器不会被导入
+    assert "nonebot_plugin_resolver2.matchers.bilibili" in modules
+    assert "nonebot_plugin_resolver2.matchers.ytb" not in modules
+    assert "nonebot_plugin_resolver2.matchers.tiktok" not in modules
+
+    plugin_us = sum(self_us for name, (self_us, _) in times.items() if name.startswith("nonebot_plugin_resolver2"))
+    logger.info(f"插件模块导入耗时 {plugin_us / 1000:.1f} ms")
+    assert plugin_us < PLUGIN_IMPORT_BUDGET_US